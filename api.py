@@ -231,10 +231,10 @@ def CrowdReportFormPost(author, request):
   if ContainsSpam(text):
     # TODO(kpy): Consider applying a big downvote here instead of a 403.
     raise base_handler.ApiError(403, 'Crowd report text rejected as spam.')
-  model.CrowdReport.Create(source=request.root_url, author=author,
-                           effective=now, text=text, topic_ids=topic_ids,
-                           answers=answers, location=ll)
-  card.InvalidateReportCache(topic_ids, ll)
+  report = model.CrowdReport.Create(
+      source=request.root_url, author=author, effective=now, text=text,
+      topic_ids=topic_ids, answers=answers, location=ll)
+  card.UpdateReportCache(report)
 
 
 def CrowdReportJsonPost(auth, report_dicts):
@@ -243,8 +243,13 @@ def CrowdReportJsonPost(auth, report_dicts):
     raise base_handler.ApiError(403, 'Not authorized to submit crowd reports.')
 
   now = utils.UtcToTimestamp(datetime.datetime.utcnow())
-  return [DictToReport(report, auth, now, auth.crowd_report_spam_check)
-          for report in report_dicts]
+  results = [DictToReport(report, auth, now, auth.crowd_report_spam_check)
+             for report in report_dicts]
+  # Update the cached answers only after all the reports have been stored.
+  for result in results:
+    if isinstance(result, model.CrowdReport):
+      card.UpdateReportCache(result)
+  return results
 
 
 def DictToReport(report, auth, now, spam_check=True):
@@ -326,4 +331,6 @@ class CrowdVotes(base_handler.BaseHandler):
     voter = self.GetCurrentUserUrl()
     report_id = self.request.get('cm-report-id', '')
     vote_type = VOTE_TYPES_BY_CODE.get(self.request.get('cm-vote-code'))
-    model.CrowdVote.Put(report_id, voter, vote_type)
+    report = model.CrowdVote.Put(report_id, voter, vote_type)
+    if report:
+      card.UpdateReportCache(report)
@@ -14,14 +14,18 @@
 
 __author__ = 'lschumacher@google.com (Lee Schumacher)'
 
+import datetime
 import json
 
 import base_handler
+import card
 import config
 import model
 import protect
 import test_utils
 
+from google.appengine.ext import ndb
+
 
 class MapByIdTest(test_utils.BaseTest):
   """Tests for the MapById API."""
@@ -275,6 +279,33 @@ class CrowdReportsTest(test_utils.BaseTest):
     self.assertEquals(expected['location'], reports[0]['location'])
     self.assertEquals(expected['place_id'], reports[0]['place_id'])
 
+  def testPostJsonUpdatesReportCache(self):
+    map_id = test_utils.CreateMap(owners=['map_owner']).id
+    topic_id = map_id + '.gas'
+    key = model.Authorization.Create(
+        crowd_report_write_permission=True, source='http://client.com/',
+        author_prefix='tel:+1', map_ids=[map_id]).id
+    cache_key = [map_id, 'gas', card.RoundGeoPt(ndb.GeoPt(37, -75))]
+    card.REPORT_CACHE.Set(cache_key, ({}, {}, []))
+
+    # A report posted through the JSON API should appear in the cached answers.
+    self.DoPost('/.api/reports?key=' + key, json.dumps([{
+        'id': 'http://client.com/1',
+        'source': 'http://client.com/',
+        'author': 'tel:+15551234567',
+        'map_id': map_id,
+        'topic_ids': [topic_id],
+        'answers': {topic_id + '.1': 'yes'},
+        'location': [37, -75],
+        'text': 'Hello'
+    }]), content_type='application/json', https=True)
+    now = datetime.datetime.utcfromtimestamp(self.default_time_secs)
+    self.assertEquals(
+        ({'1': 'yes', '_text': 'Hello'}, {'1': now, '_text': now},
+         [{'_id': 'http://client.com/1', '_effective': now,
+           '1': 'yes', '_text': 'Hello'}]),
+        card.REPORT_CACHE.Get(cache_key))
+
   def testAnonymousMultipleReportsWithLatLng(self):
     report1_time = self.default_time_secs
     self.DoPost('/.api/reports', {
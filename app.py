@@ -128,8 +128,11 @@ app = webapp2.WSGIApplication([
 
             # Tasks executed by cron or taskqueue
             Route('/.metadata_fetch', 'metadata_fetch.MetadataFetch'),
+            Route('/.metadata_fetch_batch',
+                  'metadata_fetch.MetadataFetchBatch'),
             Route('/.metadata_fetch_log_cleaner',
                   'metadata_fetch.MetadataFetchLogCleaner'),
+            Route('/.blob_store_cleaner', 'blob_store.BlobStoreCleaner'),
             Route('/.wms/cleanup', 'wmscache.tileworker.CleanupOldWorkers'),
             Route('/.wms/tileworker', 'wmscache.tileworker.StartWorker'),
             Route('/.crowd_report_cleanup', 'crowd_report_tasks.Cleanup'),
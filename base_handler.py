@@ -14,6 +14,7 @@
 
 __author__ = 'lschumacher@google.com (Lee Schumacher)'
 
+import hashlib
 import hmac
 import httplib
 import inspect
@@ -113,6 +114,13 @@ def ToHtmlSafeJson(data, **kwargs):
       '&', '\\u0026').replace('<', '\\u003c').replace('>', '\\u003e')
 
 
+def MakeEtag(content):
+  """Computes a strong ETag (a quoted MD5 hex digest) for a response body."""
+  if isinstance(content, unicode):
+    content = content.encode('utf-8')
+  return '"%s"' % hashlib.md5(content).hexdigest()
+
+
 def GenerateXsrfToken(uid, timestamp=None):
   """Generates a timestamped XSRF-prevention token scoped to the given uid."""
   timestamp = str(timestamp or int(time.time()))
@@ -377,8 +385,15 @@ class BaseHandler(webapp2.RequestHandler):
     except ValueError:
       raise ApiError(400, 'Invalid JSON data.')
 
-  def WriteJson(self, data):
-    """Writes out a JSON or JSONP serialization of the given data."""
+  def WriteJson(self, data, etag=None):
+    """Writes out a JSON or JSONP serialization of the given data.
+
+    Args:
+      data: The JSON data structure to write.
+      etag: Optional.  An ETag for the data, typically computed once when the
+          data was cached.  If given, the response carries an ETag (which also
+          covers the callback, if any) and honours If-None-Match.
+    """
     callback = self.request.get('callback', '')
     output = ToHtmlSafeJson(data)
 
@@ -397,12 +412,37 @@ class BaseHandler(webapp2.RequestHandler):
       # Prepend response with a JS comment to be sure the user-supplied callback
       # name is not the first thing the browser sees.  This further reduces the
       # risk of a content sniffing attack.
-      self.response.out.write('//\n' + SanitizeCallback(callback) +
-                              '(' + output + ')')
+      output = '//\n' + SanitizeCallback(callback) + '(' + output + ')'
+      etag = etag and MakeEtag(etag + callback)
     else:  # just emit the JSON literal
       self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+    if etag:
+      self.WriteWithEtag(output, etag)
+    else:
       self.response.out.write(output)
 
+  def WriteWithEtag(self, content, etag=None):
+    """Writes out a response body with an ETag, honouring If-None-Match.
+
+    If the client already has a copy of the content (i.e. it sent a matching
+    If-None-Match header with a GET or HEAD request), we respond with 304 Not
+    Modified and no body.  Only successful (200) responses are affected.
+
+    Args:
+      content: The response body, a string.
+      etag: The ETag for the content, if already known (e.g. computed when the
+          content was cached).  If omitted, it is computed from the content.
+    """
+    etag = etag or MakeEtag(content)
+    self.response.headers['ETag'] = etag
+    if_none_match = self.request.headers.get('If-None-Match', '')
+    client_etags = [tag.strip() for tag in if_none_match.split(',')]
+    if (self.request.method in ['GET', 'HEAD'] and
+        self.response.status_int == 200 and etag in client_etags):
+      self.response.set_status(304)
+    else:
+      self.response.out.write(content)
+
   def _GetNavbarContext(self, user):
     get_domains = lambda role: sorted(perms.GetAccessibleDomains(user, role))
     return user and {
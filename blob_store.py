@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# Copyright 2014 Google Inc.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at: http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distrib-
+# uted under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, either express or implied.  See the License for
+# specific language governing permissions and limitations under the License.
+
+"""Content-addressed storage for large, immutable payloads.
+
+memcache_big refuses values over 16 MB, and values that span many chunks are
+slow to get.  A blob store keeps such payloads under their SHA-1 digest, so
+that a cache.Cache only has to keep the digest in memcache; see the
+blob_store and blob_threshold arguments of cache.Cache.
+"""
+
+import datetime
+import hashlib
+import logging
+import os
+import tempfile
+
+import base_handler
+
+from google.appengine import runtime
+from google.appengine.ext import db
+
+# Datastore entities are limited to 1 MiB, so blobs are stored in chunks.
+CHUNK_SIZE_BYTES = 1000 * 1000
+
+# Blobs are deleted by the BlobStoreCleaner this long after they were stored.
+# Anything that refers to a blob should expire well before then.
+BLOB_TTL = datetime.timedelta(days=1)
+
+
+class BlobChunk(db.Model):
+  """One chunk of a blob.  The key name is '<digest>:<chunk index>'."""
+  data = db.BlobProperty()
+  num_chunks = db.IntegerProperty()  # the total number of chunks in the blob
+  put_time = db.DateTimeProperty(auto_now=True)
+
+
+class DatastoreBlobStore(object):
+  """A blob store that keeps blobs in the datastore."""
+
+  def Put(self, data):
+    """Stores a blob.
+
+    Args:
+      data: The content of the blob, a string.
+    Returns:
+      The digest under which the blob is stored.
+    """
+    digest = hashlib.sha1(data).hexdigest()
+    first = BlobChunk.get_by_key_name('%s:0' % digest)
+    if first and first.put_time > datetime.datetime.utcnow() - BLOB_TTL / 2:
+      return digest  # already stored, and not about to be cleaned up
+    chunks = [data[i:i + CHUNK_SIZE_BYTES]
+              for i in xrange(0, len(data), CHUNK_SIZE_BYTES)] or ['']
+    # The first chunk is written last, so that a reader never finds the first
+    # chunk of a blob whose other chunks are missing.
+    for i in reversed(range(len(chunks))):
+      BlobChunk(key_name='%s:%d' % (digest, i), data=chunks[i],
+                num_chunks=len(chunks)).put()
+    return digest
+
+  def Get(self, digest):
+    """Gets a blob.
+
+    Args:
+      digest: The digest returned by Put.
+    Returns:
+      The content of the blob, or None if it's not in the store.
+    """
+    first = BlobChunk.get_by_key_name('%s:0' % digest)
+    if not first:
+      return None
+    rest = BlobChunk.get_by_key_name(
+        ['%s:%d' % (digest, i) for i in range(1, first.num_chunks)])
+    if None in rest:
+      return None
+    data = ''.join([first.data] + [chunk.data for chunk in rest])
+    if hashlib.sha1(data).hexdigest() != digest:
+      logging.warn('Blob %s is corrupt', digest)
+      return None
+    return data
+
+
+class FileBlobStore(object):
+  """A blob store that keeps blobs as files in a local directory.
+
+  This is a stand-in for the DatastoreBlobStore in tests and local tools.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def Put(self, data):
+    """Stores a blob.  See DatastoreBlobStore.Put."""
+    digest = hashlib.sha1(data).hexdigest()
+    # Write to a temporary file first, so that readers never see a partial file.
+    fd, temp_path = tempfile.mkstemp(dir=self.directory)
+    with os.fdopen(fd, 'wb') as temp_file:
+      temp_file.write(data)
+    os.rename(temp_path, os.path.join(self.directory, digest))
+    return digest
+
+  def Get(self, digest):
+    """Gets a blob.  See DatastoreBlobStore.Get."""
+    try:
+      with open(os.path.join(self.directory, digest), 'rb') as blob_file:
+        return blob_file.read()
+    except IOError:
+      return None
+
+
+STORE = DatastoreBlobStore()
+
+
+class BlobStoreCleaner(base_handler.BaseHandler):
+  """Deletes old blobs from the DatastoreBlobStore."""
+
+  def Get(self):
+    """Deletes BlobChunk entities until the request runs out of time."""
+    count = 0
+    try:
+      query = BlobChunk.all(keys_only=True).order('put_time').filter(
+          'put_time <', datetime.datetime.utcnow() - BLOB_TTL)
+      keys = query.fetch(100)
+      while keys:
+        db.delete(keys)
+        count += len(keys)
+        query.with_cursor(query.cursor())
+        keys = query.fetch(100)
+    except runtime.DeadlineExceededError:
+      pass
+    logging.info('Deleted %d old BlobChunk entries', count)
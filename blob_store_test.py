@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# Copyright 2014 Google Inc.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at: http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distrib-
+# uted under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, either express or implied.  See the License for
+# specific language governing permissions and limitations under the License.
+
+"""Tests for blob_store.py."""
+
+import pickle
+import shutil
+import tempfile
+
+import blob_store
+import cache
+import memcache_big
+import test_utils
+
+
+class BlobStoreTest(test_utils.BaseTest):
+  """Tests the blob stores and their use by cache.Cache."""
+
+  def setUp(self):
+    super(BlobStoreTest, self).setUp()
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+    super(BlobStoreTest, self).tearDown()
+
+  def testDatastoreBlobStore(self):
+    self.SetForTest(blob_store, 'CHUNK_SIZE_BYTES', 10)
+    store = blob_store.DatastoreBlobStore()
+    data = 'abcdefghijklmnopqrstuvwxyz'
+    digest = store.Put(data)
+    self.assertEquals(3, blob_store.BlobChunk.all().count())
+    self.assertEquals(data, store.Get(digest))
+    self.assertEquals(digest, store.Put(data))  # content-addressed
+    self.assertEquals(3, blob_store.BlobChunk.all().count())
+    self.assertEquals('', store.Get(store.Put('')))
+    self.assertEquals(None, store.Get('0' * 40))
+
+    # A blob with a missing chunk is treated as missing.
+    blob_store.BlobChunk.get_by_key_name(digest + ':2').delete()
+    self.assertEquals(None, store.Get(digest))
+
+  def testFileBlobStore(self):
+    store = blob_store.FileBlobStore(self.directory)
+    digest = store.Put('foo')
+    self.assertEquals('foo', store.Get(digest))
+    self.assertEquals(None, store.Get('0' * 40))
+
+  def testBlobStoreCleaner(self):
+    self.SetTime(1000000)
+    old_digest = blob_store.STORE.Put('old')
+    self.SetTime(1000000 + 2 * 24 * 3600)
+    new_digest = blob_store.STORE.Put('new')
+    self.DoGet('/.blob_store_cleaner')
+    self.assertEquals(None, blob_store.STORE.Get(old_digest))
+    self.assertEquals('new', blob_store.STORE.Get(new_digest))
+
+  def testCacheKeepsLargeValuesInBlobStore(self):
+    store = blob_store.FileBlobStore(self.directory)
+    c = cache.Cache('test', 60, blob_store=store, blob_threshold=100)
+    c.Set('small', 'x')
+    c.Set('large', ['y' * 1000])
+    # A small value is pickled only once, to measure it, and stays pickled.
+    pickled = memcache_big.get(c.KeyToJson('small')).value
+    self.assertTrue(isinstance(pickled, cache.PickledValue))
+    self.assertEquals('x', pickle.loads(pickled.data))
+    pointer = memcache_big.get(c.KeyToJson('large')).value
+    self.assertTrue(isinstance(pointer, cache.BlobPointer))
+
+    # Values are read back from memcache or the blob store when not in the
+    # local cache.
+    cache.LOCAL_CACHE.Clear()
+    self.assertEquals('x', c.Get('small'))
+    self.assertEquals(['y' * 1000], c.Get('large'))
+
+    # If the blob has gone missing, that's a cache miss.
+    cache.LOCAL_CACHE.Clear()
+    self.SetForTest(store, 'Get', lambda digest: None)
+    self.assertEquals(None, c.Get('large', lambda: None))
+
+
+if __name__ == '__main__':
+  test_utils.main()
@@ -30,6 +30,7 @@ __author__ = 'kpy@google.com (Ka-Ping Yee)'
 import copy
 import json
 import logging
+import pickle
 import random
 import time
 
@@ -40,7 +41,7 @@ import memcache_big as memcache
 # Value to add to cache keys to prevent collisions if/when the cache entry type
 # changes. Otherwise, modifying the cache entry may break an app that uses an
 # older version of this module.
-CACHE_ENTRY_VERSION = 'v3'
+CACHE_ENTRY_VERSION = 'v5'
 
 LOCAL_CACHE = local_cache.LocalCache(0)  # key => CacheEntry
 
@@ -48,6 +49,9 @@ LOCAL_CACHE = local_cache.LocalCache(0)  # key => CacheEntry
 # existence in the cache / retrying to get a lock again.
 RETRY_INTERVAL_SEC = 0.05
 
+# Maximum time to hold, or wait for, the lock taken by Cache.Update().
+UPDATE_LOCK_SEC = 2
+
 
 class CacheEntry(object):
   """Entry to be stored in local cache and memcache.
@@ -59,7 +63,8 @@ class CacheEntry(object):
     """Cache Entry.
 
     Args:
-      value: The value. Will be deep-copied by local_cache.
+      value: The value. Will be deep-copied by local_cache, unless the cache
+          has immutable_values.
       ttl: How long this value is valid. After this time has passed this value
           MUST be ignored and regenerated.
       ttc: How long before we should check for a newer version from the origin.
@@ -70,6 +75,9 @@ class CacheEntry(object):
     self._creation_time = creation_time or time.time()
     self._ttl = ttl
     self.ttc = ttc  # Use the setter for value validation
+    # What memcache keeps in place of the value, if anything: a BlobPointer
+    # to the value in the blob store, or the PickledValue.
+    self.stored_value = None
     # IMPORTANT: If you change how this class functions, you must also update
     # CACHE_ENTRY_VERSION.
 
@@ -107,6 +115,26 @@ class CacheEntry(object):
         (self.value, self.ttl, self.ttc, self._creation_time))
 
 
+class BlobPointer(object):
+  """Stands in for a cached value that is kept in a blob store."""
+
+  def __init__(self, digest):
+    self.digest = digest
+
+  def __repr__(self):
+    return 'BlobPointer(%r)' % self.digest
+
+
+class PickledValue(object):
+  """Stands in for a cached value that was already pickled to measure it."""
+
+  def __init__(self, data):
+    self.data = data
+
+  def __repr__(self):
+    return 'PickledValue(%d bytes)' % len(self.data)
+
+
 def Reset():
   """Reset the state of this module.  For use in tests only."""
   LOCAL_CACHE.Clear()
@@ -199,7 +227,9 @@ class Cache(object):
       updates sooner than the TTL expires.
   """
 
-  def __init__(self, name, ttl, ull=None, get_timeout=None, lock_timeout=1.1):
+  def __init__(self, name, ttl, ull=None, get_timeout=None, lock_timeout=1.1,
+               blob_store=None, blob_threshold=900 * 1000,
+               immutable_values=False):
     """A two-level cache (local RAM and memcache).
 
     Args:
@@ -231,6 +261,17 @@ class Cache(object):
           for part of the second. This is ok though because the lock is per key
           and anything that needs to be cached for less than a second probably
           isn't worth caching through memcache.
+      blob_store: Optional.  A store for large values, such as a
+          blob_store.DatastoreBlobStore.  Values that are bigger than
+          blob_threshold bytes when pickled are kept in the blob store, and
+          memcache holds only a BlobPointer to them.
+      blob_threshold: The size, in bytes, above which values are kept in the
+          blob_store.  The default keeps values that would need more than one
+          memcache_big chunk out of memcache.
+      immutable_values: If True, the local RAM cache keeps and returns the
+          values themselves rather than deep copies of them, which saves
+          copying big values on every Get().  Callers must then never modify
+          a value that they have passed to Set() or gotten from Get().
 
     Raises:
       ValueError: ull > ttl is not allowed.
@@ -256,6 +297,9 @@ class Cache(object):
     self.ull = ull
     self.lock_timeout = lock_timeout
     self.get_timeout = get_timeout or 10
+    self.blob_store = blob_store
+    self.blob_threshold = blob_threshold
+    self.immutable_values = immutable_values
 
   def KeyToJson(self, key):
     """Converts a cache key to a canonical fully qualified string."""
@@ -295,7 +339,7 @@ class Cache(object):
         return entry.value
 
       # Key not found in the local cache, so look for the key in memcache
-      entry = memcache.get(key_json)
+      entry = self._LoadBlob(memcache.get(key_json))
       if entry and now < entry.refresh_time:
         # Found in memcache and still valid, save it locally
         self._SetLocalCache(key_json, entry)
@@ -327,6 +371,35 @@ class Cache(object):
                            'the lock to generate my own: %s: %s' %
                            (self.name, key))
 
+  def GetMulti(self, keys):
+    """Gets the values of many keys at once, with one call to memcache.
+
+    Unlike Get(), this doesn't make values or take make_value locks, so an
+    entry is returned until its hard expiry even if it's due to be refreshed.
+
+    Args:
+      keys: A list of cache keys.  Each can be any JSON-serializable value.
+    Returns:
+      A list of the cached values, in the same order as the keys, with None
+      for each key that was not found.
+    """
+    now = time.time()
+    key_jsons = [self.KeyToJson(key) for key in keys]
+    entries = {}
+    for key_json in key_jsons:
+      entry = LOCAL_CACHE.Get(key_json)
+      if entry:
+        entries[key_json] = entry
+    missing = [key_json for key_json in key_jsons if key_json not in entries]
+    if missing:
+      for key_json, entry in memcache.get_multi(missing).items():
+        entry = self._LoadBlob(entry)
+        if entry and now < entry.hard_expiry:
+          self._SetLocalCache(key_json, entry)
+          entries[key_json] = entry
+    return [entries[key_json].value if key_json in entries else None
+            for key_json in key_jsons]
+
   def _Make(self, key, make_value, old_entry):
     """Try to generate a new value with make_value and set it in cache.
 
@@ -391,7 +464,8 @@ class Cache(object):
       # lock until it's expired.
       old_entry.refresh_time = lock_timeout
       self._SetLocalCache(key_json, old_entry)
-      memcache.set(key_json, old_entry, time=old_entry.hard_expiry)
+      memcache.set(key_json, self._WithBlobPointer(old_entry),
+                   time=old_entry.hard_expiry)
 
     return acquired
 
@@ -421,6 +495,58 @@ class Cache(object):
     """
     return self._Set(memcache.add, key, value, ttl)
 
+  def SetMulti(self, items, ttl=None):
+    """Sets the values of many keys at once, with one call to memcache.
+
+    Args:
+      items: A list of (key, value) pairs, as for Set().
+      ttl: How long the values should last. None means use the cache default.
+    Returns:
+      A list of the keys that were not set successfully.
+    """
+    return self._SetMulti(memcache.set_multi, items, ttl)
+
+  def AddMulti(self, items, ttl=None):
+    """Atomically sets the values of many keys that are not already set.
+
+    Like Add(), this always queries memcache directly, with one call.
+
+    Args:
+      items: A list of (key, value) pairs, as for Add().
+      ttl: How long the values should last. None means use the cache default.
+    Returns:
+      A list of the keys that were previously set and were not updated.
+    """
+    return self._SetMulti(memcache.add_multi, items, ttl)
+
+  def _SetMulti(self, memcache_func, items, ttl):
+    """Set/Add the values of many keys in the cache.
+
+    Args:
+      memcache_func: Either memcache.set_multi or memcache.add_multi.
+      items: A list of (key, value) pairs.
+      ttl: How long the values should last. None means use the cache default.
+    Returns:
+      A list of the keys that were not set successfully.
+    """
+    entries = [(key, self.KeyToJson(key), self._MakeEntry(value, ttl))
+               for key, value in items]
+    if not entries:
+      return []
+    not_set = memcache_func(
+        dict((key_json, self._WithBlobPointer(entry))
+             for _, key_json, entry in entries),
+        time=max(entry.hard_expiry for _, _, entry in entries))
+    failed = []
+    for key, key_json, entry in entries:
+      if key_json in not_set:
+        if memcache_func == memcache.set_multi:  # add failures are common
+          logging.warn('Failed to set a value in memcache: %s', key_json)
+        failed.append(key)
+      else:
+        self._SetLocalCache(key_json, entry)
+    return failed
+
   def _Set(self, memcache_func, key, value, ttl):
     """Set/Add a key's value in the cache.
 
@@ -433,7 +559,24 @@ class Cache(object):
       True if this key was set successfully.
     """
     key_json = self.KeyToJson(key)
+    entry = self._MakeEntry(value, ttl)
+    if memcache_func(key_json, self._WithBlobPointer(entry),
+                     time=entry.hard_expiry):
+      self._SetLocalCache(key_json, entry)
+      return True
+    if memcache_func == memcache.set:  # Don't log add as failure is common
+      logging.warn('Failed to set a value in memcache: %s', key_json)
+    return False
 
+  def _MakeEntry(self, value, ttl):
+    """Makes a CacheEntry for a value, putting big values in the blob store.
+
+    Args:
+      value: The value to store in the cache, or a CacheEntry.
+      ttl: How long this value should last. None means use the cache default.
+    Returns:
+      The CacheEntry to store.
+    """
     if isinstance(value, CacheEntry):
       entry = value
     else:
@@ -447,12 +590,94 @@ class Cache(object):
       entry.ttc = 0.8 * entry.ttl
     # else leave the default of ttc = ttl
 
-    if memcache_func(key_json, entry, time=entry.hard_expiry):
-      self._SetLocalCache(key_json, entry)
-      return True
-    if memcache_func == memcache.set:  # Don't log add as failure is common
-      logging.warn('Failed to set a value in memcache: %s', key_json)
-    return False
+    if self.blob_store:
+      # The value is pickled only once: the pickle goes in the blob store if
+      # it's big, or in memcache in place of the value if not.
+      data = pickle.dumps(entry.value, pickle.HIGHEST_PROTOCOL)
+      if len(data) > self.blob_threshold:
+        entry.stored_value = BlobPointer(self.blob_store.Put(data))
+      else:
+        entry.stored_value = PickledValue(data)
+    return entry
+
+  def _WithBlobPointer(self, entry):
+    """Gets a copy of an entry to store in memcache in place of the value.
+
+    Args:
+      entry: A CacheEntry.
+    Returns:
+      The entry itself, or if it has a stored_value, a copy of the entry with
+      the BlobPointer or PickledValue in place of the value.
+    """
+    # pylint:disable=protected-access
+    if not entry.stored_value:
+      return entry
+    entry = copy.copy(entry)
+    entry._value, entry.stored_value = entry.stored_value, None
+    return entry
+
+  def _LoadBlob(self, entry):
+    """Gets the value for an entry from memcache out of the blob store.
+
+    Args:
+      entry: A CacheEntry from memcache, or None.
+    Returns:
+      The entry itself, or if its value is a BlobPointer or PickledValue, a
+      copy of the entry with the unpickled value, or None if the blob is
+      missing.
+    """
+    # pylint:disable=protected-access
+    stored_value = entry and entry.value
+    if isinstance(stored_value, PickledValue):
+      data = stored_value.data
+    elif isinstance(stored_value, BlobPointer):
+      data = self.blob_store and self.blob_store.Get(stored_value.digest)
+      if data is None:
+        logging.warn('Blob %s is missing for %s',
+                     stored_value.digest, self.name)
+        return None
+    else:
+      return entry
+    entry = copy.copy(entry)
+    entry._value, entry.stored_value = pickle.loads(data), stored_value
+    return entry
+
+  def Update(self, key, update_value):
+    """Atomically replaces a cached value with an updated copy of it.
+
+    Concurrent Update() calls for the same key are serialized with a memcache
+    lock, and the current value is read from memcache rather than the local
+    cache, so no update is lost to a stale read.  The entry keeps its original
+    expiry time.  If the key isn't cached, or the lock can't be acquired within
+    UPDATE_LOCK_SEC, the key is deleted instead so that the next Get() makes a
+    fresh value.
+
+    Args:
+      key: The cache key.  Can be any JSON-serializable value.
+      update_value: A function that takes the current value and returns the
+          new value, or None to delete the key.
+    """
+    key_json = self.KeyToJson(key)
+    lock_key_json = 'cache.update_lock' + key_json
+    deadline = time.time() + UPDATE_LOCK_SEC
+    while not memcache.add(lock_key_json, 1, time=UPDATE_LOCK_SEC):
+      if time.time() + RETRY_INTERVAL_SEC >= deadline:
+        logging.warn('Timed out waiting to update %s', key_json)
+        self.Delete(key)
+        return
+      time.sleep(RETRY_INTERVAL_SEC)
+    try:
+      now = time.time()
+      entry = self._LoadBlob(memcache.get(key_json))
+      value = None
+      if entry and now < entry.hard_expiry:
+        value = update_value(entry.value)
+      if value is None:
+        self.Delete(key)
+      else:
+        self.Set(key, value, ttl=entry.hard_expiry - now)
+    finally:
+      memcache.delete(lock_key_json)
 
   def Delete(self, key):
     """Deletes a key from the cache.
@@ -484,4 +709,5 @@ class Cache(object):
         min(expiry, entry.refresh_time),
         min(expiry, entry.hard_expiry))
 
-    LOCAL_CACHE.Set(key_json, entry, expiry=expiry)
+    LOCAL_CACHE.Set(key_json, entry, expiry=expiry,
+                    copy_value=not self.immutable_values)
@@ -12,7 +12,9 @@
 
 """Displays a card containing a list of nearby features for a given topic."""
 
+import copy
 import datetime
+import functools
 import json
 import logging
 import math
@@ -20,6 +22,7 @@ import re
 import urllib
 
 import base_handler
+import blob_store
 import cache
 import config
 import kmlify
@@ -32,8 +35,10 @@ from google.appengine.api import urlfetch
 from google.appengine.ext import ndb  # just for GeoPt
 
 # A cache of Feature list representing points from XML, keyed by
-# [url, map_id, map_version_id, layer_id]
-XML_FEATURES_CACHE = cache.Cache('card_features.xml', 300)
+# [url, map_id, map_version_id, layer_id].  Large lists are kept in the blob
+# store, with only a pointer in memcache.
+XML_FEATURES_CACHE = cache.Cache('card_features.xml', 300,
+                                 blob_store=blob_store.STORE)
 
 # Fetched strings of Google Places API JSON results, keyed by request URL.
 JSON_PLACES_API_CACHE = cache.Cache('card.places_json', 300)
@@ -42,13 +47,22 @@ JSON_PLACES_API_CACHE = cache.Cache('card.places_json', 300)
 # geolocation_rounded_to_10m, radius, max_count].
 FILTERED_FEATURES_CACHE = cache.Cache('card.filtered_features', 60)
 
-# Key: [map_id, map_version_id, topic_id, geolocation_rounded_to_10m, radius].
+# Rendered card GeoJSON, keyed by [root_url, map_version_id, topic_id,
+# map_label, domain, unit, max_count, radius, include_descriptions, batch,
+# centers].  Each value is a dictionary with keys 'geojson' and 'etag'
+# (computed once, when the GeoJSON is rendered).  Cards that show crowd
+# reports are not cached here, so that a new report appears at once.
+GEOJSON_CACHE = cache.Cache('card.geojson', 15)
+
+# Key: [map_id, topic_id, geolocation_rounded_to_10m].
 # Value: 3-tuple of (latest_answers, answer_times, report_dicts) where
 #   - latest_answers is a dictionary {qid: latest_answer_to_that_question}
 #   - answer_times is a dictionary {qid: effective_time_of_latest_answer}
 #   - report_dicts contains the last REPORTS_PER_FEATURE reports, as a list
 #     of dicts [{qid: answer, '_effective': time, '_id': report_id}]
-REPORT_CACHE = cache.Cache('card.reports', 15)
+# Entries are updated in place by UpdateReportCache whenever a report is
+# written, so they can live much longer than the 15-s update latency limit.
+REPORT_CACHE = cache.Cache('card.reports', 300, 15)
 
 # Number of crowd reports to cache and return per feature.
 REPORTS_PER_FEATURE = 5
@@ -314,7 +328,7 @@ def GetLayer(root, layer_id):
 
 
 def GetFeatures(map_root, map_version_id, topic_id, request, location_center,
-                radius):
+                radius, layer_features=None):
   """Gets a list of Feature objects for a given topic.
 
   Args:
@@ -333,31 +347,49 @@ def GetFeatures(map_root, map_version_id, topic_id, request, location_center,
         can be  used for layers that can do prefiltering based on the radius.
         Otherwise, features will be sorted and filtered by radius later on in
         the flow.
+    layer_features: An optional dictionary of lists of Feature objects keyed
+        by layer ID.  Features of layers that don't depend on location_center
+        are looked up here and stored here if absent, so that a caller getting
+        features for several centers loads each layer only once.
 
   Returns:
     A list of Feature objects associated with layers of a given topic in a given
     map.
   """
   topic = GetTopic(map_root, topic_id) or {}
+  if layer_features is None:
+    layer_features = {}
   features = []
   for layer_id in topic.get('layer_ids', []):
     layer = GetLayer(map_root, layer_id)
     if layer.get('type') == maproot.LayerType.GOOGLE_PLACES:
       features += GetFeaturesFromPlacesLayer(layer, location_center, radius)
     else:
-      url = GetKmlUrl(request.root_url, layer or {})
-      if url:
-        try:
-          def GetXmlFeatures():
-            content = kmlify.FetchData(url, request.host)
-            return GetFeaturesFromXml(content, layer)
-          features += XML_FEATURES_CACHE.Get(
-              [url, map_root['id'], map_version_id, layer_id], GetXmlFeatures)
-        except (SyntaxError, urlfetch.DownloadError):
-          pass
+      if layer_id not in layer_features:
+        layer_features[layer_id] = GetFeaturesFromKmlLayer(
+            map_root, map_version_id, layer, request)
+      # The caller sets distances and other fields on the returned Features,
+      # so each call gets its own copies of the shared Feature objects.
+      features += map(copy.copy, layer_features[layer_id])
   return features
 
 
+def GetFeaturesFromKmlLayer(map_root, map_version_id, layer, request):
+  """Gets a list of Feature objects for a KML-powered layer (see GetKmlUrl)."""
+  url = GetKmlUrl(request.root_url, layer or {})
+  if url:
+    try:
+      def GetXmlFeatures():
+        content = kmlify.FetchData(url, request.host)
+        return GetFeaturesFromXml(content, layer)
+      return XML_FEATURES_CACHE.Get(
+          [url, map_root['id'], map_version_id, layer.get('id')],
+          GetXmlFeatures) or []
+    except (SyntaxError, urlfetch.DownloadError):
+      pass
+  return []
+
+
 def SetDistanceOnFeatures(features, center):
   for f in features:
     f.distance = EarthDistance(center, f.location)
@@ -372,11 +404,11 @@ def FilterFeatures(features, radius, max_count):
 
 
 def GetFilteredFeatures(map_root, map_version_id, topic_id, request,
-                        center, radius, max_count):
+                        center, radius, max_count, layer_features=None):
   """Gets a list of the Feature objects for a topic within the given circle."""
   def GetFromDatastore():
     features = GetFeatures(map_root, map_version_id, topic_id, request, center,
-                           radius)
+                           radius, layer_features)
     if center:
       SetDistanceOnFeatures(features, center)
     FilterFeatures(features, radius, max_count)
@@ -425,22 +457,45 @@ def GetAnswersAndReports(map_id, topic_id, location, radius):
   for report in model.CrowdReport.GetByLocation(
       location, {full_topic_id: radius}, 100, hidden=False):
     if now - report.effective < MAX_ANSWER_AGE:
-      report_dict = {}
-      # The report's overall comment is stored under the special qid '_text'.
-      for question_id, answer in report.answers.items() + [
-          (full_topic_id + '._text', report.text)]:
-        tid, qid = question_id.rsplit('.', 1)
-        if tid == full_topic_id:
-          report_dict[qid] = answer
-          if answer or answer == 0:  # non-empty answer
-            if qid not in answer_times or report.effective > answer_times[qid]:
-              answers[qid] = answer
-              answer_times[qid] = report.effective
-      report_dicts.append(
-          dict(report_dict, _effective=report.effective, _id=report.id))
-  report_dicts.sort(key=lambda report_dict: report_dict['_effective'])
+      AddReportToAnswers(full_topic_id, report,
+                         answers, answer_times, report_dicts)
+  return answers, answer_times, GetLatestReportDicts(report_dicts)
+
+
+def AddReportToAnswers(full_topic_id, report,
+                       answers, answer_times, report_dicts):
+  """Incorporates one crowd report into a set of latest answers and reports.
+
+  Args:
+    full_topic_id: The map ID and topic ID, joined with a '.'.
+    report: A model.CrowdReport.
+    answers: A dictionary {qid: latest_answer}, updated in place.
+    answer_times: A dictionary {qid: effective_time}, updated in place.
+    report_dicts: A list of report dictionaries (see GetAnswersAndReports),
+        updated in place.  Any previous entry for the same report is replaced.
+  """
+  report_dict = {}
+  # The report's overall comment is stored under the special qid '_text'.
+  for question_id, answer in report.answers.items() + [
+      (full_topic_id + '._text', report.text)]:
+    tid, qid = question_id.rsplit('.', 1)
+    if tid == full_topic_id:
+      report_dict[qid] = answer
+      if answer or answer == 0:  # non-empty answer
+        if qid not in answer_times or report.effective > answer_times[qid]:
+          answers[qid] = answer
+          answer_times[qid] = report.effective
+  report_dicts[:] = [d for d in report_dicts if d['_id'] != report.id]
+  report_dicts.append(
+      dict(report_dict, _effective=report.effective, _id=report.id))
+
+
+def GetLatestReportDicts(report_dicts):
+  """Gets the REPORTS_PER_FEATURE most recently effective report dicts."""
+  report_dicts = sorted(report_dicts,
+                        key=lambda report_dict: report_dict['_effective'])
   report_dicts.reverse()
-  return answers, answer_times, report_dicts[:REPORTS_PER_FEATURE]
+  return report_dicts[:REPORTS_PER_FEATURE]
 
 
 def GetLegibleTextColor(background_color):
@@ -516,18 +571,24 @@ def SetAnswersAndReportsOnFeatures(features, map_root, topic_id, qids):
       return choice and choice.get('color')
 
   if topic.get('crowd_enabled') and qids:
+    # Features at the same rounded location share their answers, so look up
+    # each location once (this matters when rendering cards for many places).
+    answers_by_location = {}
     for f in features:
       # Even though we use the radius to get the latest answers, the cache key
-      # omits radius so that InvalidateReportCache can quickly delete cache
+      # omits radius so that UpdateReportCache can quickly update cache
       # entries without fetching from the datastore.  So, when a cluster radius
       # is changed and its map is republished, affected entries in the answer
       # cache will be stale until they expire.  This seems like a good tradeoff
       # because (a) changing a cluster radius in a published map is rare (less
-      # than once per map); (b) the answer cache has a short TTL (15 s); and
+      # than once per map); (b) the answer cache has a modest TTL (5 min); and
       # (c) posting crowd reports is frequent (many times per day).
-      answers, answer_times, report_dicts = REPORT_CACHE.Get(
-          [map_id, topic_id, RoundGeoPt(f.location)],
-          lambda: GetAnswersAndReports(map_id, topic_id, f.location, radius))
+      location_key = RoundGeoPt(f.location)
+      if location_key not in answers_by_location:
+        answers_by_location[location_key] = REPORT_CACHE.Get(
+            [map_id, topic_id, location_key],
+            lambda: GetAnswersAndReports(map_id, topic_id, f.location, radius))
+      answers, answer_times, report_dicts = answers_by_location[location_key]
       f.answers = answers
       f.answer_text = FormatAnswers(answers)
       if answer_times:
@@ -558,12 +619,36 @@ def _GetAgeInMinutes(dt):
   return int(seconds / 60 + 0.5)
 
 
-def InvalidateReportCache(full_topic_ids, location):
-  """Deletes cached answers affected by a new report at a given location."""
-  for full_topic_id in full_topic_ids:
+def UpdateReportCache(report):
+  """Incorporates a new or changed report into the cached answers.
+
+  Instead of deleting the cached answers at the report's location, which would
+  force the next card render to search for recent reports again, we update the
+  cached entries in place.  A report that has become hidden can't be removed
+  from the latest answers incrementally, so in that case (or if there is no
+  cached entry to update) the entries are just deleted as before.  Handlers
+  call this after a report has been written; it can wait on REPORT_CACHE's
+  update lock, so it shouldn't be called while other writes are pending.
+
+  Args:
+    report: A model.CrowdReport that was just created or changed.
+  """
+  def AddReport(full_topic_id, cached):
+    if report.hidden:
+      return None
+    if datetime.datetime.utcnow() - report.effective < MAX_ANSWER_AGE:
+      answers, answer_times, report_dicts = cached
+      AddReportToAnswers(full_topic_id, report,
+                         answers, answer_times, report_dicts)
+      cached = answers, answer_times, GetLatestReportDicts(report_dicts)
+    return cached
+
+  location_key = RoundGeoPt(report.location)
+  for full_topic_id in report.topic_ids:
     if '.' in full_topic_id:
       map_id, topic_id = full_topic_id.split('.')
-      REPORT_CACHE.Delete([map_id, topic_id, RoundGeoPt(location)])
+      REPORT_CACHE.Update([map_id, topic_id, location_key],
+                          functools.partial(AddReport, full_topic_id))
 
 
 def GetGeoJson(features, include_descriptions):
@@ -632,6 +717,11 @@ class CardBase(base_handler.BaseHandler):
     - footer: Text and links for the footer, specified as a JSON array where
           each element is either a plain text string or a two-element array
           [url, text], which is rendered as a link.
+    - batch: If true, render the card for every place in the '?places' array
+          in a single response: a JSON object mapping each place ID to the
+          FeatureCollection for that place.  The '?ll' and '?place' parameters
+          are ignored.  Layers and crowd reports are loaded only once and
+          shared among all the places.
   """
   embeddable = True
   error_template = 'card-error.html'
@@ -659,12 +749,62 @@ class CardBase(base_handler.BaseHandler):
     place_id = str(self.request.get('place', ''))
     include_descriptions = int(self.request.get('show_desc', 0))
     include_crowd_reports = int(self.request.get('show_reports', 0))
+    batch = int(self.request.get('batch', 0))
+    render_args = (map_root, map_version_id, topic, topic_id, map_label, domain,
+                   max_count, radius, unit, qids, include_descriptions,
+                   include_crowd_reports)
 
+    places = []
     try:
       places = json.loads(places_json)
     except ValueError:
       logging.error('Could not parse ?places= parameter')
 
+    if batch:
+      centers = []
+      for place in places:
+        try:
+          lat, lon = place['ll']
+          centers.append((place['id'], ndb.GeoPt(lat, lon)))
+        except (KeyError, TypeError, ValueError):
+          logging.error('Could not extract center for place %r', place)
+    else:
+      centers = [(None, self.GetCenter(lat_lon, places, place_id))]
+
+    def MakeGeoJson():
+      geojsons = self.GetGeoJsonForCenters(centers, *render_args)
+      geojson = geojsons if batch else geojsons[None]
+      return {'geojson': geojson, 'etag': base_handler.MakeEtag(
+          base_handler.ToHtmlSafeJson(geojson))}
+
+    try:
+      if include_crowd_reports:
+        # Crowd reports are updated in place as they are posted (see
+        # UpdateReportCache), so cards that show them aren't cached.
+        result = MakeGeoJson()
+      else:
+        # The key has only what affects the card: other request parameters,
+        # such as the callback (which WriteJson accounts for), are ignored.
+        cache_key = [self.request.root_url, map_version_id, topic_id,
+                     map_label, domain, unit, max_count, radius,
+                     include_descriptions, batch,
+                     [(key, center and [center.lat, center.lon])
+                      for key, center in centers]]
+        result = GEOJSON_CACHE.Get(cache_key, MakeGeoJson)
+      self.WriteJson(result['geojson'], result['etag'])
+    except Exception, e:  # pylint:disable=broad-except
+      logging.exception(e)
+
+  def GetCenter(self, lat_lon, places, place_id):
+    """Determines the center point for a single (non-batch) card.
+
+    Args:
+      lat_lon: The value of the '?ll' parameter, in lat,lon format.
+      places: The list of places given in the '?places' parameter.
+      place_id: The value of the '?place' parameter.
+    Returns:
+      An ndb.GeoPt, or None if no center could be determined.
+    """
     # If '?ll' parameter is supplied, find nearby results.
     center = None
     if lat_lon:
@@ -688,29 +828,58 @@ class CardBase(base_handler.BaseHandler):
         center = ndb.GeoPt(lat, lon)
       except (KeyError, TypeError, ValueError):
         logging.error('Could not extract center for ?place=%s', place_id)
+    return center
 
-    try:
-      # Find POIs associated with the topic layers
+  def GetGeoJsonForCenters(self, centers, map_root, map_version_id, topic,
+                           topic_id, map_label, domain, max_count, radius, unit,
+                           qids, include_descriptions, include_crowd_reports):
+    """Builds the card GeoJSON for each of several centers.
+
+    Args:
+      centers: A list of (key, center) pairs, where center is an ndb.GeoPt
+          or None.
+      map_root: The MapRoot dictionary for the map.
+      map_version_id: The version ID of the MapVersionModel (for a cache key).
+      topic: The topic dictionary from the MapRoot.
+      topic_id: The topic ID.
+      map_label: The label of the published map (for analytics).
+      domain: Owner domain of the map
+      max_count: Maximum number of items to show for each center.
+      radius: Search radius in metres.
+      unit: Distance unit to show (either 'km' or 'mi').
+      qids: A list of IDs of questions within the topic.
+      include_descriptions: If true, include descriptions of the features.
+      include_crowd_reports: If true, include recent crowd reports.
+    Returns:
+      A dictionary mapping each key in centers to a GeoJSON FeatureCollection.
+    """
+    # Find POIs associated with the topic layers, loading each layer once.
+    layer_features = {}
+    features_by_key = {}
+    html_attrs_by_key = {}
+    for key, center in centers:
       features = GetFilteredFeatures(
           map_root, map_version_id, topic_id, self.request,
-          center, radius, max_count)
-      html_attrs = GetCardLevelAttributions(features)
+          center, radius, max_count, layer_features)
+      html_attrs_by_key[key] = GetCardLevelAttributions(features)
+      features_by_key[key] = features
 
-      if include_crowd_reports:
-        SetAnswersAndReportsOnFeatures(features, map_root, topic_id, qids)
+    if include_crowd_reports:
+      SetAnswersAndReportsOnFeatures(
+          sum(features_by_key.values(), []), map_root, topic_id, qids)
 
+    geojsons = {}
+    for key, features in features_by_key.items():
       geojson = GetGeoJson(features, include_descriptions)
       geojson['properties'] = {
           'map_id': map_root.get('id'),
           'topic': topic,
-          'html_attrs': html_attrs,
+          'html_attrs': html_attrs_by_key[key],
           'map_url': self.GetMapUrl(topic, map_label, domain, features),
           'unit': unit
       }
-      self.WriteJson(geojson)
-
-    except Exception, e:  # pylint:disable=broad-except
-      logging.exception(e)
+      geojsons[key] = geojson
+    return geojsons
 
   def GetDistanceUnitForCountry(self):
     unit = self.request.get('unit', '')
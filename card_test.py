@@ -14,6 +14,7 @@
 
 import datetime
 import json
+import urllib
 
 import card
 import config
@@ -569,6 +570,31 @@ class CardTest(test_utils.BaseTest):
            '_text': 'goodbye'}]),
         card.GetAnswersAndReports('m1', 't1', 'location', 100))
 
+  def testUpdateReportCache(self):
+    now = datetime.datetime.utcnow()
+    earlier = now - datetime.timedelta(seconds=1)
+    location = ndb.GeoPt(1, 2)
+    key = ['m1', 't1', card.RoundGeoPt(location)]
+    card.REPORT_CACHE.Set(key, ({'q1': 'a1'}, {'q1': earlier},
+                                [{'_id': 'r1', '_effective': earlier,
+                                  'q1': 'a1', '_text': ''}]))
+
+    # A new report should be merged into the cached answers.
+    card.UpdateReportCache(model.CrowdReport(
+        answers_json='{"m1.t1.q1": "a2"}', id='r2', text='hi', effective=now,
+        topic_ids=['m1.t1'], location=location, hidden=False))
+    self.assertEquals(
+        ({'q1': 'a2', '_text': 'hi'}, {'q1': now, '_text': now},
+         [{'_id': 'r2', '_effective': now, 'q1': 'a2', '_text': 'hi'},
+          {'_id': 'r1', '_effective': earlier, 'q1': 'a1', '_text': ''}]),
+        card.REPORT_CACHE.Get(key))
+
+    # A hidden report can't be removed incrementally, so the entry is dropped.
+    card.UpdateReportCache(model.CrowdReport(
+        answers_json='{"m1.t1.q1": "a2"}', id='r2', text='hi', effective=now,
+        topic_ids=['m1.t1'], location=location, hidden=True))
+    self.assertEquals(None, card.REPORT_CACHE.Get(key))
+
   def testGetLegibleTextColor(self):
     # Black on a light background; white on a dark background
     self.assertEquals('#000', card.GetLegibleTextColor('#999'))
@@ -721,6 +747,15 @@ class CardHandlerTest(test_utils.BaseTest):
     geojson = self._GetGeoJson('/xyz.com/.card/foo/t2?qids=q1&show_reports=1')
     self.assertEquals(1, len(geojson['features'][0]['properties']['reports']))
 
+    # A new report appears at once, though the card was just rendered.
+    card.UpdateReportCache(model.CrowdReport(
+        answers_json='{"m1.t2.q1": "a2"}', id='r2', text='', effective=now,
+        topic_ids=['m1.t2'], location=ndb.GeoPt(60, 25), hidden=False))
+    geojson = self._GetGeoJson('/xyz.com/.card/foo/t2?qids=q1&show_reports=1')
+    helsinki, = [feature for feature in geojson['features']
+                 if feature['properties']['name'] == 'Helsinki']
+    self.assertEquals(2, len(helsinki['properties']['reports']))
+
     # Verify there are no reports with show_reports missing from the request
     geojson = self._GetGeoJson('/xyz.com/.card/foo/t2?qids=q1')
     self.assertEquals(0, len(geojson['features'][0]['properties']['reports']))
@@ -771,6 +806,49 @@ class CardHandlerTest(test_utils.BaseTest):
     self.assertTrue(self._FeatureInResponse(geojson, 'Helsinki'))
     self.assertFalse(self._FeatureInResponse(geojson, 'Columbus'))
 
+  def testGetCardBatch(self):
+    fetched_urls = []
+    def FetchData(url, unused_host):
+      fetched_urls.append(url)
+      return KML_DATA
+    self.SetForTest(kmlify, 'FetchData', FetchData)
+    places = [{'id': 'hel', 'name': 'Helsinki', 'll': [60, 25]},
+              {'id': 'col', 'name': 'Columbus', 'll': [40, -83]}]
+    geojson = self._GetGeoJson(
+        '/xyz.com/.card/foo/t2?n=1&r=100&batch=1&places=' +
+        urllib.quote(json.dumps(places)))
+    self.assertEquals(['col', 'hel'], sorted(geojson))
+    self.assertEquals('Topic 2', geojson['hel']['properties']['topic']['title'])
+    self.assertEquals(['Helsinki'], [f['properties']['name']
+                                     for f in geojson['hel']['features']])
+    self.assertEquals(['Columbus'], [f['properties']['name']
+                                     for f in geojson['col']['features']])
+    # The layer should have been fetched only once for both places.
+    self.assertEquals(['http://example.com/two.kml'], fetched_urls)
+
+  def testGetCardNotModified(self):
+    self.SetForTest(kmlify, 'FetchData', lambda url, host: KML_DATA)
+    response = self.DoGet('/xyz.com/.card/foo/t2')
+    etag = response.headers['ETag']
+
+    # A client that already has the card should get a 304 with no body.
+    response = self.DoGet('/xyz.com/.card/foo/t2', status=304,
+                          headers={'If-None-Match': etag})
+    self.assertEquals('', response.body)
+
+    # Parameters that don't affect the card get the same cached card.
+    get_geojson_for_centers = card.CardBase.GetGeoJsonForCenters
+    self.SetForTest(card.CardBase, 'GetGeoJsonForCenters', None)
+    self.DoGet('/xyz.com/.card/foo/t2?utm_source=x', status=304,
+               headers={'If-None-Match': etag})
+    self.SetForTest(card.CardBase, 'GetGeoJsonForCenters',
+                    get_geojson_for_centers)
+
+    # Different parameters give a different card.
+    response = self.DoGet('/xyz.com/.card/foo/t2?n=1', status=200,
+                          headers={'If-None-Match': etag})
+    self.assertNotEqual(etag, response.headers['ETag'])
+
   def testGetCardByTopic(self):
     response = self.DoGet('/xyz.com/.card/foo')
     self.assertEquals('foo/t1', response.headers['Location'])
@@ -27,7 +27,16 @@ from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 
 CACHE_TTL_SECONDS = 60
-CACHE = cache.Cache('jsonp', CACHE_TTL_SECONDS)
+# Each value is a pair (data, data_etag), where data_etag is our own ETag for
+# the fetched content, computed once when it is fetched.
+CACHE = cache.Cache('jsonp.data', CACHE_TTL_SECONDS)
+# The last response for each URL that came with validators (an ETag or a
+# Last-Modified time), so that when CACHE expires we can make a conditional
+# request and reuse the parsed JSON if it hasn't changed.  Each value is a
+# dictionary with keys 'etag', 'last_modified', 'data', and 'data_etag'.
+REVALIDATION_TTL_SECONDS = 3600
+REVALIDATION_CACHE = cache.Cache(
+    'jsonp.validators', REVALIDATION_TTL_SECONDS, lock_timeout=0)
 QPM_CACHE = cache.Cache('jsonp.qpm', 0)  # used only for making cache keys
 MAX_OUTBOUND_QPM_PER_IP = 30  # maximum outbound HTTP fetches/min per client IP
 HTTP_TOO_MANY_REQUESTS = 429  # this HTTP status code is not defined in httplib
@@ -93,7 +102,8 @@ def FetchJson(url, post_json, use_cache, client_ip, referrer=None):
     referrer: An optional string, the "Referer:" header to use in the request.
 
   Returns:
-    A dictionary or list parsed from the fetched JSON.
+    A pair (data, data_etag), where data is the dictionary or list parsed from
+    the fetched JSON and data_etag is an ETag for the fetched content.
 
   Raises:
     base_handler.Error: The request failed or exceeded the rate limit.
@@ -101,18 +111,34 @@ def FetchJson(url, post_json, use_cache, client_ip, referrer=None):
   url = SanitizeUrl(url)
 
   def Fetch():
-    """Fetch the URL and return the parsed JSON."""
+    """Fetch the URL and return the parsed JSON and its ETag."""
     AssertRateLimitNotExceeded(client_ip)
     method = post_json and 'POST' or 'GET'
     headers = post_json and {'Content-Type': 'application/json'} or {}
     if referrer:
       headers['Referer'] = referrer
+    previous = not post_json and REVALIDATION_CACHE.Get(url)
+    if previous and previous['etag']:
+      headers['If-None-Match'] = previous['etag']
+    if previous and previous['last_modified']:
+      headers['If-Modified-Since'] = previous['last_modified']
     result = urlfetch.fetch(url, post_json, method, headers)
+    if previous and result.status_code == httplib.NOT_MODIFIED:
+      logging.info('Request for url=%r: not modified', url)
+      REVALIDATION_CACHE.Set(url, previous)
+      return previous['data'], previous['data_etag']
     if result.status_code != httplib.OK:
       logging.warn('Request for url=%r post_json=%r returned status %r: %r',
                    url, post_json, result.status_code, result.content)
       raise base_handler.Error(result.status_code, 'Request failed.')
-    return ParseJson(result.content)
+    data = ParseJson(result.content)
+    data_etag = base_handler.MakeEtag(result.content)
+    etag = result.headers.get('ETag')
+    last_modified = result.headers.get('Last-Modified')
+    if not post_json and (etag or last_modified):
+      REVALIDATION_CACHE.Set(url, {'etag': etag, 'last_modified': last_modified,
+                                   'data': data, 'data_etag': data_etag})
+    return data, data_etag
 
   return CACHE.Get(url, Fetch) if use_cache and not post_json else Fetch()
 
@@ -188,8 +214,9 @@ class Jsonp(base_handler.BaseHandler):
     post_json = self.request.get('post_json', '')
     use_cache = not self.request.get('no_cache')
     hl = self.request.get('hl', '')
-    data = FetchJson(url, post_json, use_cache, self.request.remote_addr,
-                     self.request.headers.get('Referer'))
+    data, etag = FetchJson(url, post_json, use_cache, self.request.remote_addr,
+                           self.request.headers.get('Referer'))
     if hl:
       LocalizeMapRoot(data, hl)
-    self.WriteJson(data)
+      etag = base_handler.MakeEtag(etag + hl)
+    self.WriteJson(data, etag)
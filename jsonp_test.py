@@ -21,6 +21,8 @@ import base_handler
 import jsonp
 import test_utils
 
+from google.appengine.api import urlfetch
+
 
 class JsonpTest(test_utils.BaseTest):
   def AssertRaisesErrorWithStatus(self, expected_status, callable_obj, *args):
@@ -54,6 +56,35 @@ class JsonpTest(test_utils.BaseTest):
     self.AssertRaisesErrorWithStatus(
         httplib.FORBIDDEN, jsonp.ParseJson, 'foo(3')
 
+  def testFetchJsonRevalidates(self):
+    request_headers = []
+
+    class Response(object):
+      def __init__(self, status_code, content='', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def Fetch(unused_url, unused_payload, unused_method, headers):
+      request_headers.append(headers)
+      if headers.get('If-None-Match') == '"v1"':
+        return Response(httplib.NOT_MODIFIED)
+      return Response(httplib.OK, '{"a": 1}', {'ETag': '"v1"'})
+    self.SetForTest(urlfetch, 'fetch', Fetch)
+
+    self.SetTime(1000)
+    data, etag = jsonp.FetchJson(
+        'http://example.com/x.json', None, True, '1.2.3.4')
+    self.assertEquals({'a': 1}, data)
+    self.assertEquals([{}], request_headers)
+
+    # When the cached copy expires, a conditional request is made, and the
+    # previously parsed JSON is returned if the server says it's unchanged.
+    self.SetTime(1000 + jsonp.CACHE_TTL_SECONDS + 1)
+    self.assertEquals(({'a': 1}, etag), jsonp.FetchJson(
+        'http://example.com/x.json', None, True, '1.2.3.4'))
+    self.assertEquals({'If-None-Match': '"v1"'}, request_headers[1])
+
   def testLocalizeMapRoot(self):
     """Confirms that LocalizedMapRoot performs the correct transformations."""
     input_map_root = {
@@ -107,7 +138,8 @@ class JsonpTest(test_utils.BaseTest):
   def testXssPreventionMeasures(self):
     # This test is concerned with response headers and formatting, so stub out
     # the main FetchJson method to always return a dummy value
-    self.SetForTest(jsonp, 'FetchJson', lambda *args, **kwargs: '{}')
+    self.SetForTest(jsonp, 'FetchJson',
+                    lambda *args, **kwargs: ('{}', '"etag"'))
 
     # When callers request a callback, the result should be a JS expression
     # prefixed with a JS comment and newline.
@@ -121,6 +153,28 @@ class JsonpTest(test_utils.BaseTest):
     self.assertEqual('application/json; charset=utf-8',
                      response.headers.get('Content-Type'))
 
+  def testNotModified(self):
+    self.SetForTest(jsonp, 'FetchJson',
+                    lambda *args, **kwargs: ({'a': 1}, '"v1"'))
+    etag = self.DoGet('/.jsonp?url=ignored').headers['ETag']
+
+    # A client that already has the content should get a 304 with no body.
+    response = self.DoGet('/.jsonp?url=ignored', status=304,
+                          headers={'If-None-Match': etag})
+    self.assertEquals('', response.body)
+
+    # The ETag should cover the callback and the language.
+    for query in ['&callback=f', '&hl=fr']:
+      response = self.DoGet('/.jsonp?url=ignored' + query, status=200,
+                            headers={'If-None-Match': etag})
+      self.assertNotEqual(etag, response.headers['ETag'])
+      self.assertTrue(response.body)
+
+    # A wildcard doesn't count as a match.
+    response = self.DoGet('/.jsonp?url=ignored', status=200,
+                          headers={'If-None-Match': '*'})
+    self.assertTrue(response.body)
+
 
 if __name__ == '__main__':
   test_utils.main()
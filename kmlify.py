@@ -20,39 +20,103 @@ import base_handler
 import StringIO
 import collections
 import csv
+import hashlib
+import itertools
 import json
 import logging
+import math
+import operator
 import re
 import string
+import struct
+import time
 import urllib
 import xml_utils
 import zipfile
+import zlib
 
+import blob_store
 import cache
 
 from google.appengine.api import urlfetch
 
 KMZ_CONTENT_TYPE = 'application/vnd.google-earth.kmz'
 KML_CONTENT_TYPE = 'application/vnd.google-earth.kml+xml'
-KML_DOCUMENT_TEMPLATE = """\
+GEOJSON_CONTENT_TYPE = 'application/vnd.geo+json'
+GEOJSON_GEOMETRY_TYPES = [
+    'Point', 'LineString', 'Polygon', 'MultiPoint', 'MultiLineString',
+    'MultiPolygon', 'GeometryCollection']
+KML_HEADER = """\
 <?xml version="1.0" encoding="UTF-8"?>
 <kml xmlns="http://www.opengis.net/kml/2.2">
-%s
+"""
+KML_FOOTER = """
 </kml>
 """
 DEFAULT_ICON_URL = 'http://mw1.google.com/crisisresponse/icons/red_dot.png'
 ICON_FILES = {'small': 'pin16.png', 'medium': 'pin24.png', 'large': 'pin32.png'}
 OPERATORS = {
-    '=': lambda x, y: x == y,
-    '==': lambda x, y: x == y,
-    '!=': lambda x, y: x != y,
-    '<': lambda x, y: x < y,
-    '<=': lambda x, y: x <= y,
-    '>': lambda x, y: x > y,
-    '>=': lambda x, y: x >= y,
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
 }
+# Source data and conversions are checked against the remote server this often.
 CACHE_TTL_SECONDS = 60
-CACHE = cache.Cache('kmlify', CACHE_TTL_SECONDS)
+# Source data and conversions are kept this long, so that when they are found
+# to be unchanged (or the remote server fails), they can be used again.
+SOURCE_TTL_SECONDS = 600
+# Conversion results, keyed by the request parameters.  Each value is a
+# dictionary with keys 'content' (the KMZ or GeoJSON data), 'etag' (a strong
+# ETag for it), 'hashes' (the content hashes of the source data it was made
+# from), and 'check_time' (when the source data was last checked for changes).
+# Large results are kept in the blob store, with only a pointer in memcache.
+CACHE = cache.Cache('kmlify.kmz', SOURCE_TTL_SECONDS,
+                    blob_store=blob_store.STORE)
+# Fetched source data, keyed by URL.  See FetchSource for the value format.
+# The rate of fetching is limited by the 'fetch_time' in each entry, so no
+# lock is needed.
+SOURCE_CACHE = cache.Cache('kmlify.source', SOURCE_TTL_SECONDS, lock_timeout=0)
+# All the parsed records, keyed by source URL, content hash, and the parsing
+# options.  These are shared by all requests that read the same source data,
+# regardless of their conditions, skip, and limit; CSV records have only the
+# fields that the request uses, so they are shared only by requests that use
+# the same fields (see GetRecords).
+# Each value is a dictionary with keys 'records' (a list of packed records)
+# and 'index' (a GridIndex of their bounds).  These values can hold tens of
+# thousands of records, so the local cache doesn't copy them, and they must
+# never be modified (see UnpackRecord); the same goes for CLUSTERS_CACHE and
+# JOIN_CACHE.
+RECORDS_CACHE = cache.Cache('kmlify.records', SOURCE_TTL_SECONDS,
+                            lock_timeout=0, blob_store=blob_store.STORE,
+                            immutable_values=True)
+# The clusters of the records at each zoom level (see MakeClusters), keyed
+# by the RECORDS_CACHE key.  These are made by the first clustered request,
+# so the records entry is never written again just to add them.
+CLUSTERS_CACHE = cache.Cache('kmlify.clusters', SOURCE_TTL_SECONDS,
+                             lock_timeout=0, blob_store=blob_store.STORE,
+                             immutable_values=True)
+# Join tables, keyed by join source URL, content hash, join field, and the
+# fields to keep.  Each value is a dictionary that maps each value of the join
+# field to the record for the last row with that value.
+JOIN_CACHE = cache.Cache('kmlify.join', SOURCE_TTL_SECONDS,
+                         lock_timeout=0, blob_store=blob_store.STORE,
+                         immutable_values=True)
+ELEMENT_KEYS = ['__element__', '__geometry__', '__style__']
+KML_GEOMETRY_TAGS = set(['Point', 'LineString', 'Polygon', 'MultiGeometry'])
+FORMATS = ['kmz', 'geojson']
+# The spatial index divides the extent of the records into a grid of cells,
+# with this many cells along each side.
+GRID_SIZE = 64
+# Web Mercator maps cannot show latitudes beyond this.
+MAX_LATITUDE = 85.0511287798
+# With cluster=1, points are grouped into clusters on a grid of square cells
+# this many pixels on a side, at zoom levels up to MAX_CLUSTER_ZOOM.
+CLUSTER_CELL_PIXELS = 64
+MAX_CLUSTER_ZOOM = 16
 
 
 def Stringify(text, html=False):
@@ -86,6 +150,54 @@ def UrlQuote(text):
   return urllib.quote(Stringify(text))
 
 
+def GetDescriptionValue(record, name):
+  """Gets the value to substitute for a placeholder in a description template.
+
+  Args:
+    record: A record, as a dictionary.
+    name: The placeholder name: 'foo' for the HTML-escaped value of field
+        'foo', '_foo' for its raw value, or '__foo' for its URL-quoted value.
+  Returns:
+    The value, escaped or quoted as requested, or '' if the field is missing.
+  """
+  if name.startswith('__') and name[2:] in record:
+    return UrlQuote(record[name[2:]])
+  if name.startswith('_') and name[1:] in record:
+    return record[name[1:]]
+  if name in record:
+    return HtmlEscape(record[name])
+  return ''
+
+
+def ElementKey(element):
+  """Makes a hashable key that is equal for elements that serialize equally.
+
+  Text and tails that are only whitespace are ignored, as they are replaced
+  by indentation when the element is serialized.
+
+  Args:
+    element: An Element.
+  Returns:
+    A tuple of the element's tag, attributes, text, children, and tail.
+  """
+  return (element.tag, tuple(sorted(element.items())),
+          (element.text or '').strip() and element.text,
+          tuple(ElementKey(child) for child in element),
+          (element.tail or '').strip() and element.tail)
+
+
+def LogXmlSyntaxError(xml, e):
+  """Logs a SyntaxError from parsing XML, showing where the error occurred."""
+  logging.error('syntax error in XML input (%s)', e)
+  logging.info('beginning of input: %r', xml[:200])
+  match = re.search(r'line (\d+), column (\d+)', e.message)
+  if match:
+    lineno, column = int(match.group(1)), int(match.group(2))
+    offset = len('\n'.join(xml.split('\n')[:lineno - 1])) + 1 + column - 1
+    logging.info('before the error: %r', xml[:offset][-100:])
+    logging.info('after the error: %r', xml[offset:][:100])
+
+
 def ParseXml(xml):
   """Tries to parse some XML, logging informative errors if parsing fails."""
   xml = xml.replace('\r', '\n')  # simplify line numbering of SyntaxErrors
@@ -95,14 +207,46 @@ def ParseXml(xml):
     try:  # in case there's no root element, try adding one
       return xml_utils.Parse('<_>' + xml + '</_>')
     except SyntaxError:  # report the original error in a more informative way
-      logging.error('syntax error in XML input (%s)', e)
-      logging.info('beginning of input: %r', xml[:200])
-      match = re.search(r'line (\d+), column (\d+)', e.message)
-      if match:
-        lineno, column = int(match.group(1)), int(match.group(2))
-        offset = len('\n'.join(xml.split('\n')[:lineno - 1])) + 1 + column - 1
-        logging.info('before the error: %r', xml[:offset][-100:])
-        logging.info('after the error: %r', xml[offset:][:100])
+      LogXmlSyntaxError(xml, e)
+      raise e
+
+
+def IterParseXml(xml, events=('end',)):
+  """Parses XML incrementally, yielding (event, element) pairs.
+
+  Like ParseXml, this tries adding a root element if parsing fails, and logs
+  informative errors if that doesn't help.  In that case, the events for the
+  part of the document that was read before the failure are not repeated.
+
+  Args:
+    xml: A string of XML.
+    events: The kinds of events to yield, as for ElementTree.iterparse.
+  Yields:
+    (event, element) pairs.  Namespaces are removed from the element tags.
+  """
+  def StripNamespaces(pairs):
+    for event, element in pairs:
+      if element.tag[:1] == '{':
+        element.tag = element.tag.split('}')[-1]
+      yield event, element
+
+  xml = xml.replace('\r', '\n')  # simplify line numbering of SyntaxErrors
+  count = 0
+  try:
+    for pair in StripNamespaces(
+        xml_utils.IterParse(StringIO.StringIO(xml), events)):
+      count += 1
+      yield pair
+  except SyntaxError, e:
+    # In case there's no root element, try adding one.  We skip the events we
+    # have already yielded, plus the start event for the added root element.
+    count += 'start' in events
+    try:
+      for pair in StripNamespaces(itertools.islice(xml_utils.IterParse(
+          StringIO.StringIO('<_>' + xml + '</_>'), events), count, None)):
+        yield pair
+    except SyntaxError:  # report the original error in a more informative way
+      LogXmlSyntaxError(xml, e)
       raise e
 
 
@@ -131,30 +275,159 @@ def UnzipData(data, preferred_filename_regex='.*'):
   return ''  # zip archive contains no entries, return ''
 
 
-def MakeKmz(kml):
-  """Packs a KML document into a KMZ file."""
-  output_buffer = StringIO.StringIO()
-  archive = zipfile.ZipFile(output_buffer, 'w')
-  info = zipfile.ZipInfo('doc.kml')
-  info.external_attr = 0644 << 16L  # Unix permission bits
-  info.compress_type = zipfile.ZIP_DEFLATED
-  archive.writestr(info, kml)
-  archive.close()
-  return output_buffer.getvalue()
+class KmzWriter(object):
+  """A file-like object that packs the KML written to it into a KMZ file.
 
+  The KML is compressed as it arrives, so only the compressed data is held in
+  memory.  The KMZ file contains a single entry, 'doc.kml'.
+  """
+  FILENAME = 'doc.kml'
+  # The ZIP structures are laid out as in zipfile.py, with version 2.0 of the
+  # format, a Unix creator, and the default ZipInfo date of 1980-01-01 00:00.
+  VERSION, SYSTEM, DOS_TIME, DOS_DATE = 20, 3, 0, 0x21
+
+  def __init__(self):
+    self.buffer = StringIO.StringIO()
+    self.buffer.write(self.MakeLocalHeader(0, 0, 0))  # rewritten by Close()
+    self.compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)  # raw deflate stream
+    self.crc = 0
+    self.size = 0
+
+  def MakeLocalHeader(self, crc, compressed_size, size):
+    return struct.pack(
+        zipfile.structFileHeader, zipfile.stringFileHeader, self.VERSION, 0,
+        0, zipfile.ZIP_DEFLATED, self.DOS_TIME, self.DOS_DATE,
+        crc, compressed_size, size, len(self.FILENAME), 0) + self.FILENAME
+
+  def write(self, data):  # pylint: disable=invalid-name
+    """Compresses a string of KML and appends it to the KMZ entry."""
+    self.crc = zlib.crc32(data, self.crc)
+    self.size += len(data)
+    self.buffer.write(self.compressor.compress(data))
+
+  def Close(self):
+    """Finishes the KMZ file and returns its contents, as a string."""
+    self.buffer.write(self.compressor.flush())
+    central_offset = self.buffer.tell()
+    compressed_size = central_offset - len(self.MakeLocalHeader(0, 0, 0))
+    crc = self.crc & 0xffffffff
+    self.buffer.write(struct.pack(
+        zipfile.structCentralDir, zipfile.stringCentralDir, self.VERSION,
+        self.SYSTEM, self.VERSION, 0, 0, zipfile.ZIP_DEFLATED, self.DOS_TIME,
+        self.DOS_DATE, crc, compressed_size, self.size, len(self.FILENAME),
+        0, 0, 0, 0, 0644 << 16L, 0) + self.FILENAME)  # Unix permission bits
+    central_size = self.buffer.tell() - central_offset
+    self.buffer.write(struct.pack(
+        zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0, 1, 1,
+        central_size, central_offset, 0))
+    self.buffer.seek(0)
+    self.buffer.write(self.MakeLocalHeader(crc, compressed_size, self.size))
+    return self.buffer.getvalue()
+
+
+def WriteKml(out, elements):
+  """Writes a KML document to a file-like object.
+
+  The elements are serialized and written one at a time as they are drawn
+  from the given iterable, so they never need to be held in memory at once.
 
-def Compare(op, lhs, rhs):
-  """Applies a comparison operator, converting the type of rhs as needed."""
-  try:
-    # In general, we do the comparison according to the type of the right side
-    # (string or float).  However, we don't convert None; that way if an XML
-    # element is missing, it is considered less than all strings and floats,
-    # Thus, comparing to '' is a way to test for existence of an XML element.
-    if lhs is not None:
-      lhs = type(rhs)(lhs)
-  except (TypeError, ValueError):  # return False when conversion fails
-    return False
-  return op(lhs, rhs)
+  Args:
+    out: A file-like object with a write() method.
+    elements: An iterable of the Elements to put in the KML <Document>.
+  """
+  out.write(KML_HEADER)
+  serializer = xml_utils.Serializer()
+  empty = True
+  for element in elements:
+    out.write((empty and '<Document>' or '') + '\n  ')
+    serializer.Write(out, element, indent_level=1)
+    empty = False
+  out.write(empty and '<Document />' or '\n</Document>')
+  out.write(KML_FOOTER)
+
+
+def WriteGeoJson(out, features, name=None):
+  """Writes a GeoJSON FeatureCollection to a file-like object.
+
+  The features are serialized and written one at a time as they are drawn
+  from the given iterable, so they never need to be held in memory at once.
+
+  Args:
+    out: A file-like object with a write() method.
+    features: An iterable of GeoJSON Feature objects.
+    name: Optional.  A name for the collection.
+  """
+  out.write('{"type": "FeatureCollection", ')
+  if name:
+    out.write('"name": %s, ' % json.dumps(name))
+  out.write('"features": [')
+  separator = '\n'
+  for feature in features:
+    out.write(separator + json.dumps(feature, sort_keys=True))
+    separator = ',\n'
+  out.write('\n]}\n')
+
+
+def MakePredicate(conditions):
+  """Compiles a list of conditions into a single predicate function.
+
+  Each field value is converted to the type of the value it's compared with
+  (string or float); a condition is false if the conversion fails.  However,
+  None is not converted; that way if an XML element is missing, it is
+  considered less than all strings and floats.  Thus, comparing to '' is a
+  way to test for existence of an XML element.
+
+  The conditions are grouped by field, so that each field's value is looked up
+  and converted at most once per record.  Fields with equality tests are
+  checked first, as they are usually the most selective, and string
+  comparisons run before numeric ones, which need a conversion.  Evaluation
+  stops at the first condition that fails.
+
+  Args:
+    conditions: A list of (field, opsym, value) tuples, where opsym is a key
+        in OPERATORS and value is a string or a float.
+  Returns:
+    A function that takes a record and returns True if it meets all the
+    conditions.
+  """
+  is_not_equality = lambda (op, value): op is not operator.eq
+
+  # Each test is a (field, string_checks, number_checks) triple, where the
+  # checks are lists of (op, value) pairs.
+  tests = collections.OrderedDict()
+  for field, opsym, value in conditions:
+    string_checks, number_checks = tests.setdefault(field, ([], []))
+    checks = number_checks if isinstance(value, float) else string_checks
+    checks.append((OPERATORS[opsym], value))
+  tests = [(field, sorted(string_checks, key=is_not_equality),
+            sorted(number_checks, key=is_not_equality))
+           for field, (string_checks, number_checks) in tests.items()]
+  tests.sort(key=lambda (field, string_checks, number_checks): (
+      all(map(is_not_equality, string_checks + number_checks)),
+      bool(number_checks)))
+
+  def Predicate(record):
+    for field, string_checks, number_checks in tests:
+      lhs = record.get(field)
+      if string_checks:
+        try:
+          text = lhs if lhs is None else str(lhs)
+        except (TypeError, ValueError):
+          return False
+        for op, rhs in string_checks:
+          if not op(text, rhs):
+            return False
+      if number_checks:
+        try:
+          number = lhs if lhs is None else float(lhs)
+        except (TypeError, ValueError):
+          return False
+        for op, rhs in number_checks:
+          if not op(number, rhs):
+            return False
+    return True
+  return Predicate
 
 
 def NormalizeFieldName(name):
@@ -162,10 +435,6 @@ def NormalizeFieldName(name):
   return '_'.join(re.sub(r'[^/\w.@#]', ' ', name).split())
 
 
-def NormalizeRecord(record):
-  return {NormalizeFieldName(key): record[key].strip() for key in record}
-
-
 def Decode(s, encoding):
   try:
     return s.decode(encoding)
@@ -173,9 +442,29 @@ def Decode(s, encoding):
     return s.decode('latin-1')
 
 
-def DecodeRecord(record, encoding):
-  return {Decode(key, encoding): Decode(value, encoding)
-          for key, value in record.items()}
+def MakeDecoder(encoding):
+  """Makes a function to decode strings, falling back lazily to Latin-1.
+
+  Strings are decoded directly until one turns out not to be in the expected
+  encoding; from then on, every string goes through Decode().  This keeps the
+  usual case of correctly encoded data to one decode() call per string,
+  without decoding the whole source up front just to check its encoding.
+
+  Args:
+    encoding: The expected string encoding, e.g. 'utf-8'.
+  Returns:
+    A function that decodes a string, falling back to Latin-1 for strings
+    that aren't in the expected encoding.
+  """
+  decoders = [lambda s: s.decode(encoding)]
+
+  def DecodeString(s):
+    try:
+      return decoders[0](s)
+    except UnicodeDecodeError:
+      decoders[0] = lambda s: Decode(s, encoding)
+      return decoders[0](s)
+  return DecodeString
 
 
 def GetText(element):
@@ -183,13 +472,212 @@ def GetText(element):
       GetText(child) + (child.tail or '') for child in element.getchildren())
 
 
-def FetchData(url, referer=None):
+def MakeFieldTable(fields):
+  """Makes a table of the fields that each XML tag can provide.
+
+  See Kmlifier.RecordsFromXml for how fields are named.  A class, id, or name
+  can contain '.', '#', or '@', so each field is entered under every way it
+  could be split into a tag and an attribute, class, or ID.
+
+  Args:
+    fields: An iterable of field names.
+  Returns:
+    A dictionary that maps each tag to a (text_field, attr_fields,
+    class_fields, id_fields) tuple.  text_field is the field that gets the
+    element's text, or None; the others are dictionaries that map an
+    attribute name, a class, or an id or name to a field.
+  """
+  table = {}
+  for field in fields:
+    table.setdefault(field, [None, {}, {}, {}])[0] = field
+    for i, char in enumerate(field):
+      if char in '@.#':
+        entry = table.setdefault(field[:i], [None, {}, {}, {}])
+        entry['_@.#'.index(char)][field[i + 1:]] = field
+  return table
+
+
+def ExtractFields(element, entry, record):
+  """Copies field values from an element into a record.
+
+  Args:
+    element: An XML element.
+    entry: The entry for the element's tag from a MakeFieldTable table.
+    record: The record dictionary to update.
+  """
+  text_field, attr_fields, class_fields, id_fields = entry
+  text = None
+  if text_field or class_fields or id_fields:
+    text = GetText(element)
+  if text_field:
+    record[text_field] = text
+  for attr, field in attr_fields.iteritems():
+    value = element.get(attr)
+    if value is not None:
+      record[field] = value
+  if class_fields:
+    field = class_fields.get(element.get('class', '').strip())
+    if field:
+      record[field] = text
+  if id_fields:
+    for attr in ['id', 'name']:
+      field = id_fields.get(element.get(attr, '').strip())
+      if field:
+        record[field] = text
+
+
+def ExtractRecord(element, table):
+  """Extracts the fields, geometry, and inline style of an XML record.
+
+  Args:
+    element: The XML element for the record.
+    table: A table of the fields to extract, from MakeFieldTable.
+  Returns:
+    The record, as a dictionary.
+  """
+  # Scan all elements within the record, pulling out their values only if
+  # they are listed in the table.
+  record = {}
+  for child in element.getiterator():
+    entry = table.get(child.tag)
+    if entry:
+      ExtractFields(child, entry, record)
+    if (child.tag in KML_GEOMETRY_TAGS and
+        child.find('.//coordinates') is not None):
+      record['__geometry__'] = child  # preserve KML geometry
+  style = element.find('.//Style')
+  if style is not None:
+    record['__style__'] = style  # preserve KML style
+  return record
+
+
+def PackRecord(record):
+  """Converts the Elements in a record to tuples, so it can be cached."""
+  for key in ELEMENT_KEYS:
+    if record.get(key) is not None:
+      record[key] = xml_utils.ToTuple(record[key])
+  return record
+
+
+def UnpackRecord(record):
+  """Copies a record produced by PackRecord, with its tuples as Elements."""
+  record = dict(record)
+  for key in ELEMENT_KEYS:
+    if record.get(key) is not None:
+      record[key] = xml_utils.FromTuple(record[key])
+  return record
+
+
+def FetchSource(url, referer=None):
+  """Fetches data from a URL, revalidating any previously fetched copy.
+
+  A copy fetched within the last CACHE_TTL_SECONDS is used without contacting
+  the remote server.  An older copy is revalidated with a conditional request
+  using its ETag and Last-Modified validators; if the server reports that the
+  data hasn't changed, or fails to respond, the old copy is used again.
+
+  Args:
+    url: The URL to fetch.
+    referer: An optional value for the Referer header.
+  Returns:
+    A dictionary with keys 'url', 'data' (the content, unzipped if it was a
+    zip file), 'hash' (the MD5 hex digest of the data), 'etag' and
+    'last_modified' (the validators sent by the server, or None), and
+    'fetch_time' (when the data was last fetched or revalidated).
+  Raises:
+    urlfetch.Error: The data could not be fetched, and there was no copy.
+  """
+  return StartFetchSource(url, referer)()
+
+
+def StartFetchSource(url, referer=None):
+  """Starts fetching data from a URL asynchronously, as FetchSource does.
+
+  Args:
+    url: The URL to fetch.
+    referer: An optional value for the Referer header.
+  Returns:
+    A function that waits for the fetch to finish and returns the source, as
+    FetchSource does.
+  """
+  source = SOURCE_CACHE.Get(url)
+  if source and time.time() < source['fetch_time'] + CACHE_TTL_SECONDS:
+    return lambda: source
+
   headers = referer and {'Referer': referer} or {}
+  if source and source['etag']:
+    headers['If-None-Match'] = source['etag']
+  if source and source['last_modified']:
+    headers['If-Modified-Since'] = source['last_modified']
   logging.info('fetching %s', url)
-  data = urlfetch.fetch(
-      url, headers=headers, validate_certificate=False, deadline=10).content
-  logging.info('retrieved %d bytes', len(data))
-  return UnzipData(data, r'.*\.[kx]ml')
+  rpc = urlfetch.create_rpc(deadline=10)
+  try:
+    urlfetch.make_fetch_call(
+        rpc, url, headers=headers, validate_certificate=False)
+  except urlfetch.Error, e:  # e.g. InvalidURLError is raised immediately
+    error = e
+    def RaiseError():
+      raise error
+    return lambda: UpdateSourceFromFetch(url, source, RaiseError)
+  return lambda: UpdateSourceFromFetch(url, source, rpc.get_result)
+
+
+def UpdateSourceFromFetch(url, source, get_response):
+  """Produces the new source for a URL from the outcome of a fetch.
+
+  Args:
+    url: The URL that was fetched.
+    source: The previously fetched source, as returned by FetchSource, or None.
+    get_response: A function that returns the urlfetch Response for the
+        fetch, or raises a urlfetch.Error if the fetch failed.
+  Returns:
+    The new source, as returned by FetchSource.  It is also stored in
+    SOURCE_CACHE.
+  Raises:
+    urlfetch.Error: The fetch failed, and there was no previous source.
+  """
+  try:
+    response = get_response()
+    status = response.status_code
+  except urlfetch.Error, e:
+    if not source:
+      raise
+    logging.warn('fetching %s failed: %r', url, e)
+    status = None
+
+  if source and (status is None or status == 304 or status >= 500):
+    logging.info('reusing the %d bytes fetched at %s',
+                 len(source['data']), source['fetch_time'])
+  else:
+    data = response.content
+    logging.info('retrieved %d bytes', len(data))
+    data = UnzipData(data, r'.*\.[kx]ml')
+    source = {'url': url, 'data': data, 'hash': hashlib.md5(data).hexdigest(),
+              'etag': response.headers.get('ETag'),
+              'last_modified': response.headers.get('Last-Modified')}
+  source['fetch_time'] = time.time()
+  SOURCE_CACHE.Set(url, source)
+  return source
+
+
+def FetchData(url, referer=None):
+  return FetchSource(url, referer)['data']
+
+
+def FetchSources(urls, referer=None):
+  """Fetches several sources concurrently, as FetchSource does.
+
+  Args:
+    urls: A list of URLs to fetch.
+    referer: An optional value for the Referer header.
+  Returns:
+    A list of the sources, in the same order as the URLs.
+  Raises:
+    urlfetch.Error: A source could not be fetched.  If several failed, this is
+        the error for the first of them.
+  """
+  finishes = [StartFetchSource(url, referer) for url in urls]
+  return [finish() for finish in finishes]
 
 
 def CreateHotspotElement(spec):
@@ -222,26 +710,337 @@ def KmlCoordinatesFromJson(coords):
 
 def KmlGeometryFromJson(geom):
   """Converts a GeoJSON Geometry object to a KML Geometry element."""
-  xml = xml_utils.Xml
+  make = xml_utils.MakeElement
   t = geom.get('type')
   coords = geom.get('coordinates', [])
   if t in ['MultiPoint', 'MultiLineString', 'MultiPolygon']:
-    return xml('MultiGeometry', *(
-        KmlGeometryFromJson({'type': t[5:], 'coordinates': subcoords})
-        for subcoords in coords
-    ))
+    parts = [KmlGeometryFromJson({'type': t[5:], 'coordinates': subcoords})
+             for subcoords in coords]
+    return make('MultiGeometry', None, [p for p in parts if p is not None])
   if t == 'GeometryCollection':
-    return xml('MultiGeometry', *(
-        KmlGeometryFromJson(geometry) for geometry in geom.get('geometries', [])
-    ))
+    parts = map(KmlGeometryFromJson, geom.get('geometries', []))
+    return make('MultiGeometry', None, [p for p in parts if p is not None])
   if t in ['Point', 'LineString']:
-    return xml(t, xml('coordinates', KmlCoordinatesFromJson(coords)))
+    return make(t, None, [make('coordinates', KmlCoordinatesFromJson(coords))])
   if t == 'Polygon':
-    return xml('Polygon', *(
-        xml(i == 0 and 'outerBoundaryIs' or 'innerBoundaryIs',
-            xml('LinearRing', xml('coordinates', KmlCoordinatesFromJson(ring))))
-        for i, ring in enumerate(coords)
-    ))
+    return make('Polygon', None, [
+        make(i == 0 and 'outerBoundaryIs' or 'innerBoundaryIs', None, [
+            make('LinearRing', None, [
+                make('coordinates', KmlCoordinatesFromJson(ring))])])
+        for i, ring in enumerate(coords)])
+
+
+def GeoJsonPositions(geom):
+  """Yields the (lon, lat) positions in a GeoJSON Geometry object."""
+  def GetPositions(coords):
+    if coords and isinstance(coords[0], (int, float)):
+      yield coords[0], coords[1]
+    else:
+      for subcoords in coords or []:
+        for position in GetPositions(subcoords):
+          yield position
+  for position in GetPositions(geom.get('coordinates')):
+    yield position
+  for geometry in geom.get('geometries') or []:
+    for position in GeoJsonPositions(geometry):
+      yield position
+
+
+def KmlPositions(element):
+  """Yields the (lon, lat) positions in a KML Geometry element."""
+  for coordinates in element.getiterator('coordinates'):
+    for xyz in (coordinates.text or '').split():
+      try:
+        lon, lat = map(float, xyz.split(',')[:2])
+      except ValueError:
+        continue
+      yield lon, lat
+
+
+def GetBounds(positions):
+  """Gets the (west, south, east, north) bounds of some positions, or None."""
+  positions = list(positions)
+  if positions:
+    lons, lats = zip(*positions)
+    return min(lons), min(lats), max(lons), max(lats)
+
+
+def Intersects(bounds, bbox):
+  """Returns True if the bounds intersect a (west, south, east, north) box."""
+  west, south, east, north = bbox
+  if west > east:  # the box crosses the 180th meridian
+    return (Intersects(bounds, (west, south, 180, north)) or
+            Intersects(bounds, (-180, south, east, north)))
+  return (bounds[0] <= east and bounds[2] >= west and
+          bounds[1] <= north and bounds[3] >= south)
+
+
+def ParseBbox(spec):
+  """Parses a 'west,south,east,north' bounding box specification."""
+  west, south, east, north = map(float, spec.split(','))
+  if not (-90 <= south <= north <= 90 and
+          -180 <= west <= 180 and -180 <= east <= 180):
+    raise ValueError('invalid bbox: %r' % spec)
+  return west, south, east, north
+
+
+def Project(lon, lat):
+  """Projects a point to Web Mercator (x, y) coordinates from 0 to 1."""
+  lat = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat)))
+  return ((lon + 180.0) / 360,
+          (1 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2)
+
+
+def SnapBboxToTiles(bbox, zoom):
+  """Expands a bounding box to the edges of the map tiles at a zoom level.
+
+  Nearby viewports at the same zoom level then ask for the same box, so they
+  can share cached results.
+
+  Args:
+    bbox: A (west, south, east, north) tuple, in degrees.
+    zoom: A map zoom level.
+  Returns:
+    The (west, south, east, north) bounds of the tiles covering the box.
+  """
+  n = 2 ** zoom
+  def TileX(lon):
+    return min(n - 1, int(Project(lon, 0)[0] * n))
+  def TileY(lat):
+    return min(n - 1, int(Project(0, lat)[1] * n))
+  def TileLat(y):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2.0 * y / n))))
+
+  west, south, east, north = bbox
+  # The tiles in the top and bottom rows are extended to the poles.
+  top, bottom = TileY(north), TileY(south) + 1
+  north = TileLat(top) if top > 0 else 90
+  south = TileLat(bottom) if bottom < n else -90
+  return (TileX(west) * 360.0 / n - 180, south,
+          (TileX(east) + 1) * 360.0 / n - 180, north)
+
+
+class GridIndex(object):
+  """A spatial index of bounding boxes, bucketed into a grid of cells."""
+
+  def __init__(self, bounds):
+    """Indexes a list of bounding boxes.
+
+    Args:
+      bounds: A list of (west, south, east, north) tuples, or None for items
+          that have no location.
+    """
+    self.bounds = bounds
+    self.cells = {}
+    boxes = filter(None, bounds)
+    if boxes:
+      self.west = min(box[0] for box in boxes)
+      self.south = min(box[1] for box in boxes)
+      self.cell_width = max(
+          max(box[2] for box in boxes) - self.west, 1e-6) / float(GRID_SIZE)
+      self.cell_height = max(
+          max(box[3] for box in boxes) - self.south, 1e-6) / float(GRID_SIZE)
+      for i, box in enumerate(bounds):
+        if box:
+          for cell in self.GetCells(box):
+            self.cells.setdefault(cell, []).append(i)
+
+  def GetCells(self, bbox):
+    """Gets the (x, y) coordinates of the cells that overlap a box."""
+    def Clamp(value):
+      return max(0, min(GRID_SIZE - 1, int(value)))
+    west, south, east, north = bbox
+    xs = range(Clamp((west - self.west) / self.cell_width),
+               Clamp((east - self.west) / self.cell_width) + 1)
+    ys = range(Clamp((south - self.south) / self.cell_height),
+               Clamp((north - self.south) / self.cell_height) + 1)
+    return itertools.product(xs, ys)
+
+  def Search(self, bbox):
+    """Finds the items whose bounds intersect a box.
+
+    Args:
+      bbox: A (west, south, east, north) tuple.  If west > east, the box is
+          taken to cross the 180th meridian.
+    Returns:
+      The indices of the matching items, in ascending order.
+    """
+    west, south, east, north = bbox
+    if not self.cells:
+      return []
+    if west > east:
+      boxes = [(west, south, 180, north), (-180, south, east, north)]
+    else:
+      boxes = [bbox]
+    candidates = set()
+    for box in boxes:
+      for cell in self.GetCells(box):
+        candidates.update(self.cells.get(cell, []))
+    return sorted(i for i in candidates if Intersects(self.bounds[i], bbox))
+
+
+def MakeClusters(bounds):
+  """Groups points into clusters at each zoom level.
+
+  Points are clustered on a grid of square cells, CLUSTER_CELL_PIXELS on a
+  side, in the Web Mercator projection.  Each cell at a given zoom level
+  contains exactly four cells at the next higher zoom level, so clusters only
+  ever merge as the zoom level decreases.
+
+  Args:
+    bounds: A list of (west, south, east, north) tuples, or None for items
+        that have no location.  Items whose bounds are a single point are
+        clustered; other items are left out.
+  Returns:
+    A list, indexed by zoom level from 0 to MAX_CLUSTER_ZOOM, of lists of
+    (indices, lon, lat) tuples, where indices is a list of the indices of the
+    points in the cluster and (lon, lat) is their centroid.  The clusters are
+    ordered by their first index.
+  """
+  points = [(i, box[0], box[1]) + Project(box[0], box[1])
+            for i, box in enumerate(bounds)
+            if box and box[0] == box[2] and box[1] == box[3]]
+  clusters = []
+  for zoom in range(MAX_CLUSTER_ZOOM + 1):
+    scale = 256.0 * 2 ** zoom / CLUSTER_CELL_PIXELS
+    cells = collections.OrderedDict()
+    for i, lon, lat, x, y in points:
+      cells.setdefault((int(x * scale), int(y * scale)), []).append(
+          (i, lon, lat))
+    clusters.append([
+        ([i for i, _, _ in members],
+         sum(lon for _, lon, _ in members) / len(members),
+         sum(lat for _, _, lat in members) / len(members))
+        for members in cells.itervalues()])
+  return clusters
+
+
+def MakeClusterRecord(indices, lon, lat):
+  """Makes a record representing a cluster of points."""
+  return {'__count__': len(indices),
+          '__geojson__': {'type': 'Point', 'coordinates': [lon, lat]}}
+
+
+def SimplifyLine(positions, tolerance):
+  """Simplifies a line using the Douglas-Peucker algorithm.
+
+  Args:
+    positions: A list of positions, each a list or tuple of coordinates
+        beginning with the longitude and latitude.
+    tolerance: The maximum distance, in degrees, by which the simplified
+        line may deviate from the original.
+  Returns:
+    A list of the positions that are kept, in their original order.
+  """
+  if len(positions) < 3:
+    return positions
+  keep = [False] * len(positions)
+  keep[0] = keep[-1] = True
+  spans = [(0, len(positions) - 1)]
+  while spans:
+    first, last = spans.pop()
+    ax, ay = positions[first][:2]
+    dx, dy = positions[last][0] - ax, positions[last][1] - ay
+    length_squared = dx * dx + dy * dy
+    max_distance_squared, farthest = tolerance * tolerance, None
+    for i in xrange(first + 1, last):
+      px, py = positions[i][0] - ax, positions[i][1] - ay
+      t = length_squared and (px * dx + py * dy) / float(length_squared)
+      t = max(0, min(1, t))
+      ex, ey = px - t * dx, py - t * dy
+      if ex * ex + ey * ey > max_distance_squared:
+        max_distance_squared, farthest = ex * ex + ey * ey, i
+    if farthest is not None:
+      keep[farthest] = True
+      spans += [(first, farthest), (farthest, last)]
+  return [position for position, kept in zip(positions, keep) if kept]
+
+
+def GetPrecision(tolerance):
+  """Gets the number of decimal places needed for a tolerance in degrees."""
+  return max(0, int(math.ceil(-math.log10(tolerance))) + 1)
+
+
+def SimplifyGeoJsonGeometry(geom, tolerance):
+  """Simplifies the lines and rings in a GeoJSON Geometry object.
+
+  Args:
+    geom: A GeoJSON Geometry object.
+    tolerance: The maximum deviation from the original, in degrees.
+  Returns:
+    A new GeoJSON Geometry object, with its coordinates rounded to suit the
+    tolerance.
+  """
+  precision = GetPrecision(tolerance)
+  def Round(position):
+    return [round(coord, precision) for coord in position]
+  def Line(line):
+    return map(Round, SimplifyLine(line, tolerance))
+  def Ring(ring):
+    simplified = Line(ring)
+    # A ring that would collapse is left at full resolution.
+    return len(simplified) >= 4 and simplified or map(Round, ring)
+  def Polygon(rings):
+    return map(Ring, rings)
+
+  t = geom.get('type') or ''
+  coords = geom.get('coordinates', [])
+  if t == 'GeometryCollection':
+    return dict(geom, geometries=[
+        SimplifyGeoJsonGeometry(geometry, tolerance)
+        for geometry in geom.get('geometries', [])])
+  simplify = {'Point': Round, 'LineString': Line, 'Polygon': Polygon}
+  if t in simplify:
+    return dict(geom, coordinates=simplify[t](coords))
+  if t.startswith('Multi') and t[5:] in simplify:
+    return dict(geom, coordinates=map(simplify[t[5:]], coords))
+  return geom
+
+
+def SimplifyKmlGeometry(element, tolerance):
+  """Simplifies the lines and rings in a KML Geometry element, in place.
+
+  Args:
+    element: A KML Geometry element.
+    tolerance: The maximum deviation from the original, in degrees.
+  """
+  precision = GetPrecision(tolerance)
+  for parent in element.getiterator():
+    coordinates = parent.find('coordinates')
+    if coordinates is None:
+      continue
+    try:
+      positions = [map(float, xyz.split(','))
+                   for xyz in (coordinates.text or '').split()]
+    except ValueError:
+      continue  # leave unparseable coordinates alone
+    if parent.tag in ['LineString', 'LinearRing']:
+      simplified = SimplifyLine(positions, tolerance)
+      if parent.tag == 'LineString' or len(simplified) >= 4:
+        positions = simplified
+    coordinates.text = ' '.join(
+        ','.join(str(round(coord, precision)) for coord in position)
+        for position in positions)
+
+
+def GeoJsonGeometryFromKml(element):
+  """Converts a KML Geometry element to a GeoJSON Geometry object."""
+  def GetPositions(element):
+    text = element.findtext('.//coordinates') or ''
+    return [map(float, xyz.split(',')) for xyz in text.split()]
+
+  if element.tag == 'Point':
+    positions = GetPositions(element)
+    return positions and {'type': 'Point', 'coordinates': positions[0]}
+  if element.tag == 'LineString':
+    return {'type': 'LineString', 'coordinates': GetPositions(element)}
+  if element.tag == 'Polygon':
+    rings = (element.findall('outerBoundaryIs') +
+             element.findall('innerBoundaryIs'))
+    return {'type': 'Polygon', 'coordinates': map(GetPositions, rings)}
+  if element.tag == 'MultiGeometry':
+    return {'type': 'GeometryCollection',
+            'geometries': filter(None, map(GeoJsonGeometryFromKml, element))}
 
 
 def KmlStyleFromJson(props, root_url):
@@ -276,8 +1075,46 @@ def KmlColorFromJson(color, opacity=1):
 
 
 class Template(string.Template):
+  """A string.Template that is parsed once and can then be rendered quickly."""
   idpattern = r'/?\w[\w.@#]*'
 
+  def __init__(self, template):
+    string.Template.__init__(self, template)
+    # A list of (literal, name) pairs; each literal string is followed by the
+    # value of the placeholder with the given name, or nothing if name is None.
+    self.parts = []
+    self.names = set()
+    literal_start = 0
+    for match in self.pattern.finditer(template):
+      if match.group('invalid') is not None:
+        raise ValueError('invalid placeholder at position %d in %r' %
+                         (match.start('invalid'), template))
+      literal = template[literal_start:match.start()]
+      literal_start = match.end()
+      if match.group('escaped') is not None:
+        self.parts.append((literal + self.delimiter, None))
+      else:
+        name = match.group('named') or match.group('braced')
+        self.parts.append((literal, name))
+        self.names.add(name)
+    self.parts.append((template[literal_start:], None))
+
+  def Render(self, lookup):
+    """Fills in the template.
+
+    Args:
+      lookup: A function that takes a placeholder name and returns its value.
+          It is called only for the placeholders that appear in the template.
+    Returns:
+      The resulting string.
+    """
+    pieces = []
+    for literal, name in self.parts:
+      pieces.append(literal)
+      if name is not None:
+        pieces.append('%s' % (lookup(name),))
+    return ''.join(pieces)
+
 
 class Kmlifier(object):
   """A converter for CSV/XML/GeoJSON to KML."""
@@ -285,7 +1122,8 @@ class Kmlifier(object):
   def __init__(self, root_url, name_template, description_template,
                location_fields, id_template, icon_url_template=None,
                color_template=None, hotspot_template=None,
-               join_field=None, join_data=None, conditions=None):
+               join_field=None, join_source=None, conditions=None,
+               tolerance=None):
     """Sets up a record extractor and KML emitter.
 
     Args:
@@ -322,14 +1160,18 @@ class Kmlifier(object):
           edge; 'tl', 'tr', 'bl', 'br' for a corner).  If unspecified or
           empty, the hotspot defaults to the center of the image.
       join_field: A field name on which to join against another table of data.
-      join_data: Another table of CSV data.
+      join_source: Another table of CSV data, as returned by FetchSource.
       conditions: A list of conditions to filter by.  Each condition is a
           string consisting of a field name, an operator, and a value.  The
           operator can be one of ['==', '!=', '<', '<=', '>', '>='].  Values
           are compared as numbers if the value is parseable as a float;
           otherwise values are compared as strings.
+      tolerance: Optional.  If specified, lines and polygons are simplified
+          so that they deviate from the original by at most this many
+          degrees, and coordinates are rounded accordingly.
     """
     self.root_url = root_url
+    self.tolerance = tolerance
     self.name_template = Template(name_template)
     self.description_template = Template(description_template)
     self.location_fields = location_fields
@@ -338,21 +1180,15 @@ class Kmlifier(object):
     self.color_template = Template(color_template or 'ffffffff')
     self.hotspot_template = Template(hotspot_template or 'mc')
     self.join_field = join_field or ''
-    self.join_records = {}
-    if join_data:
-      self.join_records = {
-          record[join_field]: record
-          for record in self.RecordsFromCsv(join_data, header_fields_hint=[])}
 
     # Gather the set of all fields mentioned in templates or conditions.
     self.fields = set()
-    def Gather(match):
-      name = match.group('named') or match.group('braced')
-      if name:
-        self.fields.add(str(name).lstrip('_'))
-    self.name_template.pattern.sub(Gather, name_template)
-    self.description_template.pattern.sub(Gather, description_template)
-    self.id_template.pattern.sub(Gather, id_template)
+    for template in [self.name_template, self.description_template,
+                     self.id_template]:
+      self.fields.update(str(name).lstrip('_') for name in template.names)
+    for template in [self.icon_url_template, self.color_template,
+                     self.hotspot_template]:
+      self.fields.update(str(name) for name in template.names)
     for field in location_fields:
       if field.startswith('^'):
         field = field[1:]
@@ -367,15 +1203,29 @@ class Kmlifier(object):
         if condition:
           try:
             field, opsym, value = re.split('([=<>!]+)', str(condition), 1)
-            op = OPERATORS[opsym]
+            OPERATORS[opsym]  # pylint: disable=pointless-statement
           except (KeyError, ValueError):
             raise ValueError('ill-formed condition: %r' % condition)
           try:
             value = float(value)  # compare as a float
           except ValueError:
             pass  # compare as a string
-          self.conditions.append((field, op, value))
+          self.conditions.append((field, opsym, value))
           self.fields.add(field)
+    self.predicate = MakePredicate(self.conditions)
+
+    # For XML, fields are extracted by looking up each element's tag here.
+    # global_fields collects fields outside of record tags, so that if, for
+    # example, there is a single <title> for the whole XML document, it can
+    # be referenced in templates as $/title.
+    self.field_table = MakeFieldTable(self.fields)
+    self.need_global_fields = any(
+        field.startswith('/') for field in self.fields)
+
+    # The join records need only the fields above, so this comes last.
+    self.join_records = {}
+    if join_source and self.join_field:
+      self.join_records = self.GetJoinRecords(join_source)
 
   def RecordsFromGeoJson(self, geojson_data):
     """Extracts records from a GeoJSON string.
@@ -383,22 +1233,19 @@ class Kmlifier(object):
     Args:
       geojson_data: A GeoJSON object, serialized as a string.  See
           http://geojson.org/geojson-spec.html#geojson-objects for details.
-    Returns:
-      The records, as a list of dictionaries containing KML Geometry and Style
-      elements in their '__geometry__' and '__style__' keys, respectively.
+    Yields:
+      The records, as dictionaries of feature properties with the GeoJSON
+      Geometry object in the '__geojson__' key.
     """
     obj = json.loads(geojson_data)
     if obj['type'] not in ['Feature', 'FeatureCollection']:
       obj = {'type': 'Feature', 'geometry': obj}
-    records = []
     for feature in obj.get('features', [obj]):
       if feature.get('type') == 'Feature':
-        geometry = KmlGeometryFromJson(feature.get('geometry', {}))
         props = feature.get('properties', {})
-        style = KmlStyleFromJson(props, self.root_url)
-        if geometry:
-          records.append(dict(props, __geometry__=geometry, __style__=style))
-    return records
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') in GEOJSON_GEOMETRY_TYPES:
+          yield dict(props, __geojson__=geometry)
 
   def RecordsFromCsv(self, csv_data, encoding='utf-8', header_fields_hint=None):
     """Extracts records from a string of CSV data.
@@ -411,15 +1258,35 @@ class Kmlifier(object):
           If empty, use the first row as the header.
           If None, use self.location_fields_cleaned.
     Returns:
-      The records, as a list of dictionaries.
+      An iterator over the records, as dictionaries.  Rows are parsed only as
+      the iterator is consumed.  Only the columns named in self.fields are
+      decoded and kept in the records; a cell missing from a short row yields
+      an empty string.
     """
     csv_file = StringIO.StringIO(csv_data)
     if header_fields_hint is None:
       header_fields_hint = self.location_fields_cleaned
-    fieldnames = self.FindCsvFieldnames(csv_file, encoding, header_fields_hint)
+    decode = MakeDecoder(encoding)
+    fieldnames, subfieldnames = self.FindCsvFieldnames(
+        csv_file, encoding, header_fields_hint)
     logging.info('CSV fieldnames: %s', fieldnames)
-    return [NormalizeRecord(DecodeRecord(record, encoding))
-            for record in csv.DictReader(csv_file, fieldnames=fieldnames)]
+
+    # If a name appears in several columns, the last one wins, as it would
+    # with csv.DictReader.  A name from a second header row takes precedence.
+    columns = {}
+    for names in [fieldnames, subfieldnames]:
+      for i, name in enumerate(names):
+        if name in self.fields:
+          columns[name] = i
+    projection = columns.items()
+
+    def MakeRecord(row):
+      size = len(row)
+      return {name: decode(row[i]).strip() if i < size else ''
+              for name, i in projection}
+
+    rows = (row for row in csv.reader(csv_file) if row)  # skip blank lines
+    return itertools.imap(MakeRecord, rows)
 
   def FindCsvFieldnames(self, csv_file, encoding, header_fields_hint):
     """Finds a suitable set of fieldnames to map fields to CSV columns.
@@ -427,8 +1294,8 @@ class Kmlifier(object):
     Field names are taken from the first row with cells that match the
     latitude, longitude fields specified in self.location_fields.
     If that row contains empty cells, the algorithm presumes that field
-    names span multiple rows, and it searches the following row for fields in
-    self.fields.  If found, they are copied into the return value.
+    names span multiple rows, and the names in the following row are
+    returned too.
 
     Note that the current implementation does not support the case where
     self.location_fields are in the second row of field definitions.
@@ -439,7 +1306,8 @@ class Kmlifier(object):
       header_fields_hint: A list of fields required to be in the header row.
           Pass an empty list to use the first row as the header.
     Returns:
-      An array suitable for passing to fieldnames in csv.DictReader
+      A pair (fieldnames, subfieldnames) of lists of the names in the header
+      row and in the second header row (empty if there is none), by column.
     """
     fieldnames = []
     csv_reader = csv.reader(csv_file)
@@ -449,6 +1317,7 @@ class Kmlifier(object):
         fieldnames = row
         break
 
+    subfieldnames = []
     if '' in fieldnames:
       # Handle rowspans in the fieldnames line.  Example:
       # | Name | Location             | Description | Lat | Lon |
@@ -456,18 +1325,17 @@ class Kmlifier(object):
       # is stored in csv as
       # Name,Location,,Description,Lat,Lon
       # ,Address,City State,,,
-      # and should end up as
-      # ['Name', 'Address', 'City_State', 'Description', 'Lat', 'Lon']
-      # if we need to refer to Address or City_State in self.fields
+      # and gives the subfieldnames
+      # ['', 'Address', 'City_State', '', '', '']
+      # so that we can refer to Address or City_State in self.fields
       first_header_row_pos = csv_file.tell()
       row = [NormalizeFieldName(Decode(f, encoding)) for f in csv_reader.next()]
-      for index in range(len(fieldnames)):
-        if row[index] in self.fields:
-          fieldnames[index] = row[index]
+      subfieldnames = row[:len(fieldnames)]
       csv_file.seek(first_header_row_pos)
-    return fieldnames
+    return fieldnames, subfieldnames
 
-  def RecordsFromXml(self, xml_data, record_tag=None, xml_wrapper_tag=None):
+  def RecordsFromXml(self, xml_data, record_tag=None, xml_wrapper_tag=None,
+                     keep_elements=False):
     """Extracts records from a string of XML data.
 
     Fields in self.fields are sought as XML tags or attributes in each record.
@@ -478,6 +1346,15 @@ class Kmlifier(object):
     "p.q" gets the contents of the <p> element whose "class" attribute is "q".
     A field named "x@y" gets the value of the "y" attribute on the <x> element.
 
+    The XML is parsed incrementally, and each record is yielded (and removed
+    from the tree) as soon as it is complete, unless the templates refer to
+    fields outside the records (such as "$/title"), in which case the whole
+    document has to be read first.
+
+    With keep_elements, no fields are extracted; instead, each record keeps
+    its whole element in the '__element__' key, so the records can serve
+    any templates and conditions later (see ExpandRecord).
+
     Args:
       xml_data: A string of XML to parse.
       record_tag: The XML tag surrounding each record.  Any tag with this
@@ -485,120 +1362,383 @@ class Kmlifier(object):
       xml_wrapper_tag: An XML tag name.  If this is specified, it is assumed
           that all the records have been serialized as XML text in the text
           content of XML elements with this tag name.
-    Returns:
-      The records, as a list of dictionaries.
+      keep_elements: If True, keep each record's element instead of its
+          fields.  This can't be used with fields outside the records.
+    Yields:
+      The records, as dictionaries.
     """
     if xml_wrapper_tag:
-      root = ParseXml(xml_data)
-      xml_data = ''.join(element.text for element in root.getiterator()
-                         if element.tag.split('}')[-1] == xml_wrapper_tag)
-    root = ParseXml(xml_data)
-    for element in root.getiterator():
-      element.tag = element.tag.split('}')[-1]  # remove XML namespaces
-
-    styles = {element.get('id'): element
-              for element in root.findall('.//Style')}
-
-    def ExtractFields(field_prefix, element, record):
-      """Copies field values from an element into the given dictionary."""
-      def ExtractField(field, value):
-        if field in self.fields:
-          record[field] = value
-      text = GetText(element)
-      ExtractField(field_prefix, text)
-      for attr in element.keys():
-        ExtractField(field_prefix + '@' + attr, element.get(attr))
-      ExtractField(field_prefix + '.' + element.get('class', '').strip(), text)
-      ExtractField(field_prefix + '#' + element.get('id', '').strip(), text)
-      ExtractField(field_prefix + '#' + element.get('name', '').strip(), text)
-
-    # We walk over the the whole document looking for the record_tag XML tag;
-    # for each record tag, we scan all elements and attributes within, pulling
-    # out their values into records only if they are specified in self.fields.
-    records = []
-    # global_fields collects fields outside of record tags, so that if, for
-    # example, there is a single <title> for the whole XML document, it can
-    # be referenced in templates as $/title.
-    global_fields = {}
-    for element in root.getiterator():
+      texts = []
+      for _, element in IterParseXml(xml_data):
+        if element.tag == xml_wrapper_tag:
+          texts.append(element.text or '')
+        element.clear()
+      xml_data = ''.join(texts)
+
+    need_global_fields = self.need_global_fields
+    styles = {}  # Style elements by ID
+    pending = collections.deque()  # [record, style_id] slots, in order
+    open_slots = []  # slots for the record elements now being read
+    parents = []  # the elements now being read
+    top_elements = []  # the elements that have no parent
+    style_depth = 0  # nesting depth within Style elements
+
+    for event, element in IterParseXml(xml_data, ('start', 'end')):
+      if event == 'start':
+        if not parents:
+          top_elements.append(element)
+        parents.append(element)
+        if element.tag == record_tag:
+          open_slots.append([None, None])
+          pending.append(open_slots[-1])
+        style_depth += element.tag == 'Style'
+        continue
+
+      if parents:  # (the end of an added root element has no start event)
+        parents.pop()
+      if element.tag == 'Style':
+        styles[element.get('id')] = element
+        style_depth -= 1
       if element.tag == record_tag:
-        record = {}
-        for child in element.getiterator():
-          ExtractFields(child.tag, child, record)
-          if (child.tag in 'Point LineString Polygon MultiGeometry'.split() and
-              child.find('.//coordinates') is not None):
-            record['__geometry__'] = child  # preserve KML geometry
-        style = element.find('.//Style')
+        if keep_elements:
+          record = {'__element__': element}
+        else:
+          record = ExtractRecord(element, self.field_table)
         style_url = element.find('.//styleUrl')
-        if style is not None:
-          record['__style__'] = style  # preserve KML style
-        elif style_url is not None and style_url.text.startswith('#'):
-          record['__style__'] = styles.get(style_url.text.lstrip('#'))
-        records.append(record)
-      else:
-        ExtractFields('/' + element.tag, element, global_fields)
+        style_id = None
+        if (element.find('.//Style') is None and style_url is not None and
+            (style_url.text or '').startswith('#')):
+          style_id = style_url.text.lstrip('#')  # resolved when yielded
+        open_slots.pop()[:] = [record, style_id]
+
+      if not (open_slots or style_depth or need_global_fields):
+        # Nothing more will be read from this element, so take it out of the
+        # tree.  (A Style element lives on in the styles dictionary, and a
+        # kept record element lives on in its record.)
+        if element.tag != 'Style' and not (
+            keep_elements and element.tag == record_tag):
+          element.clear()
+        if parents:
+          parents[-1].remove(element)
+        # Yield the complete records whose shared styles have been read.
+        while pending and pending[0][0] is not None and (
+            pending[0][1] is None or pending[0][1] in styles):
+          record, style_id = pending.popleft()
+          if style_id is not None:
+            record['__style__'] = styles[style_id]
+          yield record
+
+    global_fields = {}
+    if need_global_fields:
+      for top_element in top_elements:
+        for element in top_element.getiterator():
+          entry = self.field_table.get('/' + element.tag)
+          if entry and element.tag != record_tag:
+            ExtractFields(element, entry, global_fields)
+    for record, style_id in pending:
+      if style_id is not None:
+        record['__style__'] = styles.get(style_id)
+      result = global_fields.copy()
+      result.update(record)
+      yield result
+
+  def RecordsFromData(self, data, data_type, record_tag=None,
+                      xml_wrapper_tag=None):
+    """Extracts records from source data of the given type.
+
+    Args:
+      data: The source data, as a string.
+      data_type: The type of the data: 'xml', 'csv', or 'geojson'.
+      record_tag: For XML, the XML tag surrounding each record.
+      xml_wrapper_tag: For XML, the tag of elements that contain the records
+          serialized as text, if any.
+    Returns:
+      An iterator over all the records, as dictionaries, regardless of the
+      conditions.  CSV records have just self.fields, and GeoJSON records all
+      their properties.  XML records keep their elements (see ExpandRecord),
+      unless the templates refer to fields outside the records, in which case
+      they have just self.fields.
+    Raises:
+      ValueError: The data type is not recognized.
+    """
+    if data_type == 'xml':
+      return self.RecordsFromXml(data, record_tag, xml_wrapper_tag,
+                                 keep_elements=not self.need_global_fields)
+    elif data_type == 'csv':
+      return self.RecordsFromCsv(data)
+    elif data_type == 'geojson':
+      return self.RecordsFromGeoJson(data)
+    raise ValueError(
+        'type is %r, but should be "xml", "csv", or "geojson"' % data_type)
+
+  def ExpandRecord(self, record):
+    """Extracts self.fields from a record that keeps its XML element.
 
-    def OverlayDictionaries(base, overlay):
-      result = base.copy()
-      result.update(overlay)
-      return result
-    return [OverlayDictionaries(global_fields, record) for record in records]
+    Args:
+      record: A record from RecordsFromData, with its elements unpacked.
+    Returns:
+      The record with the fields extracted, or the given record if it has no
+      '__element__'.
+    """
+    if '__element__' not in record:
+      return record
+    expanded = ExtractRecord(record['__element__'], self.field_table)
+    if expanded.get('__style__') is None:
+      expanded['__style__'] = record.get('__style__')
+    return expanded
+
+  def GetRecordBounds(self, record):
+    """Gets the (west, south, east, north) bounds of a record, or None."""
+    bounds = None
+    if record.get('__geojson__'):
+      bounds = GetBounds(GeoJsonPositions(record['__geojson__']))
+    elif record.get('__geometry__'):
+      bounds = GetBounds(KmlPositions(record['__geometry__']))
+    if not bounds:
+      bounds = GetBounds(filter(None, [self.GetLocation(record)]))
+    return bounds
+
+  def GetRecords(self, source, data_type, record_tag=None,
+                 xml_wrapper_tag=None, bbox=None, cluster_zoom=None):
+    """Gets the records from source data, parsing it only if it has changed.
+
+    All the records are cached regardless of the conditions, so requests with
+    different conditions share one parse; the conditions are applied to the
+    cached records.  CSV records keep only the columns that the templates and
+    conditions use, so they are cached separately for each set of fields.
+
+    If the records aren't cached, the whole source is parsed and cached before
+    any records are returned, even if the caller reads only some of them, so
+    that later requests for other pages or areas of a large source don't have
+    to parse it again.
+
+    Args:
+      source: The source data, as returned by FetchSource.
+      data_type: The type of the data: 'xml', 'csv', or 'geojson'.
+      record_tag: For XML, the XML tag surrounding each record.
+      xml_wrapper_tag: For XML, the tag of elements that contain the records
+          serialized as text, if any.
+      bbox: Optional.  A (west, south, east, north) tuple; if specified, only
+          the records whose geometry intersects this box are returned.
+      cluster_zoom: Optional.  If specified, points that are close together
+          at this zoom level are replaced with cluster records, which have
+          the number of points in their '__count__' key.
+    Returns:
+      An iterator over the records that meet the conditions, as dictionaries.
+    """
+    # The location fields determine the index.  CSV records, and XML records
+    # with fields outside the records (which can't keep their elements), have
+    # only the fields this request uses.
+    options = [data_type, record_tag, xml_wrapper_tag, self.location_fields]
+    if data_type == 'csv' or (data_type == 'xml' and self.need_global_fields):
+      options.append(sorted(self.fields))
+    key = [source['url'], source['hash'], options]
+    clustering = cluster_zoom is not None and cluster_zoom <= MAX_CLUSTER_ZOOM
+    value = RECORDS_CACHE.Get(key)
+    if value is None:
+      value = self.CacheRecords(key, self.RecordsFromData(
+          source['data'], data_type, record_tag, xml_wrapper_tag))
+    records = value['records']
+    logging.info('got %d records for %s', len(records), source['url'])
+    if clustering:
+      clusters = CLUSTERS_CACHE.Get(key)
+      if clusters is None:
+        clusters = MakeClusters(value['index'].bounds)
+        CLUSTERS_CACHE.Set(key, clusters)
+      return self.ClusterRecords(
+          records, value['index'], clusters[cluster_zoom], bbox)
+    if bbox:
+      records = [records[i] for i in value['index'].Search(bbox)]
+      logging.info('%d records are in %r', len(records), bbox)
+    return self.FilterRecords(
+        self.ExpandRecord(UnpackRecord(record)) for record in records)
+
+  def CacheRecords(self, key, records):
+    """Reads all the records from a source and stores them in RECORDS_CACHE.
+
+    Args:
+      key: The RECORDS_CACHE key for the records.
+      records: An iterable of records from RecordsFromData.
+    Returns:
+      The cached value: a dictionary with keys 'records' (a list of packed
+      records) and 'index' (a GridIndex of their bounds).
+    """
+    packed_records, bounds = [], []
+    for record in records:
+      bounds.append(self.GetRecordBounds(self.ExpandRecord(record)))
+      packed_records.append(PackRecord(record))
+    value = {'records': packed_records, 'index': GridIndex(bounds)}
+    RECORDS_CACHE.Set(key, value)
+    return value
+
+  def ClusterRecords(self, records, index, clusters, bbox=None):
+    """Replaces clustered points with cluster records.
+
+    Args:
+      records: A list of packed records.
+      index: The GridIndex of the records.
+      clusters: The clusters of points at one zoom level, from MakeClusters.
+      bbox: Optional.  A (west, south, east, north) tuple; if specified, only
+          the records and clusters within this box are included.
+    Yields:
+      The unclustered records and the cluster records, ordered by the first
+      record in each.  Only the records that meet the conditions are
+      included, and clusters are made of just those records.
+    """
+    expanded = {}
+    def GetRecord(i):
+      if i not in expanded:
+        expanded[i] = self.ExpandRecord(UnpackRecord(records[i]))
+      return expanded[i]
+    def Meets(i):
+      return not self.conditions or self.predicate(GetRecord(i))
+
+    selected = set(index.Search(bbox) if bbox else range(len(records)))
+    # Points are represented by their clusters; other records by themselves.
+    items = []
+    for indices, lon, lat in clusters:
+      if len(indices) == 1:
+        if indices[0] in selected:
+          items.append((indices, lon, lat))
+      elif not bbox or Intersects((lon, lat, lon, lat), bbox):
+        members = filter(Meets, indices)
+        if members and len(members) < len(indices):
+          # The clusters cover all the records; move the centroid to the
+          # records that meet the conditions.
+          lon = sum(index.bounds[i][0] for i in members) / len(members)
+          lat = sum(index.bounds[i][1] for i in members) / len(members)
+        if members:
+          items.append((members, lon, lat))
+    points = set(i for indices, _, _ in clusters for i in indices)
+    items += [([i], None, None) for i in selected if i not in points]
+    for indices, lon, lat in sorted(items):
+      if len(indices) > 1:
+        yield MakeClusterRecord(indices, lon, lat)
+      elif Meets(indices[0]):
+        yield GetRecord(indices[0])
 
   def FilterRecords(self, records):
-    """Filters the given a list of records by the specified conditions."""
-    return [record for record in records
-            if all(Compare(op, record.get(field, None), value)
-                   for field, op, value in self.conditions)]
-
-  def RecordsToKmlDocument(self, records):
-    """Turns a list of records into a KML Document element of placemarks."""
-    xml = xml_utils.Xml
-    placemarks = []
-    styles = []
+    """Filters an iterable of records by the specified conditions, lazily."""
+    return itertools.ifilter(self.predicate, records)
+
+  def GetJoinRecords(self, join_source):
+    """Gets the join table for some CSV data, parsing it only if it has changed.
+
+    Args:
+      join_source: The CSV data, as returned by FetchSource.
+    Returns:
+      A dictionary that maps each value of the join field to a record.
+    """
+    key = [join_source['url'], join_source['hash'], self.join_field,
+           sorted(self.fields)]
+    join_records = JOIN_CACHE.Get(key)
+    if join_records is None:
+      join_records = {
+          record[self.join_field]: record
+          for record in self.RecordsFromCsv(
+              join_source['data'], header_fields_hint=[])}
+      JOIN_CACHE.Set(key, join_records)
+    logging.info('got %d join records for %s',
+                 len(join_records), join_source['url'])
+    return join_records
+
+  def JoinRecord(self, record):
+    """Adds the fields of the matching record in the join_data, if any."""
+    if self.join_field:
+      join_record = self.join_records.get(record[self.join_field])
+      if join_record:
+        record.update(join_record)
+
+  def GetLocation(self, record):
+    """Gets a record's location from its location fields.
+
+    The first field specification that gets us to a valid latitude and
+    longitude is used.  This is handy because, if the location might appear
+    in one of two different fields, you can specify both and you'll get
+    whichever field is populated.
+
+    Args:
+      record: A record, as a dictionary.
+    Returns:
+      A (longitude, latitude) pair of floats, or None.
+    """
+    for field in self.location_fields:
+      try:
+        if ',' in field:
+          [lat, lon] = map(record.get, field.split(',')[:2])
+        elif field.startswith('^'):
+          lon, lat = record[field[1:]].replace(',', ' ').split()[:2]
+        else:
+          lat, lon = record[field].replace(',', ' ').split()[:2]
+        return float(lon), float(lat)
+      except (KeyError, ValueError, TypeError):
+        continue
+
+  def SimplifyRecord(self, record):
+    """Simplifies the geometry of a record, if a tolerance was specified."""
+    if self.tolerance:
+      if record.get('__geojson__'):
+        record['__geojson__'] = SimplifyGeoJsonGeometry(
+            record['__geojson__'], self.tolerance)
+      if record.get('__geometry__') is not None:
+        SimplifyKmlGeometry(record['__geometry__'], self.tolerance)
+
+  def RecordsToKmlElements(self, records):
+    """Turns an iterable of records into KML elements for a Document.
+
+    Each placemark is yielded as soon as its record has been converted; the
+    shared Style elements that the placemarks refer to are yielded at the end.
+
+    Args:
+      records: An iterable of records, as dictionaries.
+    Yields:
+      The KML Placemark elements, followed by the KML Style elements.
+    """
+    # Placemarks are built with MakeElement, which is faster than Xml.
+    xml, make = xml_utils.Xml, xml_utils.MakeElement
     style_ids = {}
+    styles = []
     for record in records:
+      if '__count__' in record:
+        # A cluster of points is labelled with the number of points.
+        lon, lat = record['__geojson__']['coordinates']
+        count = str(record['__count__'])
+        yield make('Placemark', None, [
+            make('name', count),
+            make('description', '<input type="hidden" '
+                 'name="kmlify-location" value="%.6f,%.6f">' % (lat, lon)),
+            make('ExtendedData', None, [
+                make('Data', None, [make('value', count)], {'name': 'count'})]),
+            KmlGeometryFromJson(record['__geojson__'])])
+        continue
+      self.SimplifyRecord(record)
       geometry = record.pop('__geometry__', None)
       style = record.pop('__style__', None)
-
-      # Join with the join_data, if any.
-      if self.join_field:
-        join_record = self.join_records.get(record[self.join_field])
-        if join_record:
-          record.update(join_record)
+      geojson = record.pop('__geojson__', None)
+      if geojson:
+        geometry = KmlGeometryFromJson(geojson)
+        style = KmlStyleFromJson(record, self.root_url)
+      self.JoinRecord(record)
 
       # Substitute raw values into templates.
-      values = collections.defaultdict(lambda: '', record)
-      name = self.name_template.substitute(values)
-      id_value = self.id_template.substitute(values)
-      icon_url = self.icon_url_template.substitute(values)
-      color = self.color_template.substitute(values)
-      hotspot = self.hotspot_template.substitute(values)
-
-      # Substitute escaped or quoted values into the description template.
-      values.update({key: HtmlEscape(record[key]) for key in record})
-      values.update({'_' + key: record[key] for key in record})
-      values.update({'__' + key: UrlQuote(record[key]) for key in record})
-      description = self.description_template.substitute(values)
+      get_raw = lambda name: record.get(name, '')
+      name = self.name_template.Render(get_raw)
+      id_value = self.id_template.Render(get_raw)
+      icon_url = self.icon_url_template.Render(get_raw)
+      color = self.color_template.Render(get_raw)
+      hotspot = self.hotspot_template.Render(get_raw)
+
+      # Substitute escaped or quoted values into the description template;
+      # only the fields it mentions are escaped or quoted.
+      description = self.description_template.Render(
+          lambda name: GetDescriptionValue(record, name))
 
       # Get geometry information.
       if not geometry:
-        # Take the first field specification that gets us to a valid latitude
-        # and longitude.  This is handy because, if the location might appear
-        # in one of two different fields, you can specify both and you'll get
-        # whichever field is populated.
-        for field in self.location_fields:
-          try:
-            if ',' in field:
-              [lat, lon] = map(record.get, field.split(',')[:2])
-            elif field.startswith('^'):
-              lon, lat = record[field[1:]].replace(',', ' ').split()[:2]
-            else:
-              lat, lon = record[field].replace(',', ' ').split()[:2]
-            coords = '%.6f,%.6f,0' % (float(lon), float(lat))
-            geometry = xml('Point', xml('coordinates', coords))
-            break
-          except (KeyError, ValueError, TypeError):
-            continue
+        location = self.GetLocation(record)
+        if location:
+          geometry = make('Point', None, [
+              make('coordinates', '%.6f,%.6f,0' % location)])
 
       if geometry:
         # When the Maps API gives us click events on a KmlLayer, it conveys
@@ -617,30 +1757,72 @@ class Kmlifier(object):
         except (AttributeError, ValueError):
           continue
 
-      # Get style information.
-      if not style:
-        style = xml('Style',
-                    xml('IconStyle',
-                        xml('color', color),
-                        xml('Icon', xml('href', icon_url)),
-                        CreateHotspotElement(hotspot)))
-      key = xml_utils.Serialize(style)
+      # Get style information.  Styles are deduplicated by a key made from
+      # the record's own style element or from the icon template outputs.
+      key = style and ElementKey(style) or (icon_url, color, hotspot)
       if key not in style_ids:
         style_ids[key] = 'style%d' % (len(style_ids) + 1)
-
-      # Add a placemark.
+        if not style:
+          style = xml('Style',
+                      xml('IconStyle',
+                          xml('color', color),
+                          xml('Icon', xml('href', icon_url)),
+                          CreateHotspotElement(hotspot)))
+        styles.append(xml('Style', style.getchildren(), id=style_ids[key]))
+
+      # Emit a placemark.
       if geometry:
-        placemarks.append(
-            xml('Placemark',
-                id_value and {'id': id_value} or None,
-                xml('name', name),
-                xml('description', description),
-                geometry,
-                xml('styleUrl', '#' + style_ids[key])))
+        yield make('Placemark', None, [
+            make('name', name),
+            make('description', description),
+            geometry,
+            make('styleUrl', '#' + style_ids[key])
+        ], id_value and {'id': id_value} or None)
+
+    for style in styles:
+      yield style
 
-    styles = [xml('Style', *xml_utils.Parse(key).getchildren(), id=style_id)
-              for key, style_id in sorted(style_ids.items())]
-    return xml('Document', *(styles + placemarks))
+  def RecordsToGeoJsonFeatures(self, records):
+    """Turns an iterable of records into GeoJSON Feature objects.
+
+    The geometry of GeoJSON records is passed through unchanged, and no XML
+    elements are constructed for CSV records.
+
+    Args:
+      records: An iterable of records, as dictionaries.
+    Yields:
+      The GeoJSON Feature objects, with 'name' and 'description' properties,
+      or 'name' and 'count' properties for clusters of points.
+    """
+    for record in records:
+      if '__count__' in record:
+        yield {'type': 'Feature', 'geometry': record['__geojson__'],
+               'properties': {'name': str(record['__count__']),
+                              'count': record['__count__']}}
+        continue
+      self.SimplifyRecord(record)
+      geometry = record.pop('__geojson__', None)
+      element = record.pop('__geometry__', None)
+      record.pop('__style__', None)
+      self.JoinRecord(record)
+      try:
+        if not geometry and element is not None:
+          geometry = GeoJsonGeometryFromKml(element)
+      except ValueError:  # bad coordinates
+        continue
+      if not geometry:
+        location = self.GetLocation(record)
+        geometry = location and {'type': 'Point', 'coordinates': location}
+      if geometry:
+        get_raw = lambda name: record.get(name, '')
+        feature = {'type': 'Feature', 'geometry': geometry, 'properties': {
+            'name': self.name_template.Render(get_raw),
+            'description': self.description_template.Render(
+                lambda name: GetDescriptionValue(record, name))}}
+        id_value = self.id_template.Render(get_raw)
+        if id_value:
+          feature['id'] = id_value
+        yield feature
 
 
 class Kmlify(base_handler.BaseHandler):
@@ -662,67 +1844,117 @@ class Kmlify(base_handler.BaseHandler):
     join = str(self.request.get('join', ''))
     conditions = map(str, self.request.get_all('cond') or [])
     conditions = ','.join(conditions).split(',')
+    output_format = str(self.request.get('format', 'kmz'))
+    if output_format not in FORMATS:
+      output_format = 'kmz'
     try:
-      skip = int(self.request.get('skip', '0'))
+      skip = max(0, int(self.request.get('skip', '0')))
     except ValueError:
       skip = 0
     try:  # 10000 features is likely to be more than KmlLayer can handle
-      limit = int(self.request.get('limit', '10000'))
+      limit = max(0, int(self.request.get('limit', '10000')))
     except ValueError:
       limit = 10000
+    try:
+      bbox = ParseBbox(self.request.get('bbox', ''))
+    except ValueError:
+      bbox = None
+    try:
+      zoom = max(0, min(30, int(self.request.get('zoom', ''))))
+    except ValueError:
+      zoom = None
+    if bbox and zoom is not None:
+      bbox = SnapBboxToTiles(bbox, zoom)
+    cluster_zoom = zoom if self.request.get('cluster') else None
+    # simplify=auto simplifies geometry to within one pixel at the zoom level.
+    simplify = str(self.request.get('simplify', ''))
+    try:
+      tolerance = float(simplify)
+    except ValueError:
+      tolerance = None
+    if simplify == 'auto' and zoom is not None:
+      tolerance = 360.0 / (256 * 2 ** zoom)
+    if not 0 < tolerance < 180:  # also rejects None and NaN
+      tolerance = None
 
     cache_key = [url, data_type, xml_wrapper_tag, record_tag, name_template,
                  description_template, location_fields, id_template,
                  icon_url_template, color_template, hotspot_template,
-                 join, conditions, skip, limit]
+                 join, conditions, skip, limit, output_format, bbox,
+                 cluster_zoom, tolerance]
 
-    # TODO(kpy): Keep track of how much time the cache entry has left, and
-    # extend its lifetime if the remote server temporarily fails to respond.
-    kmz = CACHE.Get(cache_key)
-    if kmz is not None:
-      logging.info('got %d bytes from cache', len(kmz))
-      return self.RespondWithKmz(kmz)
+    result = CACHE.Get(cache_key)
+    if result and time.time() < result['check_time'] + CACHE_TTL_SECONDS:
+      logging.info('got %d bytes from cache', len(result['content']))
+      return self.Respond(output_format, result['content'], result['etag'])
 
+    hashes = None
+    writer = self.MakeWriter(output_format)
     try:
-      # Fetch the source data.
-      data = FetchData(url, self.request.host)
-
-      join_field = join_data = None
+      # Fetch the source data, or revalidate our copy of it, together with
+      # the join data, if any.
+      join_field = join_source = None
       if join:
         join_field, join_url = join.split(',', 1)
-        join_data = FetchData(join_url)
+        source, join_source = FetchSources([url, join_url], self.request.host)
+      else:
+        source = FetchSource(url, self.request.host)
+      hashes = [source['hash'], join_source and join_source['hash']]
+
+      # If the source data hasn't changed, extend the lifetime of the output.
+      if result and result['hashes'] == hashes:
+        logging.info('source data unchanged; reusing the cached output')
+        result['check_time'] = time.time()
+        CACHE.Set(cache_key, result)
+        return self.Respond(output_format, result['content'], result['etag'])
 
       # Perform the conversion.
       kmlifier = Kmlifier(
           self.request.root_url, name_template, description_template,
           location_fields, id_template, icon_url_template, color_template,
-          hotspot_template, join_field, join_data, conditions)
-      if data_type == 'xml':
-        records = kmlifier.RecordsFromXml(data, record_tag, xml_wrapper_tag)
-      elif data_type == 'csv':
-        records = kmlifier.RecordsFromCsv(data)
-      elif data_type == 'geojson':
-        records = kmlifier.RecordsFromGeoJson(data)
+          hotspot_template, join_field, join_source,
+          conditions, tolerance)
+      records = kmlifier.GetRecords(
+          source, data_type, record_tag, xml_wrapper_tag, bbox, cluster_zoom)
+      # Records are converted one at a time, and the output is written as it
+      # is produced, so we stop reading the records after skip + limit.
+      records = itertools.islice(records, skip, skip + limit)
+      if output_format == 'geojson':
+        WriteGeoJson(writer, kmlifier.RecordsToGeoJsonFeatures(records))
       else:
-        raise ValueError(
-            'type is %r, but should be "xml", "csv", or "geojson"' % data_type)
-      logging.info('extracted %d records', len(records))
-      records = kmlifier.FilterRecords(records)
-      logging.info('conditions were met by %d records', len(records))
-      records = records[skip:skip + limit]
-      document = kmlifier.RecordsToKmlDocument(records)
+        WriteKml(writer, kmlifier.RecordsToKmlElements(records))
     except Exception, e:  # pylint:disable=broad-except
       # Even if conversion fails, always cache something.  We don't want an
       # error to trigger a spike of urlfetch requests to the remote server.
-      document = xml_utils.Xml(
-          'Document', xml_utils.Xml('name', 'Conversion failed: %r' %  e))
+      writer = self.MakeWriter(output_format)  # discard any partial output
+      hashes = None  # try the conversion again after CACHE_TTL_SECONDS
+      message = 'Conversion failed: %r' % e
+      if output_format == 'geojson':
+        WriteGeoJson(writer, [], message)
+      else:
+        WriteKml(writer, [xml_utils.Xml('name', message)])
       logging.exception(e)
-    kmz = MakeKmz(KML_DOCUMENT_TEMPLATE % xml_utils.Serialize(document))
-    CACHE.Set(cache_key, kmz)
-    self.RespondWithKmz(kmz)
-
-  def RespondWithKmz(self, kmz):
-    self.response.headers['Content-Type'] = KMZ_CONTENT_TYPE
+    content = self.CloseWriter(output_format, writer)
+    logging.info('wrote %d bytes of %s', len(content), output_format)
+    etag = base_handler.MakeEtag(content)
+    CACHE.Set(cache_key, {'content': content, 'etag': etag, 'hashes': hashes,
+                          'check_time': time.time()})
+    self.Respond(output_format, content, etag)
+
+  def MakeWriter(self, output_format):
+    if output_format == 'geojson':
+      return StringIO.StringIO()
+    return KmzWriter()
+
+  def CloseWriter(self, output_format, writer):
+    if output_format == 'geojson':
+      return writer.getvalue()
+    return writer.Close()
+
+  def Respond(self, output_format, content, etag=None):
+    self.response.headers['Content-Type'] = (
+        output_format == 'geojson' and GEOJSON_CONTENT_TYPE or
+        KMZ_CONTENT_TYPE)
     self.response.headers['Cache-Control'] = (
         'public, max-age=%s, must-revalidate' % CACHE_TTL_SECONDS)
-    self.response.out.write(kmz)
+    self.WriteWithEtag(content, etag)
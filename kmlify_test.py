@@ -13,22 +13,39 @@
 
 __author__ = 'romano@google.com (Raquel Romano)'
 
+import itertools
+import json
+import math
 import os
 import StringIO
 import urllib
 import zipfile
 
+import cache
 import kmlify
 import test_utils
 
 from google.appengine.api import urlfetch
 
 
+class FakeRpc(object):
+  """A fake urlfetch RPC, which gets its response from a fetch function."""
+
+  def __init__(self, fetch):
+    self.fetch = fetch
+    self.url = self.kwargs = None
+
+  def get_result(self):  # pylint: disable=g-bad-name
+    return self.fetch(self.url, **self.kwargs)
+
+
 class UrlResponse(object):
   """A fake urlfetch response object."""
 
-  def __init__(self, content):
+  def __init__(self, content, status_code=200, headers=None):
     self.content = content
+    self.status_code = status_code
+    self.headers = headers or {}
 
 
 def MaybeUpdateGoldenFile(file_name, generated_file_data):
@@ -47,6 +64,14 @@ class KmlifyTests(test_utils.BaseTest):
     # Maximum size of diffs that unittest will show (in bytes)
     self.maxDiff = 4096
 
+  def StubFetch(self, fetch):
+    """Makes urlfetch RPCs get their responses from fetch(url, **kwargs)."""
+    def MakeFetchCall(rpc, url, **kwargs):
+      rpc.url, rpc.kwargs = url, kwargs
+    self.mox.stubs.Set(urlfetch, 'create_rpc',
+                       lambda deadline=None: FakeRpc(fetch))
+    self.mox.stubs.Set(urlfetch, 'make_fetch_call', MakeFetchCall)
+
   def testStringify(self):
     self.assertEquals('abcdef', kmlify.Stringify('abcdef'))
     self.assertEquals('abcdef', kmlify.Stringify(u'abcdef'))
@@ -59,6 +84,425 @@ class KmlifyTests(test_utils.BaseTest):
     self.assertEquals("<type 'list'>", kmlify.Stringify(list))
     self.assertEquals("&lt;type 'list'&gt;", kmlify.Stringify(list, True))
 
+  def testElementKey(self):
+    key = kmlify.ElementKey(kmlify.ParseXml(
+        '<Style><IconStyle><scale>2</scale></IconStyle></Style>'))
+    self.assertEquals(key, kmlify.ElementKey(kmlify.ParseXml(
+        '<Style>\n  <IconStyle>  <scale>2</scale>\n</IconStyle> </Style>')))
+    self.assertNotEqual(key, kmlify.ElementKey(kmlify.ParseXml(
+        '<Style><IconStyle><scale>3</scale></IconStyle></Style>')))
+    self.assertNotEqual(key, kmlify.ElementKey(kmlify.ParseXml(
+        '<Style><IconStyle id="a"><scale>2</scale></IconStyle></Style>')))
+
+  def testMakePredicate(self):
+    predicate = kmlify.MakePredicate(
+        [('a', '>', 2.0), ('b', '==', 'x'), ('a', '<=', 10.0), ('c', '<', '')])
+    self.assertTrue(predicate({'a': '3', 'b': 'x'}))
+    self.assertTrue(predicate({'a': 10, 'b': 'x'}))
+    self.assertFalse(predicate({'a': '2', 'b': 'x'}))
+    self.assertFalse(predicate({'a': 'abc', 'b': 'x'}))  # not a number
+    self.assertFalse(predicate({'a': '3', 'b': 'y'}))
+    self.assertFalse(predicate({'a': '3', 'b': 'x', 'c': 'z'}))
+
+  def testCsvRecordsHaveOnlyNeededFields(self):
+    kmlifier = kmlify.Kmlifier('http://app.com', '$Name', '',
+                               ['Latitude,Longitude'], '$Id',
+                               icon_url_template='http://app.com/${Icon}.png')
+    csv_data = ('Id,Latitude,Longitude,Name,Icon,Notes\n'
+                '1,3,4, a ,dot,\xe9t\xe9\n2,3,4\n')
+    self.assertEquals(
+        [{'Id': '1', 'Latitude': '3', 'Longitude': '4', 'Name': 'a',
+          'Icon': 'dot'},
+         {'Id': '2', 'Latitude': '3', 'Longitude': '4', 'Name': '',
+          'Icon': ''}],
+        list(kmlifier.RecordsFromCsv(csv_data)))
+
+  def testMakeDecoder(self):
+    decode = kmlify.MakeDecoder('utf-8')
+    self.assertEquals(u'\xe9t\xe9', decode('\xc3\xa9t\xc3\xa9'))
+    # After a string that isn't UTF-8, non-UTF-8 strings fall back to Latin-1.
+    self.assertEquals(u'\xe9t\xe9', decode('\xe9t\xe9'))
+    self.assertEquals(u'\xe9', decode('\xc3\xa9'))
+    self.assertEquals(u'\xe8', decode('\xe8'))
+
+  def testJoinTableCached(self):
+    join_source = {'url': 'http://example.com/join.csv', 'hash': 'abc',
+                   'data': 'Id,Name,Notes\n1,a,x\n2,b,y\n2,c,z\n'}
+    args = ['http://app.com', '$Name', '', ['Latitude,Longitude'], '$Id',
+            None, None, None, 'Id', join_source]
+    kmlifier = kmlify.Kmlifier(*args)
+    self.assertEquals({'1': {'Id': '1', 'Name': 'a'},
+                       '2': {'Id': '2', 'Name': 'c'}}, kmlifier.join_records)
+
+    # Another Kmlifier for the same join data and fields doesn't parse it.
+    self.SetForTest(kmlify.Kmlifier, 'RecordsFromCsv', None)
+    kmlifier = kmlify.Kmlifier(*args)
+    record = {'Id': '2', 'Latitude': '3', 'Longitude': '4'}
+    kmlifier.JoinRecord(record)
+    self.assertEquals('c', record['Name'])
+
+  def testFetchSources(self):
+    events = []
+    def Fetch(url, **unused_kwargs):
+      events.append('got ' + url)
+      if 'bad' in url:
+        raise urlfetch.DownloadError('timed out')
+      return UrlResponse('data from ' + url)
+    self.StubFetch(Fetch)
+    make_fetch_call = urlfetch.make_fetch_call
+    def MakeFetchCall(rpc, url, **kwargs):
+      events.append('start ' + url)
+      make_fetch_call(rpc, url, **kwargs)
+    self.mox.stubs.Set(urlfetch, 'make_fetch_call', MakeFetchCall)
+
+    sources = kmlify.FetchSources(['http://a.com/', 'http://b.com/'])
+    self.assertEquals(['data from http://a.com/', 'data from http://b.com/'],
+                      [source['data'] for source in sources])
+    # All the fetches are started before waiting for any of them.
+    self.assertEquals(['start http://a.com/', 'start http://b.com/',
+                       'got http://a.com/', 'got http://b.com/'], events)
+    self.assertRaises(urlfetch.DownloadError, kmlify.FetchSources,
+                      ['http://a.com/', 'http://bad.com/'])
+
+  def testTemplate(self):
+    template = kmlify.Template('$$$a ${b}c $_a $__a $missing')
+    self.assertEquals(set(['a', 'b', '_a', '__a', 'missing']), template.names)
+    record = {'a': 'x&y z', 'b': 3}
+    self.assertEquals('$x&y z 3c   ', template.Render(
+        lambda name: record.get(name, '')))
+    self.assertEquals('$x&amp;y z 3c x&y z x%26y%20z ', template.Render(
+        lambda name: kmlify.GetDescriptionValue(record, name)))
+    self.assertRaises(ValueError, kmlify.Template, 'a $ b')
+
+  def testStreamingStopsAtLimit(self):
+    def Records():
+      for i in range(2):
+        yield {'id': str(i), 'loc': '%d,%d' % (i, i), 'name': 'x%d' % i}
+      raise AssertionError('read past the last record needed')
+
+    kmlifier = kmlify.Kmlifier('http://app.com', '$name', '', ['loc'], '$id')
+    records = itertools.islice(kmlifier.FilterRecords(Records()), 1, 2)
+    writer = kmlify.KmzWriter()
+    kmlify.WriteKml(writer, kmlifier.RecordsToKmlElements(records))
+    kml = zipfile.ZipFile(StringIO.StringIO(writer.Close())).read('doc.kml')
+    self.assertTrue(kml.startswith(kmlify.KML_HEADER + '<Document>\n'))
+    self.assertFalse('<name>x0</name>' in kml)
+    self.assertTrue('<Placemark id="1">\n    <name>x1</name>' in kml)
+    self.assertTrue(kml.index('<Placemark') < kml.index('<Style id="style1">'))
+
+  def testRecordsSharedAcrossTemplates(self):
+    data_dir = os.path.join(os.path.dirname(__file__), 'goldentests')
+    csv_data = open(os.path.join(data_dir, 'input1.csv')).read()
+    fetched_urls = []
+    def Fetch(url, **unused_kwargs):
+      fetched_urls.append(url)
+      return UrlResponse(csv_data)
+    self.StubFetch(Fetch)
+
+    params = {'type': 'csv', 'url': 'http://example.com/data.csv',
+              'loc': 'Latitude,Longitude', 'id': '$Id'}
+    response = self.DoGet('/.kmlify?' + urllib.urlencode(
+        dict(params, name='$Name')))
+    kml = zipfile.ZipFile(StringIO.StringIO(response.body)).read('doc.kml')
+    self.assertTrue('<name>Main Elementary</name>' in kml)
+
+    # Another template and page over the same fields reuses the records.
+    response = self.DoGet('/.kmlify?' + urllib.urlencode(
+        dict(params, name='[$Name]', skip=1)))
+    kml = zipfile.ZipFile(StringIO.StringIO(response.body)).read('doc.kml')
+    self.assertFalse('<name>[Main Elementary]</name>' in kml)
+    self.assertTrue('<name>[Main High School]</name>' in kml)
+    self.assertEquals(['http://example.com/data.csv'], fetched_urls)
+
+  def testRecordsSharedAcrossConditions(self):
+    csv_data = 'Name,Kind,Lat,Lon\n' + ''.join(
+        'p%d,%s,%d,%d\n' % (i, 'ab'[i % 2], i, i) for i in range(10))
+    kml_data = '<kml><Document><Style id="s"/>%s</Document></kml>' % ''.join(
+        '<Placemark><name>x%d</name><description>d%d</description>'
+        '<styleUrl>#s</styleUrl><Point><coordinates>%d,%d</coordinates>'
+        '</Point></Placemark>' % (i, i, i, i) for i in range(4))
+    self.StubFetch(lambda url, **kwargs: UrlResponse(
+        kml_data if url.endswith('.kml') else csv_data))
+    parses = []
+    records_from_data = kmlify.Kmlifier.RecordsFromData
+    def RecordsFromData(kmlifier, *args):
+      parses.append(args[1])
+      return records_from_data(kmlifier, *args)
+    self.SetForTest(kmlify.Kmlifier, 'RecordsFromData', RecordsFromData)
+    def GetNames(**params):
+      response = self.DoGet('/.kmlify?' + urllib.urlencode(
+          dict(params, format='geojson')))
+      return [feature['properties']['name']
+              for feature in json.loads(response.body)['features']]
+
+    csv_params = {'type': 'csv', 'url': 'http://example.com/data.csv',
+                  'loc': 'Lat,Lon'}
+    self.assertEquals(['p0', 'p2', 'p4', 'p6', 'p8'],
+                      GetNames(name='$Name', cond='Kind=a', **csv_params))
+    self.assertEquals(['p1/b', 'p3/b', 'p5/b', 'p7/b', 'p9/b'],
+                      GetNames(name='$Name/$Kind', cond='Kind=b', **csv_params))
+    self.assertEquals(['p2', 'p4', 'p6'],
+                      GetNames(name='$Name', cond='Kind=a',
+                               bbox='1.5,1.5,6.5,6.5', **csv_params))
+    self.assertEquals(['csv'], parses)
+    # CSV records keep only the fields in use, so other fields need a parse.
+    self.assertEquals(['a', 'b', 'a'],
+                      GetNames(name='$Kind', limit=3, **csv_params))
+    self.assertEquals(['csv', 'csv'], parses)
+
+    # XML records keep their elements, so other fields can be read later.
+    kml_params = {'type': 'xml', 'url': 'http://example.com/data.kml',
+                  'record': 'Placemark'}
+    self.assertEquals(['x0', 'x1', 'x2', 'x3'],
+                      GetNames(name='$name', **kml_params))
+    self.assertEquals(['d2'], GetNames(name='$description', cond='name=x2',
+                                       **kml_params))
+    self.assertEquals(['csv', 'csv', 'xml'], parses)
+
+  def testRevalidation(self):
+    data_dir = os.path.join(os.path.dirname(__file__), 'goldentests')
+    csv_data = open(os.path.join(data_dir, 'input1.csv')).read()
+    request_headers = []
+    def Fetch(unused_url, headers=None, **unused_kwargs):
+      request_headers.append(headers)
+      if headers.get('If-None-Match') == '"v1"':
+        return UrlResponse('', 304)
+      return UrlResponse(csv_data, headers={'ETag': '"v1"'})
+    self.StubFetch(Fetch)
+
+    self.SetTime(1000)
+    path = '/.kmlify?' + urllib.urlencode({
+        'type': 'csv', 'url': 'http://example.com/data.csv',
+        'loc': 'Latitude,Longitude', 'name': '$Name', 'id': '$Id'})
+    response = self.DoGet(path)
+    self.assertEquals(1, len(request_headers))
+    self.assertFalse('If-None-Match' in request_headers[0])
+
+    # After the TTL, the source is revalidated.  It hasn't changed, so the
+    # cached KMZ should be served without converting the data again.
+    self.SetForTest(kmlify, 'Kmlifier', None)
+    self.SetTime(1000 + kmlify.CACHE_TTL_SECONDS + 1)
+    self.assertEquals(response.body, self.DoGet(path).body)
+    self.assertEquals(2, len(request_headers))
+    self.assertEquals('"v1"', request_headers[1]['If-None-Match'])
+
+    # If the remote server fails, the cached KMZ should also be served.
+    def FailingFetch(unused_url, **unused_kwargs):
+      raise urlfetch.DownloadError('timed out')
+    self.StubFetch(FailingFetch)
+    self.SetTime(1000 + 2 * (kmlify.CACHE_TTL_SECONDS + 1))
+    self.assertEquals(response.body, self.DoGet(path).body)
+
+  def testFailedConversionRetried(self):
+    def Fetch(unused_url, headers=None, **unused_kwargs):
+      if headers.get('If-None-Match') == '"v1"':
+        return UrlResponse('', 304)
+      return UrlResponse('Name,Lat,Lon\na,1,2\n', headers={'ETag': '"v1"'})
+    self.StubFetch(Fetch)
+    def GetRecords(*unused_args):
+      raise ValueError('oops')
+    get_records = kmlify.Kmlifier.GetRecords
+    self.SetForTest(kmlify.Kmlifier, 'GetRecords', GetRecords)
+
+    self.SetTime(1000)
+    path = '/.kmlify?' + urllib.urlencode({
+        'type': 'csv', 'url': 'http://example.com/data.csv',
+        'loc': 'Lat,Lon', 'name': '$Name', 'format': 'geojson'})
+    self.assertTrue('Conversion failed' in self.DoGet(path).body)
+
+    # After the TTL, the conversion is tried again, though the source data
+    # hasn't changed.
+    self.SetForTest(kmlify.Kmlifier, 'GetRecords', get_records)
+    self.SetTime(1000 + kmlify.CACHE_TTL_SECONDS + 1)
+    features = json.loads(self.DoGet(path).body)['features']
+    self.assertEquals(['a'], [f['properties']['name'] for f in features])
+
+  def testGeoJsonOutput(self):
+    data_dir = os.path.join(os.path.dirname(__file__), 'goldentests')
+    for data_type, input_name, params in [
+        ('geojson', 'input2.geojson', {'id': '$id'}),
+        ('csv', 'input1.csv', {'loc': 'Latitude,Longitude', 'name': '$Name',
+                               'desc': '$_Description', 'id': '$Id'}),
+        ('xml', 'input3.kml', {})]:
+      input_data = open(os.path.join(data_dir, input_name)).read()
+      self.StubFetch(lambda url, **kwargs: UrlResponse(input_data))
+      cache.Reset()
+      response = self.DoGet('/.kmlify?' + urllib.urlencode(dict(
+          params, type=data_type, url='http://example.com/' + input_name,
+          format='geojson')))
+      self.assertEquals(kmlify.GEOJSON_CONTENT_TYPE,
+                        response.headers['Content-Type'])
+      output = json.loads(response.body)
+      self.assertEquals('FeatureCollection', output['type'])
+      feature = output['features'][0]
+      if data_type == 'xml':  # KML geometry is converted to GeoJSON
+        self.assertEquals('Polygon', output['features'][1]['geometry']['type'])
+      else:
+        self.assertEquals('1', feature['id'])
+        self.assertEquals('Main Elementary', feature['properties']['name'])
+        self.assertEquals({'type': 'Point', 'coordinates': [78.98, 30.28]},
+                          feature['geometry'])
+
+  def testGridIndex(self):
+    index = kmlify.GridIndex([(0, 0, 1, 1), None, (10, 10, 10, 10),
+                              (170, -5, 179, 5), (-20, -20, 20, 20)])
+    self.assertEquals([0, 4], index.Search((0.5, 0.5, 2, 2)))
+    self.assertEquals([2, 4], index.Search((9, 9, 11, 11)))
+    self.assertEquals([3], index.Search((175, -1, -175, 1)))  # crosses 180
+    self.assertEquals([], index.Search((-90, 30, -80, 40)))
+    self.assertEquals([], kmlify.GridIndex([None]).Search((0, 0, 1, 1)))
+
+  def testSnapBboxToTiles(self):
+    self.assertEquals((-180, -90, 180, 90),
+                      kmlify.SnapBboxToTiles((-1, -1, 1, 1), 1))
+    west, south, east, north = kmlify.SnapBboxToTiles((10, 10, 20, 20), 3)
+    self.assertEquals((0, 45), (west, east))
+    self.assertAlmostEquals(0, south)
+    self.assertAlmostEquals(40.979898, north, places=6)
+
+  def testBbox(self):
+    data_dir = os.path.join(os.path.dirname(__file__), 'goldentests')
+    geojson_data = open(os.path.join(data_dir, 'input2.geojson')).read()
+    self.StubFetch(lambda url, **kwargs: UrlResponse(geojson_data))
+    def GetNames(bbox, zoom=''):
+      response = self.DoGet('/.kmlify?' + urllib.urlencode({
+          'type': 'geojson', 'url': 'http://example.com/data.geojson',
+          'format': 'geojson', 'bbox': bbox, 'zoom': zoom}))
+      return [feature['properties']['name']
+              for feature in json.loads(response.body)['features']]
+
+    self.assertEquals(['Main Elementary'], GetNames('78,30,79,31'))
+    self.assertEquals(['Backup High School'], GetNames('99,-1,103,1'))
+    self.assertEquals([], GetNames('-110,40,-100,41'))
+    # At zoom level 3, the box is expanded to a tile that spans 45 degrees.
+    self.assertEquals(['Main Elementary', 'Main High School'],
+                      GetNames('78,30,79,31', 3))
+    # An invalid box is ignored.
+    self.assertEquals(3, len(GetNames('78,30,79')))
+
+  def testMakeClusters(self):
+    clusters = kmlify.MakeClusters([(10, 10, 10, 10), (10.1, 10.1, 10.1, 10.1),
+                                    None, (0, 0, 1, 1), (50, 50, 50, 50)])
+    self.assertEquals(kmlify.MAX_CLUSTER_ZOOM + 1, len(clusters))
+    [(indices, lon, lat)] = clusters[0]
+    self.assertEquals([0, 1, 4], indices)
+    self.assertAlmostEquals(70.1 / 3, lon)
+    self.assertAlmostEquals(70.1 / 3, lat)
+    self.assertEquals([[0, 1], [4]],
+                      [indices for indices, _, _ in clusters[5]])
+    self.assertEquals([[0], [1], [4]],
+                      [indices for indices, _, _ in clusters[10]])
+
+  def testClustering(self):
+    csv_data = 'Name,Lat,Lon\n' + ''.join(
+        'p%d,%.2f,%.2f\n' % (i, 30 + i * 0.01, -74.5 + i * 0.01)
+        for i in range(100))
+    self.StubFetch(lambda url, **kwargs: UrlResponse(csv_data))
+    records_sets = []
+    records_cache_set = kmlify.RECORDS_CACHE.Set
+    def RecordsCacheSet(key, value, ttl=None):
+      records_sets.append(key)
+      records_cache_set(key, value, ttl)
+    self.SetForTest(kmlify.RECORDS_CACHE, 'Set', RecordsCacheSet)
+    def GetFeatures(zoom, bbox='', cond=''):
+      response = self.DoGet('/.kmlify?' + urllib.urlencode({
+          'type': 'csv', 'url': 'http://example.com/data.csv',
+          'loc': 'Lat,Lon', 'name': '$Name', 'format': 'geojson',
+          'zoom': zoom, 'bbox': bbox, 'cluster': '1', 'cond': cond}))
+      return json.loads(response.body)['features']
+
+    [cluster] = GetFeatures(3)
+    self.assertEquals(100, cluster['properties']['count'])
+    features = GetFeatures(12)
+    self.assertTrue(1 < len(features) < 100)
+    self.assertEquals(100, sum(feature['properties'].get('count', 1)
+                               for feature in features))
+    self.assertEquals(['p%d' % i for i in range(100)],
+                      [f['properties']['name'] for f in GetFeatures(16)])
+
+    # Clusters are made of just the points that meet the conditions.
+    [cluster] = GetFeatures(3, cond='Name<p2')  # p0, p1, p10 to p19
+    self.assertEquals(12, cluster['properties']['count'])
+    lon, lat = cluster['geometry']['coordinates']
+    self.assertAlmostEquals(-74.5 + 146 / 12.0 * 0.01, lon)
+    self.assertAlmostEquals(30 + 146 / 12.0 * 0.01, lat)
+    [feature] = GetFeatures(3, cond='Name=p5')
+    self.assertEquals('p5', feature['properties']['name'])
+
+    # The clusters are cached separately, so the records were set only once.
+    self.assertEquals(1, len(records_sets))
+
+  def testSimplifyLine(self):
+    self.assertEquals(
+        [[0, 0], [2, -0.1], [3, 5], [5, 7]],
+        kmlify.SimplifyLine([[0, 0], [1, 0.1], [2, -0.1], [3, 5], [4, 6],
+                             [5, 7]], 0.5))
+    self.assertEquals([[0, 0], [2, 0]],
+                      kmlify.SimplifyLine([[0, 0], [1, 0], [2, 0]], 0.1))
+
+  def testSimplifyGeometry(self):
+    circle = [[10 * math.cos(i * math.pi / 500),
+               10 * math.sin(i * math.pi / 500)] for i in range(1000)]
+    small_ring = [[0, 0], [0.001, 0], [0.001, 0.001], [0, 0]]
+    geom = {'type': 'Polygon', 'coordinates': [circle + circle[:1], small_ring]}
+    simplified = kmlify.SimplifyGeoJsonGeometry(geom, 0.01)
+    outer, inner = simplified['coordinates']
+    self.assertTrue(10 < len(outer) < 200)
+    self.assertEquals([10, 0], outer[0])
+    self.assertEquals([9.99, 0.44], outer[1])  # rounded to 3 decimal places
+    self.assertEquals(small_ring, inner)  # would collapse, so left as is
+
+    # The same simplification applies to KML geometry.
+    element = kmlify.KmlGeometryFromJson(geom)
+    kmlify.SimplifyKmlGeometry(element, 0.01)
+    self.assertEquals(
+        [len(outer), 4],
+        [len(c.text.split()) for c in element.getiterator('coordinates')])
+
+  def testXmlRecordsAreStreamed(self):
+    kmlifier = kmlify.Kmlifier('http://app.com', '$name', '', [], '')
+    records = kmlifier.RecordsFromXml(
+        '<kml><Placemark><name>a</name><styleUrl>#s</styleUrl></Placemark>'
+        '<Style id="s"/><Placemark><name>b</name></Placemark><broken',
+        'Placemark')
+    # The first record is complete once its shared style has been read,
+    # before the syntax error at the end of the document is reached.
+    record = records.next()
+    self.assertEquals('a', record['name'])
+    self.assertEquals('s', record['__style__'].get('id'))
+    self.assertEquals('b', records.next()['name'])
+    self.assertRaises(SyntaxError, records.next)
+
+  def testXmlGlobalFields(self):
+    kmlifier = kmlify.Kmlifier('http://app.com', '$name ($/title)', '', [], '')
+    records = kmlifier.RecordsFromXml(
+        '<doc><item><name>a</name></item><title>t</title></doc>', 'item')
+    self.assertEquals([{'name': 'a', '/title': 't'}], list(records))
+
+  def testRecordsCachedWhenSomeRead(self):
+    csv_data = 'Name,Lat,Lon\n' + ''.join(
+        'p%d,%d,%d\n' % (i, i, i) for i in range(10))
+    self.StubFetch(lambda url, **kwargs: UrlResponse(csv_data))
+    parses = []
+    records_from_data = kmlify.Kmlifier.RecordsFromData
+    def RecordsFromData(kmlifier, *args):
+      parses.append(args[1])
+      return records_from_data(kmlifier, *args)
+    self.SetForTest(kmlify.Kmlifier, 'RecordsFromData', RecordsFromData)
+    def GetNames(name, limit):
+      response = self.DoGet('/.kmlify?' + urllib.urlencode({
+          'type': 'csv', 'url': 'http://example.com/data.csv',
+          'loc': 'Lat,Lon', 'name': name, 'format': 'geojson',
+          'limit': limit}))
+      return [feature['properties']['name']
+              for feature in json.loads(response.body)['features']]
+
+    # Reading stops after the limit, but all the records are still cached.
+    self.assertEquals(['p0'], GetNames('$Name', 1))
+    self.assertEquals(['[p0]'], GetNames('[$Name]', 1))
+    self.assertEquals(10, len(GetNames('$Name', 100)))
+    self.assertEquals(['csv'], parses)
+
   def testSimpleCsv(self):
     self.DoGoldenFileTest('csv', 'input1.csv', 'output1.kml',
                           {'loc': 'Latitude,Longitude', 'name': '$Name',
@@ -124,7 +568,7 @@ class KmlifyTests(test_utils.BaseTest):
       join_url = url_params['join'].split(',')[1]
       join_data = open(os.path.join(data_dir, join_name)).read()
       responses[join_url] = UrlResponse(join_data)
-    self.mox.stubs.Set(urlfetch, 'fetch', lambda url, **kwargs: responses[url])
+    self.StubFetch(lambda url, **kwargs: responses[url])
 
     # Perform the kmlify request and check the output.
     response = self.DoGet('/.kmlify?' + urllib.urlencode(
@@ -137,12 +581,19 @@ class KmlifyTests(test_utils.BaseTest):
 
     # The content should be cached now, so repeating the request should yield
     # the same result even with urlfetch disabled.
-    self.mox.stubs.Set(urlfetch, 'fetch', lambda url, **kwargs: UrlResponse(''))
+    self.StubFetch(lambda url, **kwargs: UrlResponse(''))
     response2 = self.DoGet('/.kmlify?' + urllib.urlencode(
         dict(url_params, type=input_type, url=url)))
     self.assertEquals(
         response.body, response2.body, "kmlify didn't use cache as expected")
 
+    # A client that already has the content should get a 304 with no body.
+    response3 = self.DoGet(
+        '/.kmlify?' + urllib.urlencode(dict(url_params, type=input_type,
+                                            url=url)),
+        status=304, headers={'If-None-Match': response.headers['ETag']})
+    self.assertEquals('', response3.body)
+
 
 if __name__ == '__main__':
   test_utils.main()
@@ -24,14 +24,15 @@ SWEEP_INTERVAL_SECONDS = 60
 class _CacheEntry(object):
   """Entry to be stored in LocalCache."""
 
-  def __init__(self, value, expiry):
-    """Cache Entry."""
-    self._value = copy.deepcopy(value)
+  def __init__(self, value, expiry, copy_value=True):
+    """Cache Entry.  Deep-copies the value unless copy_value is False."""
+    self._copy_value = copy_value
+    self._value = copy.deepcopy(value) if copy_value else value
     self._expiry = expiry
 
   @property
   def value(self):
-    return copy.deepcopy(self._value)
+    return copy.deepcopy(self._value) if self._copy_value else self._value
 
   @property
   def expiry(self):
@@ -97,7 +98,7 @@ class LocalCache(object):
       return v.value
     return None
 
-  def Set(self, key, value, ttl=None, expiry=None):
+  def Set(self, key, value, ttl=None, expiry=None, copy_value=True):
     """Set the key/value pair with the specified expiry.
 
     The ttl and expiry are mutually exclusive. If you use neither, the cache
@@ -108,6 +109,9 @@ class LocalCache(object):
       value: The value to store in the cache.  Must be picklable.
       ttl: How long to keep this value, relative time in seconds.
       expiry: When to expiry this value, absolute timestamp in seconds.
+      copy_value: If False, keep the value itself instead of a deep copy, and
+          return it from Get() without copying it.  Use this only for values
+          that are never modified once they are set.
     Returns:
       True if it was stored, False otherwise.
     Raises:
@@ -123,7 +127,7 @@ class LocalCache(object):
         ttl = self._ttl
       expiry = ttl + now if ttl > 0 else 0
     if expiry == 0 or now < expiry:
-      self._cache[key] = _CacheEntry(value, expiry)
+      self._cache[key] = _CacheEntry(value, expiry, copy_value)
       self._Sweep()
       return True
     return False
@@ -17,6 +17,7 @@ import json
 import urllib
 
 import base_handler
+import card
 import config
 import model
 import perms
@@ -283,11 +284,19 @@ class _MapReview(base_handler.BaseHandler):
     to_downvote = self.request.get_all('downvote')
     to_upvote = self.request.get_all('upvote')
 
-    model.CrowdReport.MarkAsReviewed(to_accept + to_downvote + to_upvote)
+    reports = {report.id: report for report in
+               model.CrowdReport.MarkAsReviewed(
+                   to_accept + to_downvote + to_upvote)}
     for report_id in to_downvote:
-      model.CrowdVote.Put(report_id, self.GetCurrentUserUrl(), 'REVIEWER_DOWN')
+      reports[report_id] = model.CrowdVote.Put(
+          report_id, self.GetCurrentUserUrl(), 'REVIEWER_DOWN')
     for report_id in to_upvote:
-      model.CrowdVote.Put(report_id, self.GetCurrentUserUrl(), 'REVIEWER_UP')
+      reports[report_id] = model.CrowdVote.Put(
+          report_id, self.GetCurrentUserUrl(), 'REVIEWER_UP')
+    # Update the cached answers only after all the writes are done.
+    for report in reports.values():
+      if report:
+        card.UpdateReportCache(report)
 
     self.redirect(self._GetUrl())
 
@@ -15,6 +15,7 @@ __author__ = 'shakusa@google.com (Steve Hakusa)'
 
 import urllib
 
+import card
 import map_review
 import model
 import perms
@@ -240,6 +241,24 @@ class MapReviewTest(test_utils.BaseTest):
       self.assertFalse(self.cr1.id in response.body)
       self.assertFalse(self.cr2.id in response.body)
 
+  def testPostUpdatesReportCache(self):
+    key = [self.map_id, 'shelter', card.RoundGeoPt(model.NOWHERE)]
+    card.REPORT_CACHE.Set(key, ({}, {}, []))
+
+    # Reviewing a report should bring the cached answers up to date.
+    with test_utils.Login('reviewer'):
+      self.DoPost('/.maps/%s/review' % self.map_id,
+                  'xsrf_token=XSRF&accept=%s' % self.cr1.id)
+    self.assertEquals({'q1': 'y', 'q3': 26, 'q4': '555-1234',
+                       '_text': '26 beds here'},
+                      card.REPORT_CACHE.Get(key)[0])
+
+    # A reviewer downvote hides the report, which drops the cached answers.
+    with test_utils.Login('reviewer'):
+      self.DoPost('/.maps/%s/review' % self.map_id,
+                  'xsrf_token=XSRF&downvote=%s' % self.cr1.id)
+    self.assertEquals(None, card.REPORT_CACHE.Get(key))
+
   def testGetWithInvalidQuestionAnswer(self):
     q_invalid_id = '%s.water.qINVALID' % self.map_id
     cr_bad_question = test_utils.NewCrowdReport(author='http://foo.com/abc',
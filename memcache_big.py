@@ -76,6 +76,30 @@ def get(key):
     return None
 
 
+def get_multi(keys):
+  """Like memcache.get_multi but supports values > 1mb."""
+  values = memcache.get_multi(keys, namespace=_NAMESPACE)
+  # Get the remaining chunks of all the chunked values in one more call.
+  remain_keys = {}
+  for key, value in values.items():
+    if isinstance(value, _CacheEntry):
+      remain_keys[key] = _keys(key, value.num_chunks, value.rand)[1:]
+  remain = remain_keys and memcache.get_multi(
+      sum(remain_keys.values(), []), namespace=_NAMESPACE)
+  results = {}
+  for key, value in values.items():
+    if key in remain_keys:
+      if not all(k in remain for k in remain_keys[key]):
+        continue  # a chunk is missing; treat it as a cache miss
+      value = ''.join([value.value] + [remain[k] for k in remain_keys[key]])
+    try:
+      results[key] = pickle.loads(value)
+    except Exception:  # pylint:disable=broad-except
+      logging.exception('Failed to unpickle value for key: %s, pickled len: %s',
+                        key, len(value))
+  return results
+
+
 def delete(key):
   """Like memcache.delete but supports values > 1mb."""
   # Only delete the first. The rest will get cleaned up implicitly
@@ -89,6 +113,15 @@ def set(key, value, time=0):  # pylint:disable=redefined-builtin
   return not not_set  # ie True if the list is empty.
 
 
+def set_multi(mapping, time=0):
+  """Like memcache.set_multi but supports values > 1mb."""
+  chunks = {}
+  for key, value in mapping.items():
+    chunks.update(_chunks(key, value))
+  not_set = memcache.set_multi(chunks, time=time, namespace=_NAMESPACE)
+  return [key for key in mapping if key in not_set]
+
+
 def add(key, value, time=0):
   """Like memcache.add but supports values > 1mb."""
   chunks = _chunks(key, value)
@@ -96,6 +129,15 @@ def add(key, value, time=0):
   return key not in not_added
 
 
+def add_multi(mapping, time=0):
+  """Like memcache.add_multi but supports values > 1mb."""
+  chunks = {}
+  for key, value in mapping.items():
+    chunks.update(_chunks(key, value))
+  not_added = memcache.add_multi(chunks, time=time, namespace=_NAMESPACE)
+  return [key for key in mapping if key in not_added]
+
+
 def flush_all():
   """Deletes everything in memcache."""
   return memcache.flush_all()
@@ -103,7 +145,7 @@ def flush_all():
 
 def _chunks(key, value):
   """Return a k,v pairing of chunks."""
-  value = pickle.dumps(value)
+  value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
   if len(value) < _CHUNK_SIZE_BYTES:
     return {key: value}
 
@@ -74,16 +74,25 @@ def ActivateSources(sources):
   # To avoid hitting memcache N times for each pageview of an N-layer map, we
   # skip activation if the same set of layers has been activated recently.
   if ACTIVATE_CACHE.Add(sources, 1):
+    addresses = sorted(set(sources))
+    # Set all the flags that aren't set yet in one memcache call.
+    already_active = set(ACTIVE_CACHE.AddMulti(
+        [(address, 1) for address in addresses]))
+    if already_active:  # Extend the lifetime of the existing active flags.
+      ACTIVE_CACHE.SetMulti([(address, 1) for address in already_active])
+    addresses = [a for a in addresses if a not in already_active]
+
     num_fetches = {}  # number of fetches, keyed by hostname
-    for address in sources:
-      if ACTIVE_CACHE.Add(address, 1):
-        logging.info('Activating layer: ' + address)
-        hostname = maproot.GetHostnameForSource(address)
-        num_fetches[hostname] = num_fetches.get(hostname, 0) + 1
-        # Spread out the fetches to each origin server.  It's more polite.
-        metadata_fetch.ScheduleFetch(address, num_fetches[hostname] * 0.25)
-      else:  # Extend the lifetime of the existing active flag.
-        ACTIVE_CACHE.Set(address, 1)
+    countdowns = {}
+    for address in addresses:
+      logging.info('Activating layer: ' + address)
+      hostname = maproot.GetHostnameForSource(address)
+      num_fetches[hostname] = num_fetches.get(hostname, 0) + 1
+      # Spread out the fetches to each origin server.  It's more polite.
+      countdowns[address] = num_fetches[hostname] * 0.25
+    if addresses:
+      metadata_fetch.ScheduleFetches(
+          dict(zip(addresses, METADATA_CACHE.GetMulti(addresses))), countdowns)
 
 
 class Metadata(base_handler.BaseHandler):
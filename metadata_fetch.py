@@ -60,12 +60,20 @@ Tasks to fetch metadata are queued as follows:
     metadata_fetch.py task runs, it fetches the metadata and then queues the
     next metadata_fetch.py task for that source if the source is still active.
     It chooses a task frequency depending on the size of the fetch (big files
-    are fetched less often, to keep from overusing bandwidth).
+    are fetched less often, to keep from overusing bandwidth), and delays the
+    task further if the overall budget of fetches for that time is used up.
 
   - Adding or editing layers can cause metadata_model.js to query metadata.py
     to ask about sources that weren't delivered with the original map.  This
     also invokes ActivateSources to activate the requested sources.
 
+  - When the 'metadata_batch_fetch' config setting is true, the tasks go into
+    a pull queue instead, and a cron job (MetadataFetchBatch) leases the due
+    tasks in batches.  The fetches in a batch run concurrently, the results
+    are written to memcache in chunks, and the next tasks for each chunk of
+    sources are queued together.  This takes far fewer requests and instance
+    hours than running one task per fetch when there are many active sources.
+
 Metadata is stored in memcache as a dictionary with these keys, and sent to the
 browser as JSON.  'fetch_time' is always present; all other fields are optional.
 
@@ -84,6 +92,9 @@ browser as JSON.  'fetch_time' is always present; all other fields are optional.
         'update_time' field typically conveys the same information, but could
         differ if e.g. the content itself contains a more accurate update time.
   - 'fetch_etag': "Etag" header string from the server.
+  - 'fetch_unchanged_count': The number of consecutive fetches, up to and
+        including the last one, that found the source data unchanged (a 304
+        response or the same MD5 hash).  Absent if the data just changed.
 
 All other fields tell us about the source data itself:
   - 'update_time': Last update time of source data (seconds since the epoch).
@@ -99,23 +110,27 @@ All other fields tell us about the source data itself:
 __author__ = 'cimamoglu@google.com (Cihat Imamoglu)'
 
 import calendar
+import collections
 import datetime
 import email.utils
 import hashlib
 import json
 import logging
 import re
+import struct
 import StringIO
 import time
-import xml.etree.ElementTree
 import zipfile
 
 import base_handler
 import cache
 import config
 import maproot
+import xml_utils
 
 from google.appengine import runtime
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.api import urlfetch
 from google.appengine.ext import db
@@ -134,6 +149,27 @@ ACTIVE_CACHE = cache.Cache('metadata.active', 24 * 3600)
 # length in bytes and add 50000 to account for request setup and HTTP headers.
 HTTP_FIXED_COST = 50000
 
+# Fetches are paced so that any window of this length gets at most a budget
+# of bytes and fetches overall, and of fetches to each host; see
+# ReserveFetchSlot.  This cache is only used to produce the keys of the
+# next free times, which are updated directly with memcache compare-and-set.
+FETCH_SLOT_SECONDS = 10
+FETCH_SLOT_CACHE = cache.Cache('metadata.slot', 24 * 3600)
+
+# The number of compare-and-set attempts to make when reserving fetch slots.
+# If they all lose races with other requests, the fetches are not delayed.
+MAX_RESERVE_ATTEMPTS = 3
+
+# In batch mode (see MetadataFetchBatch), fetch tasks are queued in this pull
+# queue, and each request leases up to MAX_BATCH_SIZE of them at a time for
+# BATCH_LEASE_SECONDS, until BATCH_SECONDS have passed or no tasks are due.
+# The results are written to the cache in chunks of BATCH_WRITE_SIZE.
+BATCH_QUEUE = 'metadata-batch'
+MAX_BATCH_SIZE = 100
+BATCH_LEASE_SECONDS = 600
+BATCH_SECONDS = 50
+BATCH_WRITE_SIZE = 10
+
 # Limitations of KML support in the Maps API's KmlLayer, documented at:
 #     https://developers.google.com/kml/documentation/kmlelementsinmaps
 #     https://developers.google.com/kml/documentation/mapsSupport
@@ -157,9 +193,18 @@ KML_SUPPORTED_TAGS = {
     'viewRefreshTime', 'visibility', 'w', 'west', 'width', 'x', 'y'
 }
 
-# Keep at most 7 days of MetadataFetchLog entries.
+# Keep at most 7 days of MetadataFetchLog and MetadataFetchRollup entries.
 METADATA_FETCH_LOG_TTL = datetime.timedelta(days=7)
 
+# Each fetch in a MetadataFetchRollup is packed into a record of this format:
+# fetch time (seconds since the epoch), HTTP status, fetch length, and the
+# first 4 bytes of the MD5 hash.  A status or length of -1 means unknown.
+FETCH_ROLLUP_RECORD = struct.Struct('<Ihi4s')
+
+# The most rollups to update in one transaction (the limit on the number of
+# entity groups in a cross-group transaction).
+MAX_ROLLUPS_PER_TRANSACTION = 25
+
 
 class MetadataFetchLog(db.Model):
   """Just a log of fetches.  The metadata we actually use is in memcache."""
@@ -193,6 +238,101 @@ class MetadataFetchLog(db.Model):
       logging.exception(e)
 
 
+class MetadataFetchRollup(db.Model):
+  """A compact log of all the fetches of one source in one hour.
+
+  This takes far fewer datastore writes and deletes than MetadataFetchLog,
+  which stores an indexed entity for every fetch.  Enable it by setting the
+  'metadata_fetch_log_rollups' config setting to true.
+  """
+  address = db.StringProperty(indexed=False)
+  hostname = db.StringProperty(indexed=False)
+  hour_time = db.DateTimeProperty()  # start of the hour, for cleanup
+  records = db.BlobProperty()  # concatenated FETCH_ROLLUP_RECORD records
+
+  @staticmethod
+  def GetKeyName(address, hour):
+    """Gets the key name for a source and an hour (seconds since the epoch)."""
+    return '%d:%s' % (hour, hashlib.md5(address).hexdigest())
+
+  @staticmethod
+  def Log(entries):
+    """Adds fetches to their rollups.  Guaranteed not to raise an exception.
+
+    Args:
+      entries: A list of (address, metadata) pairs, one for each fetch.  The
+          fetches are added in transactions (cross-group when there is more
+          than one rollup), each of which makes one datastore get and one
+          datastore put for up to MAX_ROLLUPS_PER_TRANSACTION rollups.
+    """
+    try:
+      new_records = {}  # (address, hour) -> list of packed records
+      for address, metadata in entries:
+        md5_hash = metadata.get('md5_hash') or '00000000'
+        new_records.setdefault(
+            (address, int(metadata['fetch_time']) // 3600 * 3600), []).append(
+                FETCH_ROLLUP_RECORD.pack(
+                    int(metadata['fetch_time']),
+                    metadata.get('fetch_status', -1),
+                    int(metadata.get('fetch_length', -1)),
+                    md5_hash[:8].decode('hex')))
+    except Exception, e:  # pylint: disable=broad-except
+      logging.exception(e)
+      return
+
+    def AppendRecords(keys):
+      rollups = MetadataFetchRollup.get_by_key_name(
+          [MetadataFetchRollup.GetKeyName(*key) for key in keys])
+      for i, (address, hour) in enumerate(keys):
+        rollups[i] = rollups[i] or MetadataFetchRollup(
+            key_name=MetadataFetchRollup.GetKeyName(address, hour),
+            address=address,
+            hostname=maproot.GetHostnameForSource(address),
+            hour_time=datetime.datetime.utcfromtimestamp(hour))
+        rollups[i].records = db.Blob(
+            (rollups[i].records or '') + ''.join(new_records[address, hour]))
+      db.put(rollups)
+
+    # Each rollup is its own entity group, and the transaction keeps appends
+    # by concurrent requests from overwriting each other.
+    keys = sorted(new_records)
+    for i in range(0, len(keys), MAX_ROLLUPS_PER_TRANSACTION):
+      group = keys[i:i + MAX_ROLLUPS_PER_TRANSACTION]
+      try:
+        db.run_in_transaction_options(
+            db.create_transaction_options(xg=len(group) > 1),
+            AppendRecords, group)
+      except Exception, e:  # pylint: disable=broad-except
+        logging.exception(e)
+
+  def GetFetches(self):
+    """Unpacks the records into a list of dictionaries, in order of logging."""
+    size = FETCH_ROLLUP_RECORD.size
+    fetches = []
+    for i in range(0, len(self.records or ''), size):
+      fetch_time, status, length, md5_prefix = FETCH_ROLLUP_RECORD.unpack(
+          self.records[i:i + size])
+      fetches.append({'fetch_time': fetch_time, 'fetch_status': status,
+                      'fetch_length': length,
+                      'md5_prefix': md5_prefix.encode('hex')})
+    return fetches
+
+
+def LogFetches(metadata_by_address):
+  """Logs fetches in the logs enabled by the config settings.
+
+  Args:
+    metadata_by_address: A dictionary of the metadata produced by each fetch,
+        keyed by source address.
+  """
+  entries = sorted(metadata_by_address.items())
+  if config.Get('metadata_fetch_log'):
+    for address, metadata in entries:
+      MetadataFetchLog.Log(address, metadata)
+  if config.Get('metadata_fetch_log_rollups'):
+    MetadataFetchRollup.Log(entries)
+
+
 def HasXmlResponse(layer_type):
   """Returns true if the expected metadata response for this layer type is XML.
 
@@ -207,6 +347,29 @@ def HasXmlResponse(layer_type):
                         maproot.LayerType.WMS]
 
 
+def OpenKml(content):
+  """Opens the KML content in a string, unzipping a KMZ archive if necessary.
+
+  Args:
+    content: A string containing the data from a KML or KMZ file.
+
+  Returns:
+    If the data is in zip format: a file-like object that unpacks the doc.kml
+    file or the first .kml file present as it is read, or None if there is no
+    .kml file in the zip archive.  Otherwise, a file-like object that reads
+    the content itself.
+  """
+  try:
+    archive = zipfile.ZipFile(StringIO.StringIO(content))
+  except zipfile.BadZipfile:
+    return StringIO.StringIO(content)  # not a zip archive
+  names = archive.namelist()
+  # Look for doc.kml, then for the first .kml file.
+  for name in ['doc.kml'] + [name for name in names if name.endswith('.kml')]:
+    if name in names:
+      return archive.open(name)
+
+
 def GetKml(content):
   """Gets the KML content from a string, unzipping a KMZ archive if necessary.
 
@@ -218,37 +381,78 @@ def GetKml(content):
     file or the first .kml file present, or None if there is no .kml file in
     the zip archive.  Otherwise, just returns the content itself.
   """
-  try:
-    archive = zipfile.ZipFile(StringIO.StringIO(content))
-  except zipfile.BadZipfile:
-    return content  # not a zip archive
-  try:
-    return archive.read('doc.kml')
-  except KeyError:
-    for name in archive.namelist():  # look for first .kml file
-      if name.endswith('.kml'):
-        return archive.read(name)
+  kml = OpenKml(content)
+  return kml.read() if kml else None
+
+
+def ScanXml(content, keep_tag=None):
+  """Counts the tags in an XML document in one incremental pass.
 
+  To keep memory use low, a KMZ archive is unpacked as it is parsed, and each
+  element is discarded as soon as it has been parsed, except for the first
+  child of the root element that has the tag keep_tag.
 
-def ParseXml(content):
-  """Parses an XML string into an xml.etree.ElementTree.Element object."""
+  Args:
+    content: A string containing an XML document or a KMZ archive (which is
+        unpacked as by GetKml).
+    keep_tag: Optional.  The tag of the child of the root element to keep.
+
+  Returns:
+    A pair (tag_counts, root_element), where tag_counts is a Counter of all
+    the tags (without XML namespaces) in the document, and root_element is
+    the root of the document, containing only the kept child (if any).
+
+  Raises:
+    ValueError: The document is not well-formed XML.
+  """
   try:
-    return xml.etree.ElementTree.XML(content)
-  except xml.etree.ElementTree.ParseError:
+    return ScanXmlFile(OpenKml(content) or StringIO.StringIO(''), keep_tag)
+  except xml_utils.ElementTree.ParseError:
     # When an XML string says it's UTF-8 but actually isn't, try assuming that
     # it's Latin-1.  This matches the behaviour of google.maps.KmlLayer, so that
     # the metadata is consistent with what is displayed on the map.
+    content = GetKml(content) or ''
     try:
-      return xml.etree.ElementTree.XML(
+      return ScanXmlFile(StringIO.StringIO(
           '<?xml version="1.0" encoding="latin-1"?>' +
-          re.sub(r'^\s*<\?xml[^>]*\?>', '', content))
-    except xml.etree.ElementTree.ParseError:
+          re.sub(r'^\s*<\?xml[^>]*\?>', '', content)), keep_tag)
+    except xml_utils.ElementTree.ParseError:
       raise ValueError('Not well-formed XML')
 
 
-def GetAllXmlTags(root_element):
-  """Gets a list of all tags (without XML namespaces) in an XML tree."""
-  return [element.tag.split('}')[-1] for element in root_element.getiterator()]
+def ScanXmlFile(fileobj, keep_tag=None):
+  """Does the work of ScanXml on a file-like object.
+
+  Args:
+    fileobj: A file-like object containing an XML document.
+    keep_tag: Optional.  The tag of the child of the root element to keep.
+
+  Returns:
+    A pair (tag_counts, root_element), as for ScanXml.
+
+  Raises:
+    ParseError: The document is not well-formed XML.
+  """
+  tag_counts = collections.Counter()
+  root_element = kept_element = None
+  keeping = False  # True while parsing inside the kept element
+  ancestors = []
+  for event, element in xml_utils.IterParse(fileobj, ('start', 'end')):
+    if event == 'start':
+      if not ancestors:
+        root_element = element
+      elif (keep_tag and kept_element is None and len(ancestors) == 1 and
+            element.tag == keep_tag):
+        kept_element, keeping = element, True
+      ancestors.append(element)
+    else:
+      ancestors.pop()
+      tag_counts[element.tag.split('}')[-1]] += 1
+      if keeping:
+        keeping = element is not kept_element
+      elif ancestors:
+        ancestors[-1].remove(element)  # done with this element; discard it
+  return tag_counts, root_element
 
 
 def GetWmsLayerMetadata(root_element):
@@ -295,22 +499,21 @@ def GetWmsLayerMetadata(root_element):
   return layer_metadata
 
 
-def HasUnsupportedKml(root_element):
+def HasUnsupportedKml(tag_counts):
   """Checks whether a KML file has any features unsupported by the Maps API.
 
   This method does not perform full checking; for example, it does not check
   whether KML files referenced in NetworkLinks contain unsupported features.
 
   Args:
-    root_element: An XML Element object containing the parsed file.
+    tag_counts: A Counter of the tags in the file, as produced by ScanXml.
 
   Returns:
     True if there are any unsupported features found in the KML file.
   """
-  tags = GetAllXmlTags(root_element)
-  return (tags.count('Placemark') > KML_MAX_FEATURES or
-          tags.count('NetworkLink') > KML_MAX_NETWORK_LINKS or
-          not KML_SUPPORTED_TAGS.issuperset(tags))
+  return (tag_counts['Placemark'] > KML_MAX_FEATURES or
+          tag_counts['NetworkLink'] > KML_MAX_NETWORK_LINKS or
+          not KML_SUPPORTED_TAGS.issuperset(tag_counts))
 
 
 def GatherMetadata(layer_type, response):
@@ -340,64 +543,130 @@ def GatherMetadata(layer_type, response):
     metadata['fetch_etag'] = response.headers['Etag']
 
   if HasXmlResponse(layer_type):
-    content = GetKml(response.content) or ''  # unpack KMZ if necessary
     try:
-      root_element = ParseXml(content)
+      # Only the <Capability> element of a WMS response is needed in full.
+      tags, root_element = ScanXml(
+          response.content,
+          'Capability' if layer_type == maproot.LayerType.WMS else None)
     except ValueError:
       logging.warn('Content is not valid XML')
       metadata['ill_formed'] = True
       return metadata
 
-    tags = GetAllXmlTags(root_element)
-
     if layer_type == maproot.LayerType.KML:
       # TODO(cimamoglu): Look for placemarks within network links.
-      if not set(tags) & {'Placemark', 'NetworkLink', 'GroundOverlay'}:
+      if not (tags['Placemark'] or tags['NetworkLink'] or
+              tags['GroundOverlay']):
         metadata['has_no_features'] = True
-      if set(tags) & {'NetworkLink', 'GroundOverlay'}:
+      if tags['NetworkLink'] or tags['GroundOverlay']:
         if 'update_time' in metadata:
           del metadata['update_time']  # we don't know the actual update time
-      if HasUnsupportedKml(root_element):
+      if HasUnsupportedKml(tags):
         metadata['has_unsupported_kml'] = True
 
     if layer_type == maproot.LayerType.GEORSS:
       # GEORSS layers actually accept both Atom and GeoRSS feeds, so we need
       # to check for <entry> elements (Atom) as well as <item> elements (RSS).
-      if not set(tags) & {'entry', 'item'}:
+      if not (tags['entry'] or tags['item']):
         metadata['has_no_features'] = True
 
     if layer_type == maproot.LayerType.WMS:
-      metadata['wms_layers'] = GetWmsLayerMetadata(root_element)
+      # Skip the search for layers if there are no bounding boxes to find.
+      metadata['wms_layers'] = tags['LatLonBoundingBox'] and (
+          GetWmsLayerMetadata(root_element)) or {}
 
   return metadata
 
 
-def FetchAndUpdateMetadata(metadata, address):
-  """Fetches a layer and produces an updated metadata dictionary for the layer.
+def GetFetchRequest(metadata, address):
+  """Determines the URL and headers with which to fetch a source.
 
   Args:
     metadata: The current metadata dictionary associated with the URL, or None.
     address: The source address, a string in the form "<type>:<url>".
 
   Returns:
-    The new metadata dictionary (without 'fetch_time'; the caller must set it).
+    A (url, headers) pair, or None if the address is not fetchable.
   """
   if ':' not in address:
-    return {'fetch_impossible': True}
+    return None
   layer_type, url = address.split(':', 1)
   headers = {}
   if metadata and 'fetch_etag' in metadata:
     headers['If-none-match'] = metadata['fetch_etag']
   elif metadata and 'fetch_last_modified' in metadata:
     headers['If-modified-since'] = metadata['fetch_last_modified']
+  if layer_type == maproot.LayerType.WMS:
+    url = '%s?service=WMS&version=1.1.1&request=GetCapabilities' % url
+  return url, headers
+
+
+def FetchAndUpdateMetadata(metadata, address):
+  """Fetches a layer and produces an updated metadata dictionary for the layer.
+
+  Args:
+    metadata: The current metadata dictionary associated with the URL, or None.
+    address: The source address, a string in the form "<type>:<url>".
+
+  Returns:
+    The new metadata dictionary (without 'fetch_time'; the caller must set it).
+  """
+  request = GetFetchRequest(metadata, address)
+  if not request:
+    return {'fetch_impossible': True}
+  url, headers = request
+  return UpdateMetadataFromFetch(metadata, address, lambda: urlfetch.fetch(
+      url, headers=headers, deadline=MAX_FETCH_SECONDS))
+
+
+def StartFetch(metadata, address):
+  """Starts fetching a layer asynchronously.
+
+  Args:
+    metadata: The current metadata dictionary associated with the URL, or None.
+    address: The source address, a string in the form "<type>:<url>".
+
+  Returns:
+    A pair (rpc, finish), where rpc is the urlfetch RPC, or None if the fetch
+    couldn't be started, and finish is a function that waits for the fetch to
+    finish and returns the new metadata dictionary (without 'fetch_time'; the
+    caller must set it).
+  """
+  request = GetFetchRequest(metadata, address)
+  if not request:
+    return None, lambda: {'fetch_impossible': True}
+  url, headers = request
+  rpc = urlfetch.create_rpc(deadline=MAX_FETCH_SECONDS)
   try:
-    if layer_type == maproot.LayerType.WMS:
-      response = urlfetch.fetch(
-          '%s?service=WMS&version=1.1.1&request=GetCapabilities' % url,
-          headers=headers, deadline=MAX_FETCH_SECONDS)
-    else:
-      response = urlfetch.fetch(url, headers=headers,
-                                deadline=MAX_FETCH_SECONDS)
+    urlfetch.make_fetch_call(rpc, url, headers=headers)
+  except urlfetch.Error, e:  # e.g. InvalidURLError is raised immediately
+    error = e
+    def RaiseError():
+      raise error
+    return None, lambda: UpdateMetadataFromFetch(metadata, address, RaiseError)
+  return rpc, lambda: UpdateMetadataFromFetch(metadata, address, rpc.get_result)
+
+
+def WaitForAnyFetch(rpcs):
+  """Waits for any of a list of urlfetch RPCs to finish, and returns it."""
+  return apiproxy_stub_map.UserRPC.wait_any(rpcs)
+
+
+def UpdateMetadataFromFetch(metadata, address, get_response):
+  """Produces an updated metadata dictionary from the outcome of a fetch.
+
+  Args:
+    metadata: The current metadata dictionary associated with the URL, or None.
+    address: The source address, a string in the form "<type>:<url>".
+    get_response: A function that returns the urlfetch Response for the
+        fetch, or raises a urlfetch.Error if the fetch failed.
+
+  Returns:
+    The new metadata dictionary (without 'fetch_time'; the caller must set it).
+  """
+  layer_type = address.split(':', 1)[0]
+  try:
+    response = get_response()
   except urlfetch.Error, e:
     logging.warn('%r from urlfetch for source: %s', e, address)
     if isinstance(e, urlfetch.InvalidURLError):
@@ -406,16 +675,26 @@ def FetchAndUpdateMetadata(metadata, address):
       return {'fetch_error_occurred': True, 'fetch_length': 32e6}
     return {'fetch_error_occurred': True}
   logging.info('HTTP status %d for source: %s', response.status_code, address)
+  unchanged_count = (metadata or {}).get('fetch_unchanged_count', 0) + 1
   if response.status_code == 304:  # not modified
-    return dict(metadata, fetch_status=304, fetch_length=len(response.content))
+    return dict(metadata, fetch_status=304, fetch_length=len(response.content),
+                fetch_unchanged_count=unchanged_count)
   if response.status_code == 200:  # success
-    return GatherMetadata(layer_type, response)
+    new_metadata = GatherMetadata(layer_type, response)
+    if metadata and metadata.get('md5_hash') == new_metadata['md5_hash']:
+      new_metadata['fetch_unchanged_count'] = unchanged_count
+    return new_metadata
   return {'fetch_status': response.status_code, 'fetch_error_occurred': True}
 
 
 def DetermineFetchInterval(metadata):
-  """Decides how long to wait before fetching a layer's data again."""
-  # TODO(kpy): Add overall rate-limiting (total bandwidth across all sources).
+  """Decides how long to wait before fetching a layer's data again.
+
+  This only considers the source itself; ScheduleFetch also applies limits
+  on the overall bandwidth across all sources.  The interval grows while the
+  source stays unchanged, and drops back as soon as it changes, so that stable
+  sources are fetched less often without making changing sources staler.
+  """
   # By default, fetch each source at most once per minute.
   min_interval = config.Get('metadata_min_interval_seconds', 60)
   # By default, on failure, wait at least 10 minutes before trying again.
@@ -425,17 +704,177 @@ def DetermineFetchInterval(metadata):
   max_interval = config.Get('metadata_max_interval_hours', 24) * 3600
   # By default, limit fetch bandwidth to 50 megabytes per day per source.
   mb_per_day = config.Get('metadata_max_megabytes_per_day_per_source', 50)
+  # By default, back off to at most 16 times the usual interval.
+  max_backoff = config.Get('metadata_max_backoff_factor', 16)
 
   # Estimate interval based on a metric of cost expended by the remote server.
   fetch_cost = HTTP_FIXED_COST + metadata.get('fetch_length', 0)
   interval = int(fetch_cost / (max(mb_per_day, 0.001) * 1e6 / 24 / 3600))
 
+  # Double the interval for each fetch in a row that found no change.
+  interval = max(min_interval, interval) * min(
+      max_backoff, 2 ** metadata.get('fetch_unchanged_count', 0))
+
   # Also keep the interval within our minimum and maximum bounds.
   min_seconds = (metadata.get('fetch_error_occurred') and
                  min_interval_after_error or min_interval)
   return max(min_seconds, min(max_interval, interval))
 
 
+def ReserveFetchSlot(hostname, cost, earliest_time):
+  """Reserves room for a fetch at the first time that has enough budget left.
+
+  Each budget (bytes and fetches across all sources, and fetches to each
+  host) has a next free time in memcache: the time up to which its capacity
+  has been reserved.  A fetch may start when reserving its share of every
+  budget leaves that budget no more than FETCH_SLOT_SECONDS ahead of the
+  start, so each budget allows a burst of one slot's worth and then a steady
+  rate.  This keeps the overall fetch load smooth and bounded no matter how
+  many sources are active, with one memcache read and write per budget.
+
+  Args:
+    hostname: The hostname of the remote server, or None.
+    cost: The estimated cost of the fetch, in bytes.
+    earliest_time: The earliest time at which the fetch should run.
+
+  Returns:
+    The number of seconds by which to delay the fetch past earliest_time.
+  """
+  return ReserveFetchSlots([(hostname, cost, earliest_time)])[0]
+
+
+def ReserveFetchSlots(fetches):
+  """Reserves room for many fetches at once, as ReserveFetchSlot does.
+
+  Each budget's next free time is read and written once for all the fetches,
+  with one get_multi() and one cas_multi() (or add_multi() for budgets not
+  yet in memcache) per attempt.  Only the budgets that lost a race with
+  another request are tried again.
+
+  Args:
+    fetches: A list of (hostname, cost, earliest_time) triples.
+
+  Returns:
+    A list of the number of seconds by which to delay each fetch past its
+    earliest_time, in the same order as the fetches.
+  """
+  if not fetches:
+    return []
+  # By default, start at most 5 megabytes and 10 fetches per second overall,
+  # and 2 fetches per FETCH_SLOT_SECONDS to each host.  These are all rates:
+  # how many fetches to a host run at once is up to the caller.
+  max_bytes = config.Get('metadata_max_megabytes_per_second', 5) * 1e6
+  max_fetches = config.Get('metadata_max_fetches_per_second', 10)
+  max_host_fetches = config.Get('metadata_max_fetches_per_slot_per_host', 2)
+
+  # The fetches that use each budget, with the seconds of its capacity that
+  # each one takes up, in order.
+  uses = {}
+  for i, (hostname, cost, _) in enumerate(fetches):
+    for key, seconds in [
+        (['bytes'], cost / max(max_bytes, 1.0)),
+        (['fetches'], 1.0 / max(max_fetches, 0.001)),
+        (['host', hostname], FETCH_SLOT_SECONDS / max(max_host_fetches, 1.0))]:
+      uses.setdefault(FETCH_SLOT_CACHE.KeyToJson(key), []).append((i, seconds))
+
+  delays = [0] * len(fetches)
+  client = memcache.Client()
+  keys = sorted(uses)
+  for _ in range(MAX_RESERVE_ATTEMPTS):
+    old_times = client.get_multi(keys, for_cas=True)
+    new_times, key_delays = {}, {}
+    for key in keys:
+      next_free = old_times.get(key, 0)
+      for i, seconds in uses[key]:
+        earliest_time = fetches[i][2]
+        key_delays[key, i] = max(
+            0, next_free + seconds - FETCH_SLOT_SECONDS - earliest_time)
+        next_free = max(next_free, earliest_time) + seconds
+      new_times[key] = next_free
+    # Once its next free time has passed, a budget is the same as no budget,
+    # so the keys can expire then.
+    ttl = int(max(new_times.values()) - time.time()) + FETCH_SLOT_SECONDS
+    failed = set(client.cas_multi(
+        dict((key, new_times[key]) for key in old_times), time=ttl) or [])
+    failed |= set(client.add_multi(
+        dict((key, new_times[key]) for key in keys if key not in old_times),
+        time=ttl) or [])
+    for key, i in key_delays:
+      if key not in failed:
+        delays[i] = max(delays[i], key_delays[key, i])
+    keys = sorted(failed)
+    if not keys:
+      break
+  else:
+    logging.warn('Gave up reserving fetch slots for %d budgets', len(keys))
+  return delays
+
+
+def UpdateMetadataBatch(addresses, deadline, handle_results):
+  """Updates the cached metadata for many sources, fetching them concurrently.
+
+  Up to metadata_max_concurrent_fetches_per_host fetches to each host run at
+  once, and as each one finishes, the next fetch to its host starts.  A fetch
+  is started only if it would time out before the deadline.  The results are
+  written to the cache in chunks of BATCH_WRITE_SIZE as they come in, so the
+  work done is kept even if the request is cut short.
+
+  Args:
+    addresses: A list of source addresses.
+    deadline: The time by which all the fetches must be finished.
+    handle_results: A function to call with each chunk of new metadata (a
+        dictionary keyed by source address) once it has been written.
+
+  Returns:
+    A list of the addresses that were not fetched because time ran out.
+  """
+  old_metadata = dict(zip(addresses, METADATA_CACHE.GetMulti(addresses)))
+  if config.Get('metadata_max_megabytes_per_day_per_source', 50) == 0:
+    logging.info('Skipped; metadata_max_megabytes_per_day_per_source is 0')
+    handle_results(old_metadata)
+    return []
+  max_host_fetches = max(
+      1, config.Get('metadata_max_concurrent_fetches_per_host', 2))
+  waiting = collections.OrderedDict()  # addresses not yet fetched, by host
+  for address in addresses:
+    hostname = ':' in address and maproot.GetHostnameForSource(address)
+    waiting.setdefault(hostname, collections.deque()).append(address)
+  running = {}  # (hostname, address, finish, fetch_time) by RPC
+  new_metadata = {}  # results not yet written
+
+  def WriteResults():
+    METADATA_CACHE.SetMulti(new_metadata.items())
+    for address, metadata in sorted(new_metadata.items()):
+      logging.info('Updated metadata for source: %s %r', address, metadata)
+    LogFetches(new_metadata)
+    handle_results(dict(new_metadata))
+    new_metadata.clear()
+
+  def StartNextFetch(hostname):
+    while waiting[hostname] and time.time() + MAX_FETCH_SECONDS <= deadline:
+      address = waiting[hostname].popleft()
+      fetch_time = time.time()
+      rpc, finish = StartFetch(old_metadata[address], address)
+      if rpc:
+        running[rpc] = hostname, address, finish, fetch_time
+        return
+      new_metadata[address] = dict(finish(), fetch_time=fetch_time)
+
+  for hostname in waiting:
+    for _ in range(max_host_fetches):
+      StartNextFetch(hostname)
+  while running:
+    hostname, address, finish, fetch_time = running.pop(
+        WaitForAnyFetch(running.keys()))
+    new_metadata[address] = dict(finish(), fetch_time=fetch_time)
+    if len(new_metadata) >= BATCH_WRITE_SIZE:
+      WriteResults()
+    StartNextFetch(hostname)
+  if new_metadata:
+    WriteResults()
+  return [address for group in waiting.values() for address in group]
+
+
 def UpdateMetadata(address):
   """Updates the cached metadata dictionary for a single source."""
   if config.Get('metadata_max_megabytes_per_day_per_source', 50) == 0:
@@ -447,21 +886,123 @@ def UpdateMetadata(address):
   metadata['fetch_time'] = fetch_time
   METADATA_CACHE.Set(address, metadata)
   logging.info('Updated metadata for source: %s %r', address, metadata)
-  if config.Get('metadata_fetch_log'):
-    MetadataFetchLog.Log(address, metadata)
+  LogFetches({address: metadata})
+
+
+def GetFetchCountdowns(metadata_by_address, countdowns=None):
+  """Determines when to fetch sources next, reserving room for the fetches.
+
+  Args:
+    metadata_by_address: A dictionary of the current metadata dictionaries
+        (or None) for the sources, keyed by source address.
+    countdowns: Optional.  A dictionary of the minimum delays in seconds,
+        keyed by source address.  For sources not in this dictionary, the
+        delay is determined from the metadata by DetermineFetchInterval.
+
+  Returns:
+    A dictionary of the number of seconds to wait before fetching each
+    source, keyed by source address, omitting the sources that should not
+    be fetched at all.
+  """
+  countdowns = countdowns or {}
+  now = time.time()
+  results, fetches = {}, []
+  for address, metadata in sorted(metadata_by_address.items()):
+    metadata = metadata or {}
+    if not metadata.get('fetch_impossible'):
+      countdown = countdowns.get(address)
+      if countdown is None:
+        countdown = DetermineFetchInterval(metadata)
+      results[address] = countdown
+      hostname = ':' in address and maproot.GetHostnameForSource(address)
+      cost = HTTP_FIXED_COST + metadata.get('fetch_length', 0)
+      fetches.append((hostname, cost, now + countdown))
+  for address, delay in zip(sorted(results), ReserveFetchSlots(fetches)):
+    results[address] += delay
+    logging.info('Scheduling fetch in %ds for source: %s',
+                 results[address], address)
+  return results
+
+
+def MakeFetchTask(address, countdown):
+  """Makes a task for the metadata queue, to be run by MetadataFetch."""
+  return taskqueue.Task(
+      countdown=countdown, method='GET',
+      url=(config.Get('root_path') or '') + '/.metadata_fetch',
+      params={'source': address})
+
+
+def MakeBatchTask(address, countdown):
+  """Makes a task for BATCH_QUEUE, to be leased by MetadataFetchBatch."""
+  return taskqueue.Task(method='PULL', payload=address, countdown=countdown)
 
 
 def ScheduleFetch(address, countdown=None):
   """Schedules the next fetch task for a source."""
-  metadata = METADATA_CACHE.Get(address) or {}
-  if not metadata.get('fetch_impossible'):
-    if countdown is None:
-      countdown = DetermineFetchInterval(metadata)
-    logging.info('Scheduling fetch in %ds for source: %s', countdown, address)
-    taskqueue.add(
-        queue_name='metadata', countdown=countdown, method='GET',
-        url=(config.Get('root_path') or '') + '/.metadata_fetch',
-        params={'source': address})
+  ScheduleFetches({address: METADATA_CACHE.Get(address)}, {address: countdown})
+
+
+def ScheduleFetches(metadata_by_address, countdowns=None):
+  """Schedules the next fetch tasks for many sources together.
+
+  The tasks are queued with one queue operation per MAX_TASKS_PER_ADD tasks.
+
+  Args:
+    metadata_by_address: A dictionary of the current metadata dictionaries
+        (or None) for the sources, keyed by source address.
+    countdowns: Optional.  A dictionary of the minimum delays in seconds,
+        keyed by source address, as for ScheduleFetch.
+  """
+  batch = config.Get('metadata_batch_fetch')
+  make_task = MakeBatchTask if batch else MakeFetchTask
+  tasks = [make_task(address, countdown) for address, countdown in sorted(
+      GetFetchCountdowns(metadata_by_address, countdowns).items())]
+  queue = taskqueue.Queue(BATCH_QUEUE if batch else 'metadata')
+  for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+    queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+
+def FetchBatch(queue, tasks, deadline):
+  """Performs a batch of leased fetch tasks and schedules the next fetches.
+
+  As each chunk of results is written, the next fetches for its sources are
+  queued and its tasks are deleted.  The fetches that can't finish before the
+  deadline are queued again to run right away.
+
+  Args:
+    queue: The taskqueue.Queue from which the tasks were leased.
+    tasks: A list of leased tasks, whose payloads are source addresses.
+        Sources that are no longer active are skipped.
+    deadline: The time by which all the fetches must be finished.
+
+  Returns:
+    The number of tasks that were performed or skipped.
+  """
+  tasks_by_address = {}
+  for task in tasks:
+    tasks_by_address.setdefault(task.payload, []).append(task)
+  addresses = sorted(tasks_by_address)
+  active_addresses, done_tasks = [], []
+  for address, active in zip(addresses, ACTIVE_CACHE.GetMulti(addresses)):
+    if active:
+      active_addresses.append(address)
+    else:
+      logging.info('Source is no longer active: %s', address)
+      done_tasks += tasks_by_address[address]
+  if done_tasks:
+    queue.delete_tasks(done_tasks)
+
+  def HandleResults(new_metadata):
+    ScheduleFetches(new_metadata)
+    queue.delete_tasks([task for address in sorted(new_metadata)
+                        for task in tasks_by_address[address]])
+  left = UpdateMetadataBatch(active_addresses, deadline, HandleResults)
+  if left:
+    logging.info('Out of time; queueing %d fetches again', len(left))
+    queue.add([MakeBatchTask(address, 0) for address in left])
+    queue.delete_tasks([task for address in left
+                        for task in tasks_by_address[address]])
+  return len(tasks) - sum(len(tasks_by_address[address]) for address in left)
 
 
 class MetadataFetch(base_handler.BaseHandler):
@@ -477,22 +1018,51 @@ class MetadataFetch(base_handler.BaseHandler):
       logging.info('Source is no longer active: %s', source)
 
 
+class MetadataFetchBatch(base_handler.BaseHandler):
+  """Fetches the metadata for all the sources that are due, in batches.
+
+  In batch mode (when the 'metadata_batch_fetch' config setting is true),
+  fetches are queued as tasks in the BATCH_QUEUE pull queue, and cron runs
+  this handler every minute to lease the tasks that are due and do all their
+  fetches concurrently.
+  """
+
+  def Get(self):
+    """Leases and performs batches of fetches until the request is used up."""
+    queue = taskqueue.Queue(BATCH_QUEUE)
+    deadline = time.time() + BATCH_SECONDS
+    count = 0
+    # Fetches are started only if they'll time out before the deadline.
+    while time.time() + MAX_FETCH_SECONDS <= deadline:
+      tasks = queue.lease_tasks(BATCH_LEASE_SECONDS, MAX_BATCH_SIZE)
+      if not tasks:
+        break
+      count += FetchBatch(queue, tasks, deadline)
+    logging.info('Performed %d fetch tasks', count)
+
+
 class MetadataFetchLogCleaner(base_handler.BaseHandler):
-  """Deletes old MetadataFetchLog entries."""
+  """Deletes old MetadataFetchLog and MetadataFetchRollup entries."""
 
   def Get(self):
-    """Deletes MetadataFetchLog entries until the request runs out of time."""
+    """Deletes old log entries until the request runs out of time."""
+    min_time = datetime.datetime.utcnow() - METADATA_FETCH_LOG_TTL
     count = 0
     try:
-      query = MetadataFetchLog.all(keys_only=True).order('fetch_time').filter(
-          'fetch_time <', datetime.datetime.utcnow() - METADATA_FETCH_LOG_TTL)
-      keys = query.fetch(100)
-      while keys:
-        db.delete(keys)
-        count += len(keys)
-        query.with_cursor(query.cursor())
+      # Rollups are few, so delete them first; then the per-fetch entries.
+      for query in [
+          MetadataFetchRollup.all(keys_only=True).order('hour_time').filter(
+              'hour_time <', min_time),
+          MetadataFetchLog.all(keys_only=True).order('fetch_time').filter(
+              'fetch_time <', min_time)]:
         keys = query.fetch(100)
+        while keys:
+          db.delete(keys)
+          count += len(keys)
+          query.with_cursor(query.cursor())
+          keys = query.fetch(100)
     except runtime.DeadlineExceededError:
       pass
-    logging.info('Deleted %d old MetadataFetchLog entries', count)
+    logging.info('Deleted %d old MetadataFetchLog and MetadataFetchRollup '
+                 'entries', count)
 
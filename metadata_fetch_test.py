@@ -18,6 +18,8 @@ import hashlib
 import json
 import re
 import StringIO
+import time
+import urllib
 import zipfile
 
 import config
@@ -25,6 +27,7 @@ import metadata_fetch
 import test_utils
 import utils
 
+from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.api import urlfetch
 from google.appengine.api import urlfetch_errors
@@ -157,6 +160,31 @@ METADATA = {'fetch_time': 1234560000, 'fetch_status': 200, 'length': 1234}
 METADATA_2 = {'fetch_time': 1234567890, 'fetch_status': 200, 'length': 123456}
 
 
+class FakeRpc(object):
+  """Stands in for a urlfetch RPC, getting responses from a dictionary."""
+
+  def __init__(self, responses):
+    self.responses = responses
+    self.url = None
+
+  def get_result(self):  # pylint: disable=g-bad-name
+    return self.responses[self.url]
+
+
+class FakeQueue(object):
+  """Stands in for a pull queue, recording the tasks added and deleted."""
+
+  def __init__(self):
+    self.added = []
+    self.deleted = []
+
+  def add(self, tasks):  # pylint: disable=g-bad-name
+    self.added += tasks
+
+  def delete_tasks(self, tasks):  # pylint: disable=g-bad-name
+    self.deleted += tasks
+
+
 class MetadataFetchTest(test_utils.BaseTest):
 
   def testGetKml(self):
@@ -175,39 +203,50 @@ class MetadataFetchTest(test_utils.BaseTest):
     self.assertEquals('asdf', metadata_fetch.GetKml(
         CreateZip([('xyz.kml', 'asdf'), ('abc.kml', 'zxcv')])))
 
-  def testParseXml(self):
-    # ParseXml should accept ASCII text declared as UTF-8
-    xml = metadata_fetch.ParseXml(
+  def testScanXml(self):
+    # ScanXml should accept ASCII text declared as UTF-8
+    _, xml = metadata_fetch.ScanXml(
         '<?xml version="1.0" encoding="UTF-8"?><a>foo</a>')
     self.assertEquals('foo', xml.text)
 
-    # ParseXml should accept UTF-8 text declared as UTF-8
-    xml = metadata_fetch.ParseXml(
+    # ScanXml should accept UTF-8 text declared as UTF-8
+    _, xml = metadata_fetch.ScanXml(
         '<?xml version="1.0" encoding="UTF-8"?><a>f\xc3\xb8o</a>')
     self.assertEquals(u'f\xf8o', xml.text)
 
-    # ParseXml should handle non-UTF-8 text declared incorrectly as UTF-8
-    xml = metadata_fetch.ParseXml(
+    # ScanXml should handle non-UTF-8 text declared incorrectly as UTF-8
+    _, xml = metadata_fetch.ScanXml(
         '<?xml version="1.0" encoding="UTF-8"?><a>f\xf8o</a>')
     self.assertEquals(u'f\xf8o', xml.text)
 
+    # ScanXml should count all the tags, and keep only the requested element
+    tag_counts, xml = metadata_fetch.ScanXml(
+        '<a xmlns="http://x.com/"><b/><c><d/><b>foo</b></c><e><b/></e></a>',
+        '{http://x.com/}c')
+    self.assertEquals({'a': 1, 'b': 3, 'c': 1, 'd': 1, 'e': 1}, tag_counts)
+    self.assertEquals(['{http://x.com/}c'], [child.tag for child in xml])
+    self.assertEquals('foo', xml.findtext('.//{http://x.com/}b'))
+
+    # ScanXml should raise ValueError for content that isn't XML
+    self.assertRaises(ValueError, metadata_fetch.ScanXml, 'foo')
+
   def testHasUnsupportedKml(self):
-    supported_kml = metadata_fetch.ParseXml(
+    supported_kml, _ = metadata_fetch.ScanXml(
         """<?xml version="1.0" encoding="UTF-8"?>
            <kml xmlns="http://earth.google.com/kml/2.2">
            <Document><name>blah</name></Document></kml>""")
     # Unsupported tag.
-    unsupported_kml_1 = metadata_fetch.ParseXml(
+    unsupported_kml_1, _ = metadata_fetch.ScanXml(
         """<?xml version="1.0" encoding="UTF-8"?>
            <kml xmlns="http://earth.google.com/kml/2.2">
            <Document><geomColor></geomColor></Document></kml>""")
     # Supported tags, but case matters.
-    unsupported_kml_2 = metadata_fetch.ParseXml(
+    unsupported_kml_2, _ = metadata_fetch.ScanXml(
         """<?xml version="1.0" encoding="UTF-8"?>
            <kml xmlns="http://earth.google.com/kml/2.2">
            <Document><NAME></NAME></Document></kml>""")
     # Supported tags, but maximum number of network links is exceeded.
-    unsupported_kml_3 = metadata_fetch.ParseXml(
+    unsupported_kml_3, _ = metadata_fetch.ScanXml(
         """<?xml version="1.0" encoding="UTF-8"?>
            <kml xmlns="http://earth.google.com/kml/2.2">
            <Document><NetworkLink>foo</NetworkLink>
@@ -480,10 +519,12 @@ class MetadataFetchTest(test_utils.BaseTest):
         'length': 1234,
         'md5_hash': 'foo'
     }
-    # Updated metadata should be the same except fetch_status and fetch_length.
+    # Updated metadata should be the same except fetch_status, fetch_length,
+    # and fetch_unchanged_count.
     self.assertEquals({
         'fetch_status': 304,
         'fetch_length': len('Not modified'),
+        'fetch_unchanged_count': 1,
         'fetch_last_modified': LAST_MODIFIED_STRING,
         'update_time': LAST_MODIFIED_TIMESTAMP,
         'length': 1234,
@@ -508,10 +549,12 @@ class MetadataFetchTest(test_utils.BaseTest):
         'length': 1234,
         'md5_hash': 'foo'
     }
-    # Updated metadata should be the same except fetch_status and fetch_length.
+    # Updated metadata should be the same except fetch_status, fetch_length,
+    # and fetch_unchanged_count.
     self.assertEquals({
         'fetch_status': 304,
         'fetch_length': len('Not modified'),
+        'fetch_unchanged_count': 1,
         'fetch_etag': ETAG,
         'length': 1234,
         'md5_hash': 'foo'
@@ -519,6 +562,29 @@ class MetadataFetchTest(test_utils.BaseTest):
 
     self.mox.VerifyAll()
 
+  def testFetchUnchangedContent(self):
+    # Simulate fetching the same content again without getting a 304.
+    self.mox.StubOutWithMock(urlfetch, 'fetch')
+    response = utils.Struct(status_code=200, headers={}, content=SIMPLE_KML)
+    for _ in range(3):
+      urlfetch.fetch(SOURCE_URL, headers={}, deadline=30).AndReturn(response)
+
+    self.mox.ReplayAll()
+    old_metadata = {'md5_hash': hashlib.md5(SIMPLE_KML).hexdigest()}
+    metadata = metadata_fetch.FetchAndUpdateMetadata(
+        old_metadata, SOURCE_ADDRESS)
+    self.assertEquals(1, metadata['fetch_unchanged_count'])
+    metadata = metadata_fetch.FetchAndUpdateMetadata(metadata, SOURCE_ADDRESS)
+    self.assertEquals(2, metadata['fetch_unchanged_count'])
+
+    # A change in the content should reset the count.
+    old_metadata = {'md5_hash': 'foo', 'fetch_unchanged_count': 5}
+    self.assertFalse('fetch_unchanged_count' in
+                     metadata_fetch.FetchAndUpdateMetadata(
+                         old_metadata, SOURCE_ADDRESS))
+
+    self.mox.VerifyAll()
+
   def testFetchInvalidUrl(self):
     self.assertEquals(
         {'fetch_impossible': True},
@@ -578,6 +644,23 @@ class MetadataFetchTest(test_utils.BaseTest):
     self.AssertBetween(60, 180, metadata_fetch.DetermineFetchInterval(
         {'fetch_status': 304, 'fetch_length': 100, 'length': 1e6}))
 
+    # The interval should double for each fetch that found no change...
+    interval = metadata_fetch.DetermineFetchInterval(
+        {'fetch_status': 200, 'fetch_length': 100})
+    self.assertEquals(4 * interval, metadata_fetch.DetermineFetchInterval(
+        {'fetch_status': 304, 'fetch_length': 100,
+         'fetch_unchanged_count': 2}))
+
+    # ...up to a maximum factor...
+    self.assertEquals(16 * interval, metadata_fetch.DetermineFetchInterval(
+        {'fetch_status': 304, 'fetch_length': 100,
+         'fetch_unchanged_count': 10}))
+
+    # ...and never beyond the maximum interval.
+    self.assertEquals(86400, metadata_fetch.DetermineFetchInterval(
+        {'fetch_status': 200, 'fetch_length': 10e6,
+         'fetch_unchanged_count': 10}))
+
   def testUpdateMetadata(self):
     self.mox.StubOutWithMock(metadata_fetch, 'FetchAndUpdateMetadata')
     metadata_fetch.FetchAndUpdateMetadata(
@@ -602,33 +685,199 @@ class MetadataFetchTest(test_utils.BaseTest):
     metadata_fetch.METADATA_CACHE.Set(SOURCE_ADDRESS, METADATA)
     metadata_fetch.UpdateMetadata(SOURCE_ADDRESS)
 
+  def testLogFetchRollups(self):
+    config.Set('metadata_fetch_log_rollups', True)
+    metadata_fetch.LogFetches({SOURCE_ADDRESS: {
+        'fetch_time': FETCH_TIME, 'fetch_status': 200, 'fetch_length': 123,
+        'md5_hash': 'abcdef0123456789'}})
+    metadata_fetch.LogFetches({SOURCE_ADDRESS: {
+        'fetch_time': FETCH_TIME_2, 'fetch_error_occurred': True}})
+
+    # Fetches of a source within the same hour should go in one rollup.
+    rollups = metadata_fetch.MetadataFetchRollup.all().fetch(10)
+    self.assertEquals(1, len(rollups))
+    self.assertEquals(SOURCE_ADDRESS, rollups[0].address)
+    self.assertEquals([
+        {'fetch_time': FETCH_TIME, 'fetch_status': 200, 'fetch_length': 123,
+         'md5_prefix': 'abcdef01'},
+        {'fetch_time': FETCH_TIME_2, 'fetch_status': -1, 'fetch_length': -1,
+         'md5_prefix': '00000000'}
+    ], rollups[0].GetFetches())
+
+    # The cleaner should delete the whole rollup once it has expired.
+    self.SetTime(FETCH_TIME + 8 * 24 * 3600)
+    self.DoGet('/.metadata_fetch_log_cleaner')
+    self.assertEquals(0, metadata_fetch.MetadataFetchRollup.all().count())
+
   def testScheduleFetch(self):
-    # Expect a task to be queued...
-    self.mox.StubOutWithMock(taskqueue, 'add')
-    taskqueue.add(queue_name='metadata', method='GET',
-                  url='/root/.metadata_fetch',
-                  params={'source': SOURCE_ADDRESS},
-                  countdown=metadata_fetch.DetermineFetchInterval(METADATA))
-
-    # ...when the metadata_active flag is set.
-    self.mox.ReplayAll()
+    queues = {}
+    self.SetForTest(taskqueue, 'Queue',
+                    lambda name: queues.setdefault(name, FakeQueue()))
+    self.SetTime(FETCH_TIME)
     metadata_fetch.METADATA_CACHE.Set(SOURCE_ADDRESS, METADATA)
     metadata_fetch.ACTIVE_CACHE.Set(SOURCE_ADDRESS, 1)
     metadata_fetch.ScheduleFetch(SOURCE_ADDRESS)
 
-    self.mox.VerifyAll()
+    # A task should be queued when the metadata_active flag is set.
+    [task] = queues['metadata'].added
+    self.assertEquals('GET', task.method)
+    self.assertEquals('/root/.metadata_fetch?' + urllib.urlencode(
+        {'source': SOURCE_ADDRESS}), task.url)
+    self.assertEquals(
+        FETCH_TIME + metadata_fetch.DetermineFetchInterval(METADATA),
+        task.eta_posix)
+
+  def testReserveFetchSlot(self):
+    self.SetTime(1000000)
+    reserve = metadata_fetch.ReserveFetchSlot
+    # By default, each host gets a burst of two fetches, then one fetch every
+    # five seconds.
+    self.assertEquals([0, 0, 5, 10, 15],
+                      [reserve('a.com', 1000, 1000000) for _ in range(5)])
+    # Other hosts are independent.
+    self.assertEquals([0, 0, 5],
+                      [reserve('b.com', 1000, 1000003) for _ in range(3)])
+    # The rate for each host is configurable.
+    config.Set('metadata_max_fetches_per_slot_per_host', 1)
+    self.assertEquals([0, 10, 20],
+                      [reserve('c.com', 1000, 1000010) for _ in range(3)])
+
+    # Fetches are limited by the overall rate of fetches...
+    config.Set('metadata_max_fetches_per_second', 0.1)
+    self.assertEquals([0, 10, 20], [reserve('d%d.com' % i, 1000, 1000100)
+                                    for i in range(3)])
+
+    # ...and of bytes, but a big fetch still fits in an empty budget.
+    config.Set('metadata_max_fetches_per_second', 10)
+    config.Set('metadata_max_megabytes_per_second', 0.1)
+    self.assertEquals([0, 10, 20], [reserve('e%d.com' % i, 1e6, 1000200)
+                                    for i in range(3)])
+    self.assertEquals(0, reserve('f.com', 5e6, 1000300))
+
+  def testFetchBatch(self):
+    config.Set('metadata_batch_fetch', True)
+    georss_address = 'GEORSS:' + GEORSS_URL
+    responses = {
+        SOURCE_URL: utils.Struct(status_code=304, headers={}, content=''),
+        GEORSS_URL: utils.Struct(status_code=200, headers=RESPONSE_HEADERS,
+                                 content=SIMPLE_GEORSS)
+    }
+    requests = []
+    def MakeFetchCall(rpc, url, headers):
+      requests.append((url, headers))
+      rpc.url = url
+    self.SetForTest(urlfetch, 'create_rpc',
+                    lambda deadline: FakeRpc(responses))
+    self.SetForTest(urlfetch, 'make_fetch_call', MakeFetchCall)
+    self.SetForTest(metadata_fetch, 'WaitForAnyFetch', lambda rpcs: rpcs[0])
 
-  def testDontScheduleFetch(self):
-    # Expect no tasks to be queued...
-    self.mox.StubOutWithMock(taskqueue, 'add')
+    self.SetTime(FETCH_TIME)
+    old_metadata = dict(METADATA, fetch_etag=ETAG)
+    metadata_fetch.METADATA_CACHE.Set(SOURCE_ADDRESS, old_metadata)
+    metadata_fetch.ACTIVE_CACHE.Set(SOURCE_ADDRESS, 1)
+    metadata_fetch.ACTIVE_CACHE.Set(georss_address, 1)
+    queue = FakeQueue()
+    tasks = [utils.Struct(payload=address) for address in
+             [SOURCE_ADDRESS, georss_address, 'ATOM:' + ATOM_URL]]
+    self.assertEquals(3, metadata_fetch.FetchBatch(
+        queue, tasks, FETCH_TIME + 50))
+    self.assertEquals(set(tasks), set(queue.deleted))
+    self.assertEquals([], queue.added)
+
+    # Only the active sources should be fetched.
+    self.assertEquals([(GEORSS_URL, {}), (SOURCE_URL, {'If-none-match': ETAG})],
+                      sorted(requests))
+    self.assertEquals([
+        dict(old_metadata, fetch_time=FETCH_TIME, fetch_status=304,
+             fetch_length=0, fetch_unchanged_count=1),
+        {
+            'fetch_time': FETCH_TIME,
+            'fetch_status': 200,
+            'fetch_length': len(SIMPLE_GEORSS),
+            'fetch_last_modified': LAST_MODIFIED_STRING,
+            'fetch_etag': ETAG,
+            'update_time': LAST_MODIFIED_TIMESTAMP,
+            'length': len(SIMPLE_GEORSS),
+            'md5_hash': hashlib.md5(SIMPLE_GEORSS).hexdigest()
+        }
+    ], metadata_fetch.METADATA_CACHE.GetMulti([SOURCE_ADDRESS, georss_address]))
+
+    # The next fetches should be queued in the pull queue.
+    tasks = self.PopTasks('metadata-batch')
+    self.assertEquals([georss_address, SOURCE_ADDRESS],
+                      sorted(self.GetTaskBody(task) for task in tasks))
+
+  def testFetchBatchOutOfTime(self):
+    config.Set('metadata_batch_fetch', True)
+    config.Set('metadata_max_concurrent_fetches_per_host', 1)
+    urls = ['http://example.com/%d.kml' % i for i in range(3)]
+    addresses = ['KML:' + url for url in urls]
+    responses = dict((url, utils.Struct(status_code=200, headers={},
+                                        content=SIMPLE_KML)) for url in urls)
+    def MakeFetchCall(rpc, url, **unused_kwargs):
+      rpc.url = url
+    def WaitForAnyFetch(rpcs):
+      self.SetTime(time.time() + 25)  # each fetch takes 25 seconds
+      return rpcs[0]
+    self.SetForTest(urlfetch, 'create_rpc',
+                    lambda deadline: FakeRpc(responses))
+    self.SetForTest(urlfetch, 'make_fetch_call', MakeFetchCall)
+    self.SetForTest(metadata_fetch, 'WaitForAnyFetch', WaitForAnyFetch)
+
+    # Fetches run one at a time, so there's only time for two of them.
+    self.SetTime(FETCH_TIME)
+    for address in addresses:
+      metadata_fetch.ACTIVE_CACHE.Set(address, 1)
+    queue = FakeQueue()
+    tasks = [utils.Struct(payload=address) for address in addresses]
+    self.assertEquals(2, metadata_fetch.FetchBatch(
+        queue, tasks, FETCH_TIME + 60))
+    self.assertEquals([FETCH_TIME, FETCH_TIME + 25, None], [
+        metadata and metadata['fetch_time'] for metadata in
+        metadata_fetch.METADATA_CACHE.GetMulti(addresses)])
+
+    # The last fetch is queued again, to run right away.
+    self.assertEquals(set(tasks), set(queue.deleted))
+    self.assertEquals([addresses[2]], [task.payload for task in queue.added])
+    self.assertEquals(2, len(self.PopTasks('metadata-batch')))
+
+  def testReserveFetchSlots(self):
+    self.SetTime(1000000)
+    # Fetches reserved together share each budget, in order.  Each host gets
+    # two fetches per 10 seconds, after a burst of two.
+    self.assertEquals([0, 0, 5, 0, 5, 5], metadata_fetch.ReserveFetchSlots([
+        ('a.com', 1000, 1000000), ('a.com', 1000, 1000000),
+        ('a.com', 1000, 1000000), ('b.com', 1000, 1000000),
+        ('a.com', 1000, 1000005), ('a.com', 1000, 1000010)]))
+    # Later reservations see the room taken by earlier ones.
+    self.assertEquals(20, metadata_fetch.ReserveFetchSlot(
+        'a.com', 1000, 1000000))
+    # A budget whose next free time has passed doesn't delay anything.
+    self.assertEquals(0, metadata_fetch.ReserveFetchSlot(
+        'a.com', 1000, 1000100))
+
+  def testReserveFetchSlotsLosingRaces(self):
+    self.SetTime(1000000)
+    # A budget that another request updates in the meantime is retried.
+    cas_multi = memcache.Client.cas_multi
+    races = [1]
+    def CasMulti(client, *args, **kwargs):
+      if races:
+        races.pop()
+        metadata_fetch.ReserveFetchSlot('a.com', 1000, 1000000)
+      return cas_multi(client, *args, **kwargs)
+    metadata_fetch.ReserveFetchSlot('a.com', 1000, 1000000)
+    self.SetForTest(memcache.Client, 'cas_multi', CasMulti)
+    self.assertEquals(5, metadata_fetch.ReserveFetchSlot(
+        'a.com', 1000, 1000000))
 
-    # ...when the address is unfetchable.
+  def testDontScheduleFetch(self):
+    # No tasks should be queued when the address is unfetchable.
     metadata_fetch.METADATA_CACHE.Set(
         SOURCE_ADDRESS, {'fetch_impossible': True})
     metadata_fetch.ACTIVE_CACHE.Set(SOURCE_ADDRESS, 1)
     metadata_fetch.ScheduleFetch(SOURCE_ADDRESS)
-
-    self.mox.VerifyAll()
+    self.assertEquals([], self.PopTasks('metadata'))
 
   def testSystem(self):
     """Tests map, metadata_fetch, and metadata, all working together."""
@@ -70,6 +70,19 @@ class MetadataTest(test_utils.BaseTest):
     metadata.ActivateSources(sources)
     self.assertEquals(0, len(self.PopTasks('metadata')))
 
+  def testActivateSomeSources(self):
+    metadata.ACTIVE_CACHE.Set('KML:http://x.com/a', 1)
+    metadata.ActivateSources(['KML:http://x.com/a', 'GEORSS:http://y.com/b',
+                              'GEORSS:http://y.com/b'])
+
+    # Only the source that wasn't active yet should be queued, just once.
+    urls = [task['url'] for task in self.PopTasks('metadata')]
+    self.assertEquals(1, len(urls))
+    self.AssertEqualsUrlWithUnorderedParams(
+        '/root/.metadata_fetch?source=GEORSS:http://y.com/b', urls[0])
+    self.assertEquals([1, 1], metadata.ACTIVE_CACHE.GetMulti(
+        ['KML:http://x.com/a', 'GEORSS:http://y.com/b']))
+
   def testGet(self):
     cache_key, _ = metadata.CacheSourceAddresses('abc', MAPROOT)
     metadata.METADATA_CACHE.Set('KML:http://x.com/a', {'length': 123})
@@ -1186,6 +1186,8 @@ class CrowdReport(utils.Struct):
     Args:
       report_ids: A single report ID or iterable collection of report IDs.
       reviewed: True to mark the reports reviewed, false to mark unreviewed.
+    Returns:
+      A list of the updated CrowdReports.
     """
     if isinstance(report_ids, basestring):
       report_ids = [report_ids]
@@ -1196,6 +1198,7 @@ class CrowdReport(utils.Struct):
       documents.append(cls._CreateSearchDocument(model))
     ndb.put_multi(models)
     cls.index.put(documents)
+    return [cls.FromModel(model) for model in models]
 
   @classmethod
   def UpdateScore(cls, report_id, old_vote=None, new_vote_type=None):
@@ -1210,6 +1213,8 @@ class CrowdReport(utils.Struct):
       report_id: The ID of the report.
       old_vote: A CrowdVote or None, the vote that's about to be replaced.
       new_vote_type: A member of VOTE_TYPES or None, the vote about to be added.
+    Returns:
+      The updated CrowdReport, or None if there is no such report.
     """
     # This method is designed this way because scanning the indexes immediately
     # after writing a vote is likely to produce incomplete counts; there's some
@@ -1238,7 +1243,7 @@ class CrowdReport(utils.Struct):
              # Reviewer votes count 1000x user votes
              1000 * (reviewer_upvote_count - reviewer_downvote_count))
     hidden = score <= -2  # for now, two downvotes hide a report
-    cls.PutScoreForReport(
+    return cls.PutScoreForReport(
         report_id, upvote_count + reviewer_upvote_count,
         downvote_count + reviewer_downvote_count, score, hidden)
 
@@ -1246,7 +1251,7 @@ class CrowdReport(utils.Struct):
   @ndb.transactional
   def PutScoreForReport(
       cls, report_id, upvote_count, downvote_count, score, hidden):
-    """Atomically writes the voting stats on a report."""
+    """Atomically writes the voting stats on a report and returns the report."""
     model = _CrowdReportModel.get_by_id(report_id)
     if model:
       model.upvote_count = upvote_count
@@ -1256,6 +1261,8 @@ class CrowdReport(utils.Struct):
       document = cls._CreateSearchDocument(model)
       model.put()
       cls.index.put(document)
+      return cls.FromModel(model)
+
 
 # Possible types of votes.  Each vote type is associated with a particular
 # weight, and some vote types are only available to privileged users.
@@ -1317,11 +1324,15 @@ class CrowdVote(utils.Struct):
       report_id: The ID of the report.
       voter: A unique URL identifying the voter.
       vote_type: A member of VOTE_TYPES.
+    Returns:
+      The CrowdReport with its updated score, or None if there is no such
+      report.
     """
     old_vote = CrowdVote.Get(report_id, voter)
-    CrowdReport.UpdateScore(report_id, old_vote, vote_type)
+    report = CrowdReport.UpdateScore(report_id, old_vote, vote_type)
     _CrowdVoteModel(id=report_id + '\x00' + voter, report_id=report_id,
                     voter=voter, vote_type=vote_type).put()
+    return report
 
 
 class _AuthorizationModel(ndb.Model):
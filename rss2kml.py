@@ -26,6 +26,7 @@ KML_DOCUMENT_TEMPLATE = """\
 """
 
 import hashlib
+import logging
 import random
 import re
 import string
@@ -38,6 +39,9 @@ from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 
 TTL = 120
+# How long to keep the previous conversion of a feed, along with the feed's
+# validators, so that it can be reused if the feed hasn't changed.
+PREVIOUS_TTL = 3600
 
 
 class IconCache(object):
@@ -105,7 +109,8 @@ class Rss2Kml(base_handler.BaseHandler):
     kml = memcache.get(cache_key)
     if kml is not None:
       last_mod = memcache.get(cache_key + 'last_mod')
-      self.RespondWithKml(kml, last_mod)
+      etag = memcache.get(cache_key + 'etag')
+      self.RespondWithKml(kml, last_mod, etag)
       return
 
     icon_base = self.MandatoryParam('ib')
@@ -122,21 +127,49 @@ class Rss2Kml(base_handler.BaseHandler):
       searches.append((search_string.lower().split(chr(1)), icon, altitude))
     if not searches:
       raise ValueError('need to specify searches - s is mandatory')
-    rss_response = urlfetch.fetch(url, validate_certificate=False,
-                                  deadline=30)
-    rss_text = rss_response.content
-    last_modified_header = rss_response.headers.get('Last-modified')
-    doc = self.GenerateKml(rss_text, icon_base, rss_field, searches,
-                           polygon_style)
-    kml = KML_DOCUMENT_TEMPLATE % xml_utils.Serialize(doc)
-    self.RespondWithKml(kml, last_modified_header)
+
+    # If we have converted this feed before, make the request conditional.
+    previous = memcache.get(cache_key + 'previous')
+    headers = {}
+    if previous and previous['rss_etag']:
+      headers['If-None-Match'] = previous['rss_etag']
+    if previous and previous['last_mod']:
+      headers['If-Modified-Since'] = previous['last_mod']
+    try:
+      rss_response = urlfetch.fetch(url, headers=headers,
+                                    validate_certificate=False, deadline=30)
+      status = rss_response.status_code
+    except urlfetch.Error:
+      if not previous:
+        raise
+      logging.exception('fetching %s failed; reusing previous KML', url)
+      status = None
+
+    # On an upstream server error, keep serving the previous KML.
+    if previous and (status is None or status == 304 or status >= 500):
+      kml, etag = previous['kml'], previous['etag']
+      last_modified_header = previous['last_mod']
+      rss_etag = previous['rss_etag']
+    else:
+      rss_text = rss_response.content
+      last_modified_header = rss_response.headers.get('Last-modified')
+      rss_etag = rss_response.headers.get('ETag')
+      doc = self.GenerateKml(rss_text, icon_base, rss_field, searches,
+                             polygon_style)
+      kml = KML_DOCUMENT_TEMPLATE % xml_utils.Serialize(doc)
+      etag = base_handler.MakeEtag(kml)
+    self.RespondWithKml(kml, last_modified_header, etag)
     memcache.set(cache_key, kml, TTL)
+    memcache.set(cache_key + 'etag', etag, TTL)
     # Only set a cache key if we get a Last-Modified
     if last_modified_header:
       memcache.set(cache_key + 'last_mod', last_modified_header, TTL)
+    memcache.set(cache_key + 'previous', {
+        'kml': kml, 'etag': etag, 'last_mod': last_modified_header,
+        'rss_etag': rss_etag}, PREVIOUS_TTL)
 
-  def RespondWithKml(self, kml, last_modified_header):
-    self.response.write(kml)
+  def RespondWithKml(self, kml, last_modified_header, etag=None):
+    self.WriteWithEtag(kml, etag)
     self.response.headers['Content-Type'] = KML_CONTENT_TYPE
     if last_modified_header:
       self.response.headers['Last-Modified'] = last_modified_header
@@ -54,6 +54,7 @@ class Rss2KmlTest(test_utils.BaseTest):
     last_mod = 'Wed, 26 Sep 2012 02:45:35 GMT'
 
     class DummyRSS(object):
+      status_code = 200
       headers = {'Last-modified': last_mod}
       content = """\
 <rss xmlns:georss="http://www.georss.org/georss" version="2.0">
@@ -75,14 +76,18 @@ class Rss2KmlTest(test_utils.BaseTest):
   </channel>
 </rss>"""
 
+    memcache.get(mox.IgnoreArg())
     memcache.get(mox.IgnoreArg())
     urlfetch.fetch('http://feeds.rfs.nsw.gov.au/majorIncidents.xml',
-                   validate_certificate=False, deadline=30).AndReturn(DummyRSS)
+                   headers={}, validate_certificate=False,
+                   deadline=30).AndReturn(DummyRSS)
     # TODO(arb): test_utils.SetupHandler() doesn't set self.request.query_string
     # This makes our cache key broken.
     cache_key = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
     memcache.set('RSS2KML+' + cache_key, mox.IgnoreArg(), 120)
+    memcache.set('RSS2KML+' + cache_key + 'etag', mox.IgnoreArg(), 120)
     memcache.set('RSS2KML+' + cache_key + 'last_mod', last_mod, 120)
+    memcache.set('RSS2KML+' + cache_key + 'previous', mox.IgnoreArg(), 3600)
     self.mox.ReplayAll()
     handler.get()
     self.mox.VerifyAll()
@@ -154,6 +159,66 @@ class Rss2KmlTest(test_utils.BaseTest):
     self.assertEquals(Deindent(expected), Deindent(handler.response.body))
     self.assertEquals(last_mod, handler.response.headers['Last-modified'])
 
+  def testUnchangedFeedIsNotConverted(self):
+    handler = test_utils.SetupHandler(
+        '/crisismap/rss2kml', rss2kml.Rss2Kml(),
+        'ib=x%24.png&url=http%3A%2F%2Fexample.com%2Ffeed.xml&field=category&'
+        's=:0:NotApplicable')
+    last_mod = 'Wed, 26 Sep 2012 02:45:35 GMT'
+    previous = {'kml': '<kml/>', 'etag': '"abc"', 'last_mod': last_mod,
+                'rss_etag': '"v1"'}
+
+    class NotModified(object):
+      status_code = 304
+      headers = {}
+      content = ''
+
+    cache_key = 'RSS2KML+da39a3ee5e6b4b0d3255bfef95601890afd80709'
+    memcache.get(cache_key)
+    memcache.get(cache_key + 'previous').AndReturn(previous)
+    urlfetch.fetch('http://example.com/feed.xml',
+                   headers={'If-None-Match': '"v1"',
+                            'If-Modified-Since': last_mod},
+                   validate_certificate=False,
+                   deadline=30).AndReturn(NotModified)
+    memcache.set(cache_key, '<kml/>', 120)
+    memcache.set(cache_key + 'etag', '"abc"', 120)
+    memcache.set(cache_key + 'last_mod', last_mod, 120)
+    memcache.set(cache_key + 'previous', previous, 3600)
+    self.mox.ReplayAll()
+    handler.get()
+    self.mox.VerifyAll()
+    self.assertEquals('<kml/>', handler.response.body)
+    self.assertEquals('"abc"', handler.response.headers['ETag'])
+
+  def testServerErrorReusesPreviousKml(self):
+    handler = test_utils.SetupHandler(
+        '/crisismap/rss2kml', rss2kml.Rss2Kml(),
+        'ib=x%24.png&url=http%3A%2F%2Fexample.com%2Ffeed.xml&field=category&'
+        's=:0:NotApplicable')
+    previous = {'kml': '<kml/>', 'etag': '"abc"', 'last_mod': None,
+                'rss_etag': '"v1"'}
+
+    class ServerError(object):
+      status_code = 503
+      headers = {}
+      content = 'Service Unavailable'
+
+    cache_key = 'RSS2KML+da39a3ee5e6b4b0d3255bfef95601890afd80709'
+    memcache.get(cache_key)
+    memcache.get(cache_key + 'previous').AndReturn(previous)
+    urlfetch.fetch('http://example.com/feed.xml',
+                   headers={'If-None-Match': '"v1"'},
+                   validate_certificate=False,
+                   deadline=30).AndReturn(ServerError)
+    memcache.set(cache_key, '<kml/>', 120)
+    memcache.set(cache_key + 'etag', '"abc"', 120)
+    memcache.set(cache_key + 'previous', previous, 3600)
+    self.mox.ReplayAll()
+    handler.get()
+    self.mox.VerifyAll()
+    self.assertEquals('<kml/>', handler.response.body)
+
   def testCreatePlacemarkPoint(self):
     item_values = {'point': ['12 24'],
                    'title': ['a point'],
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# Copyright 2014 Google Inc.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at: http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distrib-
+# uted under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, either express or implied.  See the License for
+# specific language governing permissions and limitations under the License.
+
+"""Compares the speed of xml_utils.Xml and xml_utils.MakeElement.
+
+Usage: tools/python tools/xml_benchmark.py [<repetitions>]
+
+The placemarks in the KML produced by kmlify for the golden tests are rebuilt
+with each builder, in the way that kmlify builds them, and the time taken to
+build and to serialize them is reported.
+"""
+
+import glob
+import os
+import sys
+import time
+
+import xml_utils
+
+KML_NAMESPACE = 'http://www.opengis.net/kml/2.2'
+GOLDEN_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'goldentests')
+
+
+def GetPlacemarkFields(kml):
+  """Gets the (id, name, description, coordinates, style URL) of placemarks."""
+  kml = kml.replace(' xmlns="%s"' % KML_NAMESPACE, '', 1)
+  for placemark in xml_utils.Parse(kml).findall('.//Placemark'):
+    coordinates = placemark.find('.//coordinates')
+    yield (placemark.get('id'), placemark.findtext('name'),
+           placemark.findtext('description'),
+           coordinates is not None and coordinates.text or '',
+           placemark.findtext('styleUrl'))
+
+
+def BuildWithXml(fields):
+  xml = xml_utils.Xml
+  return [xml('Placemark', id_value and {'id': id_value} or None,
+              xml('name', name),
+              xml('description', description),
+              xml('Point', xml('coordinates', coordinates)),
+              xml('styleUrl', style_url))
+          for id_value, name, description, coordinates, style_url in fields]
+
+
+def BuildWithMakeElement(fields):
+  make = xml_utils.MakeElement
+  return [make('Placemark', None, [
+      make('name', name),
+      make('description', description),
+      make('Point', None, [make('coordinates', coordinates)]),
+      make('styleUrl', style_url)
+  ], id_value and {'id': id_value} or None)
+          for id_value, name, description, coordinates, style_url in fields]
+
+
+def Time(function, *args):
+  start = time.time()
+  result = function(*args)
+  return result, time.time() - start
+
+
+def main(repetitions):
+  fields = []
+  for path in sorted(glob.glob(os.path.join(GOLDEN_DIR, '*output*.kml'))):
+    fields += list(GetPlacemarkFields(open(path).read()))
+  fields *= repetitions
+  print '%d placemarks from the golden test outputs' % len(fields)
+
+  outputs = []
+  for builder in [BuildWithXml, BuildWithMakeElement]:
+    elements, build_time = Time(builder, fields)
+    output, write_time = Time(
+        lambda: [xml_utils.Serialize(element) for element in elements])
+    outputs.append(output)
+    print '%-22s build: %6.3f s   serialize: %6.3f s' % (
+        builder.__name__, build_time, write_time)
+  if outputs[0] != outputs[1]:
+    print 'ERROR: the builders produced different XML'
+    return 1
+
+
+if __name__ == '__main__':
+  sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100))
@@ -21,6 +21,8 @@ of an XML document to or from a Python value.  The type and structure of
 the Python value is up to the Converter.
 """
 
+import StringIO
+
 # pylint:disable=g-import-not-at-top
 try:
   import xml.etree.cElementTree as ElementTree
@@ -82,11 +84,53 @@ def Xml(tag, *args, **kwargs):
   return element
 
 
+def MakeElement(tag, text=None, children=None, attributes=None):
+  """Creates an Element quickly, for code that builds many elements.
+
+  Unlike Xml, this doesn't inspect or convert its arguments, so they must
+  already be in their final form.
+
+  Args:
+    tag: The name of the new tag, as a string (in Clark notation if it has a
+        namespace).
+    text: The text content, as a string, or None.
+    children: A list of child elements, or None.
+    attributes: A dictionary of attribute names to string values, or None.
+  Returns:
+    The newly created Element.
+  """
+  element = ElementTree.Element(tag, attributes or {})
+  element.text = text
+  if children:
+    element.extend(children)
+  return element
+
+
+def ToTuple(element):
+  """Converts an element subtree to nested tuples, which can be pickled."""
+  return (element.tag, dict(element.items()), element.text,
+          [ToTuple(child) for child in element], element.tail)
+
+
+def FromTuple(element_tuple):
+  """Converts nested tuples produced by ToTuple back into an Element."""
+  tag, attributes, text, children, tail = element_tuple
+  element = ElementTree.Element(tag, attributes)
+  element.text, element.tail = text, tail
+  element.extend([FromTuple(child) for child in children])
+  return element
+
+
 def Parse(string):
   """Parses XML from a string."""
   return ElementTree.fromstring(string)
 
 
+def IterParse(fileobject, events=('end',)):
+  """Parses XML incrementally from a file, yielding (event, element) pairs."""
+  return ElementTree.iterparse(fileobject, events)
+
+
 def Read(fileobject):
   """Reads an XML tree from a file."""
   return ElementTree.parse(fileobject)
@@ -97,7 +141,6 @@ def Read(fileobject):
 
 def Indent(element, level=0):
   """Adds indentation to an element subtree."""
-  # TODO(kpy): Make this non-mutating so we don't have to copy in serialize().
   if element:  # True if element has any children
     if not element.text or not element.text.strip():
       element.text = '\n' + '  '*(level + 1)
@@ -120,7 +163,6 @@ def FixName(name, uri_prefixes):
 
 def SetPrefixes(root, uri_prefixes):
   """Replaces Clark qualified element names with specific given prefixes."""
-  # TODO(kpy): Make this non-mutating so we don't have to copy in serialize().
   for uri, prefix in uri_prefixes.items():
     root.set('xmlns:' + prefix, uri)
 
@@ -128,13 +170,179 @@ def SetPrefixes(root, uri_prefixes):
     element.tag = FixName(element.tag, uri_prefixes)
 
 
-def Serialize(root, uri_prefixes=None, pretty_print=True):
-  """Serializes XML to a string."""
-  root_copy = ElementTree.fromstring(ElementTree.tostring(root))
-  SetPrefixes(root_copy, uri_prefixes or {})
-  if pretty_print:
-    Indent(root_copy)
-  return ElementTree.tostring(root_copy)
+# The tags of comments and processing instructions.  (In cElementTree, these
+# are not ElementTree.Comment and ElementTree.PI.)
+COMMENT_TAG = ElementTree.Comment('').tag
+PI_TAG = ElementTree.PI('').tag
+
+# The prefixes that ElementTree uses for these namespaces when no prefix is
+# specified; other namespaces get prefixes 'ns0', 'ns1', etc.
+WELL_KNOWN_PREFIXES = {
+    'http://www.w3.org/XML/1998/namespace': 'xml',
+    'http://www.w3.org/1999/xhtml': 'html',
+    'http://www.w3.org/1999/02/22-rdf-syntax-ns#': 'rdf',
+    'http://schemas.xmlsoap.org/wsdl/': 'wsdl',
+    'http://www.w3.org/2001/XMLSchema': 'xs',
+    'http://www.w3.org/2001/XMLSchema-instance': 'xsi',
+    'http://purl.org/dc/elements/1.1/': 'dc',
+}
+
+
+def EscapeText(text, encoding):
+  """Escapes and encodes character data."""
+  if '&' in text:
+    text = text.replace('&', '&amp;')
+  if '<' in text:
+    text = text.replace('<', '&lt;')
+  if '>' in text:
+    text = text.replace('>', '&gt;')
+  return text.encode(encoding, 'xmlcharrefreplace')
+
+
+def EscapeAttribute(value, encoding):
+  """Escapes and encodes an attribute value."""
+  if '&' in value:
+    value = value.replace('&', '&amp;')
+  if '<' in value:
+    value = value.replace('<', '&lt;')
+  if '>' in value:
+    value = value.replace('>', '&gt;')
+  if '"' in value:
+    value = value.replace('"', '&quot;')
+  if '\n' in value:
+    value = value.replace('\n', '&#10;')
+  return value.encode(encoding, 'xmlcharrefreplace')
+
+
+class Serializer(object):
+  """Serializes element subtrees without modifying or copying them.
+
+  The output is the same as that of ElementTree.tostring() on a tree that
+  has been through SetPrefixes() and Indent(), but the prefixes and the
+  indentation are applied as each element is written.
+  """
+
+  def __init__(self, uri_prefixes=None, pretty_print=True,
+               encoding='us-ascii'):
+    """Constructor.
+
+    Args:
+      uri_prefixes: A dictionary of namespace URI to prefixes.
+      pretty_print: If True, pretty print the XML (add indentation).
+      encoding: The encoding of the output.  Characters that can't be
+          encoded are written as character references.
+    """
+    self.uri_prefixes = uri_prefixes or {}
+    self.pretty_print = pretty_print
+    self.encoding = encoding
+
+  def Write(self, out, root, indent_level=0):
+    """Writes an element subtree to a file-like object.
+
+    Each call produces one write() on the file-like object, so a document
+    can be streamed by writing its elements one at a time.
+
+    Args:
+      out: A file-like object with a write() method.
+      root: The root element.
+      indent_level: The nesting level at which the root element will appear,
+          for serializing an element that will be embedded in a larger
+          document.
+    """
+    self.names = {}  # maps qualified names to encoded prefixed names
+    self.namespaces = {}  # maps URIs to prefixes not from self.uri_prefixes
+    self.parts = []
+    attributes = dict(root.items())
+    for uri, prefix in self.uri_prefixes.items():
+      attributes['xmlns:' + prefix] = uri
+    self.WriteElement(root, indent_level, attributes)
+    if self.namespaces:
+      # The declarations go in the start tag of the root, which comes first.
+      self.parts.insert(1, ''.join(
+          ' xmlns:%s="%s"' % (prefix.encode(self.encoding),
+                              EscapeAttribute(uri, self.encoding))
+          for uri, prefix in sorted(self.namespaces.items(),
+                                    key=lambda item: item[1])))
+    out.write(''.join(self.parts))
+
+  def GetName(self, name):
+    """Converts a Clark qualified name into an encoded prefixed name."""
+    result = self.names.get(name)
+    if result is None:
+      if name[:1] == '{':
+        uri, tag = name[1:].rsplit('}', 1)
+        prefix = self.uri_prefixes.get(uri) or self.namespaces.get(uri)
+        if prefix is None:
+          prefix = WELL_KNOWN_PREFIXES.get(uri, 'ns%d' % len(self.namespaces))
+          if prefix != 'xml':
+            self.namespaces[uri] = prefix
+        name = prefix + ':' + tag
+      result = self.names[name] = name.encode(self.encoding)
+    return result
+
+  def WriteElement(self, element, level, attributes=None):
+    """Appends the serialization of an element subtree to self.parts."""
+    write = self.parts.append
+    tag = element.tag
+    if tag is COMMENT_TAG:
+      write('<!--%s-->' % element.text.encode(self.encoding,
+                                              'xmlcharrefreplace'))
+      return
+    if tag is PI_TAG:
+      write('<?%s?>' % element.text.encode(self.encoding, 'xmlcharrefreplace'))
+      return
+
+    tag = self.GetName(tag)
+    write('<' + tag)
+    if attributes is None:
+      attributes = element.items()
+    else:
+      attributes = attributes.items()
+    if attributes:
+      # Prefixes are assigned in document order, as ElementTree does.
+      names = [self.GetName(key) for key, _ in attributes]
+      for _, name, value in sorted(
+          (key, name, value) for (key, value), name in zip(attributes, names)):
+        write(' %s="%s"' % (name, EscapeAttribute(value, self.encoding)))
+
+    text = element.text
+    children = list(element)
+    if children and self.pretty_print:
+      indent = '\n' + '  ' * (level + 1)
+      if not text or not text.strip():
+        text = indent
+    if text or children:
+      write('>')
+      if text:
+        write(EscapeText(text, self.encoding))
+      last = len(children) - 1
+      for i, child in enumerate(children):
+        self.WriteElement(child, level + 1)
+        tail = child.tail
+        if self.pretty_print and (not tail or not tail.strip()):
+          tail = i < last and indent or '\n' + '  ' * level
+        if tail:
+          write(EscapeText(tail, self.encoding))
+      write('</' + tag + '>')
+    else:
+      write(' />')
+
+
+def Serialize(root, uri_prefixes=None, pretty_print=True, indent_level=0):
+  """Serializes XML to a string.
+
+  Args:
+    root: The root element.
+    uri_prefixes: A dictionary of namespace URI to prefixes.
+    pretty_print: If True, pretty print the XML (add indentation).
+    indent_level: The nesting level at which the root element will appear,
+        for serializing an element that will be embedded in a larger document.
+  Returns:
+    The serialized XML, as a string.
+  """
+  out = StringIO.StringIO()
+  Serializer(uri_prefixes, pretty_print).Write(out, root, indent_level)
+  return out.getvalue()
 
 
 def Write(fileobj, root, uri_prefixes=None, pretty_print=True):
@@ -149,11 +357,7 @@ def Write(fileobj, root, uri_prefixes=None, pretty_print=True):
     uri_prefixes: A dictionary of namespace URI to prefixes.
     pretty_print: If True, pretty print the XML (add indentation).
   """
-  root_copy = ElementTree.fromstring(ElementTree.tostring(root))
-  SetPrefixes(root_copy, uri_prefixes or {})
-  if pretty_print:
-    Indent(root_copy)
-  # Setting encoding to 'UTF-8' makes ElementTree write the XML declaration
-  # because 'UTF-8' differs from ElementTree's default, 'utf-8'.  According
-  # to the XML 1.0 specification, 'UTF-8' is also the recommended spelling.
-  ElementTree.ElementTree(root_copy).write(fileobj, encoding='UTF-8')
+  # This is the XML declaration that ElementTree writes for 'UTF-8', which
+  # the XML 1.0 specification gives as the recommended spelling.
+  fileobj.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+  Serializer(uri_prefixes, pretty_print, 'UTF-8').Write(fileobj, root)
@@ -13,6 +13,7 @@
 # limitations under the License.
 """Tests for xml_utils.py."""
 
+import StringIO
 import unittest
 
 import xml_utils
@@ -41,6 +42,41 @@ class XmlUtilsTest(unittest.TestCase):
 </ns0:e>\
 """, xml_utils.Serialize(e4))
 
+  def testMakeElement(self):
+    e1 = xml_utils.MakeElement('a', None, [xml_utils.MakeElement('x')],
+                               {'p': 'hey', 'q': 'you'})
+    e2 = xml_utils.MakeElement('b', 'goodbye')
+    e3 = xml_utils.MakeElement('{d}e', None, [e1, e2])
+    self.assertEquals(
+        xml_utils.Serialize(xml_utils.Xml(
+            ('d', 'e'), [xml_utils.Xml('a', xml_utils.Xml('x'), p='hey',
+                                       q='you'),
+                         xml_utils.Xml('b', ['good', 'bye'])])),
+        xml_utils.Serialize(e3))
+
+  def testSerializeDoesNotModifyTree(self):
+    root = xml_utils.Parse(
+        '<a xmlns="http://x.com/" k="v"><b>1</b><c><d t="&quot;"/></c></a>')
+    before = xml_utils.ElementTree.tostring(root)
+    self.assertEquals("""\
+<x:a k="v" xmlns:x="http://x.com/">
+    <x:b>1</x:b>
+    <x:c>
+      <x:d t="&quot;" />
+    </x:c>
+  </x:a>\
+""", xml_utils.Serialize(root, {'http://x.com/': 'x'}, indent_level=1))
+    self.assertEquals(before, xml_utils.ElementTree.tostring(root))
+
+  def testWriteStreamsElements(self):
+    out = StringIO.StringIO()
+    serializer = xml_utils.Serializer(pretty_print=False, encoding='UTF-8')
+    serializer.Write(out, xml_utils.Xml('a', u'\xe9'))
+    serializer.Write(out, xml_utils.Xml(('http://y.com/', 'b'), c='&'))
+    self.assertEquals(
+        '<a>\xc3\xa9</a><ns0:b xmlns:ns0="http://y.com/" c="&amp;" />',
+        out.getvalue())
+
 
 if __name__ == '__main__':
   unittest.main()